@@ -11,9 +11,12 @@ if [ -z "$SERVER_IP" ]; then
 fi
 echo "Using Server IP: $SERVER_IP"
 
-# Update config.json
-CONFIG_FILE="/opt/super-pxe-server/deploy/brain/config.json"
-if [ ! -f "$CONFIG_FILE" ]; then
+# Seed config.json on first start. Exported so this script and the brain that
+# supervisord starts (which inherits the environment) open the same store.
+export SUPER_PXE_CONFIG_FILE="${SUPER_PXE_CONFIG_FILE:-/opt/super-pxe-server/brain/config.json}"
+CONFIG_FILE="$SUPER_PXE_CONFIG_FILE"
+CONFIG_DB="${CONFIG_FILE%.json}.db"
+if [ ! -f "$CONFIG_FILE" ] && [ ! -f "$CONFIG_DB" ]; then
     echo "Creating default config..."
     cat <<EOF > "$CONFIG_FILE"
 {
@@ -24,15 +27,16 @@ if [ ! -f "$CONFIG_FILE" ]; then
     "menu_title": "Super PXE Docker"
 }
 EOF
-else
-    # Update IP in existing config if it was default
-    sed -i "s/127.0.0.1/$SERVER_IP/g" "$CONFIG_FILE"
 fi
 
+# Replace the 127.0.0.1 placeholder through the brain, which knows whether
+# settings live in config.json or have been migrated into config.db
+(cd /opt/super-pxe-server/brain && ./venv/bin/python brain.py --server-ip "$SERVER_IP")
+
 # 2. Permissions
 # Ensure storage is writable (important if volume mounted)
-chown -R nobody:nogroup /opt/super-pxe-server/deploy/storage
-chmod -R 777 /opt/super-pxe-server/deploy/storage
+chown -R nobody:nogroup /opt/super-pxe-server/storage
+chmod -R 777 /opt/super-pxe-server/storage
 
 # 3. Start Supervisor (manages all processes)
 exec /usr/bin/supervisord
@@ -79,7 +79,7 @@ requests
 EOF
 
 # Write config.json (Safely)
-if [ -f "$PROJECT_DIR/brain/config.json" ]; then
+if [ -f "$PROJECT_DIR/brain/config.json" ] || [ -f "$PROJECT_DIR/brain/config.db" ]; then
     log "Config file exists. Skipping overwrite to preserve settings."
 else
     log "Creating default config.json..."
@@ -1182,10 +1182,36 @@ systemctl enable super-pxe-brain --now
 # --- 5. Configure Nginx ---
 log "Configuring Nginx..."
 cat <<EOF > /etc/nginx/sites-available/super-pxe
+# Only hand well-formed query args to try_files (static boot export)
+map \$arg_mac \$pxe_static_mac {
+    default                    "";
+    "~^[0-9a-f]{2}(:[0-9a-f]{2}){5}\$"  \$arg_mac;
+}
+map \$arg_mac \$pxe_static_menu {
+    ""                         "/boot/menu";
+    "~^[0-9a-f]{2}(:[0-9a-f]{2}){5}\$"  "/boot/menu";
+    default                    "/no-static"; # Other MAC spellings need the Brain's lookup
+}
+map \$arg_path \$pxe_static_path {
+    default                    \$arg_path;
+    "~\\.\\."                    "/invalid";
+}
+
 server {
     listen 80;
     server_name _;
     
+    # Pre-rendered boot scripts (static_boot_export); misses go to the Brain
+    location = /boot.ipxe {
+        root $PROJECT_DIR/generated_configs;
+        default_type text/plain;
+        try_files /boot/clients/\${pxe_static_mac}.ipxe \${pxe_static_menu}/\$arg_type/\${pxe_static_path}/menu.ipxe @brain;
+    }
+
+    location @brain {
+        proxy_pass http://127.0.0.1:$BRAIN_PORT;
+    }
+
     # Serve Boot Files
     location /tftpboot/ {
         alias $PROJECT_DIR/tftpboot/; 
@@ -1204,6 +1230,14 @@ server {
         autoindex on;
     }
 
+    # HTTP SAN boot with kernel sendfile (set san_http_url to http://<ip>/san to use it)
+    location /san/ {
+        alias $PROJECT_DIR/storage/vhds/;
+        sendfile on;
+        tcp_nopush on;
+        max_ranges 64;
+    }
+
     # Proxy API requests to Brain
     location / {
         proxy_pass http://127.0.0.1:$BRAIN_PORT;
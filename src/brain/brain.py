@@ -1,4 +1,5 @@
 import os
+import copy
 import logging
 import json
 import secrets
@@ -8,13 +9,44 @@ import uuid
 import time
 import platform
 import hashlib
-from fastapi import FastAPI, Request, Depends, HTTPException, status, UploadFile, File
+import threading
+import ctypes
+import ctypes.util
+import select
+import errno
+import struct
+import fcntl
+import asyncio
+import functools
+import mmap
+import csv
+import io
+import re
+import sqlite3
+import bisect
+import itertools
+import random
+import multiprocessing
+import argparse
+from fastapi import FastAPI, Request, Depends, HTTPException, status
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
-from fastapi.responses import PlainTextResponse, FileResponse
+from fastapi.responses import PlainTextResponse, FileResponse, Response, JSONResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
-from pydantic import BaseModel
+from pydantic import BaseModel, ValidationError
+from jinja2 import StrictUndefined, TemplateError
+from jinja2.sandbox import SandboxedEnvironment
 from pathlib import Path
 from typing import Optional, List, Dict, Any
+from collections import OrderedDict, deque
+from urllib.parse import quote
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+_IMPORT_STARTED = time.perf_counter()
+try:
+    from python_multipart.multipart import MultipartParser, parse_options_header
+except ImportError: # python-multipart < 0.0.13
+    from multipart.multipart import MultipartParser, parse_options_header
 
 # --- Licensing Engine ---
 
@@ -24,7 +56,7 @@ class LicenseManager:
         self.license_file = config_dir / ".license_store"
         self.machine_id = self._get_machine_id()
         self.trial_days = 60
-        self.status = self._refresh_status()
+        self.status = None # Computed on first use, not at import
 
     def _get_machine_id(self):
         mid_path = Path("/etc/machine-id")
@@ -35,7 +67,7 @@ class LicenseManager:
     def _refresh_status(self):
         # 1. Check for Enterprise Key (Placeholder logic)
         # In production, this would verify a signed JWT/key
-        config = load_config()
+        config = get_config_snapshot().config
         if config.get("license_key") and "SPS-ENT-" in config.get("license_key"):
             # Simple check for demo: key must contain machine_id hash
             expected = hashlib.sha256(self.machine_id.encode()).hexdigest()[:8].upper()
@@ -68,6 +100,8 @@ class LicenseManager:
         self.license_file.write_text(json.dumps(data))
 
     def is_enterprise(self):
+        if self.status is None:
+            self.status = self._refresh_status()
         return self.status["type"] == "ENTERPRISE" or self.status["type"] == "TRIAL"
 
     def check_feature(self, feature: str, current_count: int = 0):
@@ -100,6 +134,10 @@ else:
     CONFIG_FILE = PROJECT_ROOT / "brain/config.json"
     STATIC_DIR = PROJECT_ROOT / "brain/static"
 
+# Explicit overrides (relocated installs, tests, benchmarks)
+RUNTIME_ROOT = Path(os.environ.get("SUPER_PXE_RUNTIME_ROOT", RUNTIME_ROOT))
+CONFIG_FILE = Path(os.environ.get("SUPER_PXE_CONFIG_FILE", CONFIG_FILE))
+
 STORAGE_ROOT = RUNTIME_ROOT / "storage"
 GENERATED_DIR = RUNTIME_ROOT / "generated_configs"
 TFTP_ROOT = RUNTIME_ROOT / "tftpboot"
@@ -122,6 +160,24 @@ DEFAULT_CONFIG = {
     "menu_title": "Super PXE Server (Next-Gen)",
     "admin_password": "admin",
     "license_key": "",
+    "asset_watch": "auto", # 'auto', 'inotify' or 'poll' (use 'poll' for NFS-backed storage)
+    "static_boot_export": False, # Pre-render boot scripts for nginx into generated_configs/boot
+    "overlay_workers": 4, # Concurrent qemu-img overlay creations
+    "overlay_gc_interval": 3600, # Seconds between sweeps for orphaned overlays; 0 disables
+    "san_http_url": "", # Base URL for HTTP SAN boot; empty = the Brain's /san/ (e.g. http://<ip>/san for nginx)
+    "disk_workers": 32, # Threads for blocking disk, store and tool work off the event loop
+    "bulk_workers": 8, # Threads for HTTP SAN reads, uploads and target syncs, kept apart from disk_workers
+    "image_index_workers": 2, # Processes checksumming and inspecting images in the background
+    "image_index_interval": 300, # Seconds between full storage walks for the image index; 0 disables
+    "image_index_read_mbps": 0, # Per-worker read rate cap for the image index in MB/s; 0 = uncapped
+    "tgt_live_apply": True, # Push target changes to the running tgtd via tgtadm
+    "iso_kernel_boot": True, # Boot recognised Linux ISOs via extracted kernel/initrd instead of memdisk
+    "max_injection_upload_mb": 64, # Per-file cap for /api/upload_injection
+    "admission_control": False, # Queue per-MAC boots beyond the budgets below (disables static client scripts)
+    "admission_budgets": {"memdisk": 10, "kernel": 40, "iscsi": 60}, # Concurrent boots per type; 0 = unlimited
+    "admission_lease": {"memdisk": 300, "kernel": 120, "iscsi": 45}, # Max seconds a boot holds its slot
+    "admission_backoff": 5, # Base seconds a queued client sleeps before re-chaining (jittered)
+    "session_poll_interval": 5, # Seconds between tgtadm polls for the live session list; 0 disables
     "clients": [] 
 }
 
@@ -131,11 +187,244 @@ security = HTTPBasic()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("Brain")
 
-licenser = LicenseManager(CONFIG_FILE.parent)
-
 app.mount("/static", StaticFiles(directory=STATIC_DIR), name="static")
-# Serve injections via HTTP
-app.mount("/injections", StaticFiles(directory=INJECTION_DIR), name="injections")
+
+# --- Metrics ---
+# Prometheus text exposition without the client library. Updates are a dict
+# lookup and an add under a per-metric lock, cheap enough for the boot path.
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+COUNT_BUCKETS = (0, 10, 100, 1000, 10000, 100000)
+METRICS: List["_Metric"] = []
+
+def _label_value(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_label_value(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.lock = threading.Lock()
+        self.values: Dict[tuple, Any] = {}
+        METRICS.append(self)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            items = [(k, copy.deepcopy(v)) for k, v in self.values.items()]
+        for labels, value in items:
+            lines.extend(self._samples(labels, value))
+        return lines
+
+    def _samples(self, labels: tuple, value) -> List[str]:
+        return [f"{self.name}{_format_labels(self.labels, labels)} {value}"]
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount: float = 1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+class Gauge(_Metric):
+    """Sampled at scrape time from a callback returning {label values: value}."""
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, labels: tuple = (), collect=None):
+        super().__init__(name, help, labels)
+        self.collect = collect
+
+    def render(self) -> List[str]:
+        try:
+            values = dict(self.collect())
+            with self.lock:
+                self.values = values
+        except Exception as e:
+            logger.error(f"Metric {self.name} failed: {e}")
+        return super().render()
+
+class _Timer:
+    __slots__ = ("histogram", "labels", "started")
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, *self.labels)
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+
+    def observe(self, value: float, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            state = self.values.get(labels)
+            if state is None:
+                state = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][index] += 1
+            state[1] += value
+
+    def time(self, *labels) -> _Timer:
+        return _Timer(self, labels)
+
+    def _samples(self, labels: tuple, value) -> List[str]:
+        counts, total = value
+        lines, cumulative = [], 0
+        for bound, count in zip(self.buckets + ("+Inf",), counts):
+            cumulative += count
+            le = f'le="{bound}"'
+            lines.append(f"{self.name}_bucket{_format_labels(self.labels, labels, le)} {cumulative}")
+        lines.append(f"{self.name}_sum{_format_labels(self.labels, labels)} {total}")
+        lines.append(f"{self.name}_count{_format_labels(self.labels, labels)} {cumulative}")
+        return lines
+
+def render_metrics() -> str:
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+HTTP_REQUESTS = Counter("pxe_http_requests_total", "HTTP requests by route and status.", ("route", "method", "status"))
+HTTP_LATENCY = Histogram("pxe_http_request_duration_seconds", "HTTP request latency by route.", ("route", "method"))
+BOOTS = Counter("pxe_boots_total", "boot.ipxe responses by mode, boot type and outcome.", ("mode", "boot_type", "outcome"))
+SCRIPT_CACHE = Counter("pxe_boot_script_cache_total", "Boot script cache lookups.", ("result",))
+ASSET_SCAN_SECONDS = Histogram("pxe_asset_scan_duration_seconds", "Storage directory scan time.", ("root",))
+ASSET_SCAN_ENTRIES = Histogram("pxe_asset_scan_entries", "Entries returned per storage directory scan.", ("root",),
+                               buckets=COUNT_BUCKETS)
+CONFIG_PARSE_SECONDS = Histogram("pxe_config_parse_duration_seconds", "Time to load and parse the config.")
+OVERLAY_CREATE_SECONDS = Histogram("pxe_overlay_create_duration_seconds", "qemu-img overlay creation time.", ("result",))
+OVERLAY_GC_REMOVED = Counter("pxe_overlay_gc_removed_total", "Orphaned overlay files deleted by GC.")
+TARGETS_SYNC_SECONDS = Histogram("pxe_targets_sync_duration_seconds", "targets.conf regeneration and tgtd apply time.")
+# Gauges read state owned by objects defined further down, at scrape time only
+Gauge("pxe_config_version", "In-memory config snapshot version.",
+      collect=lambda: {(): get_config_snapshot().version})
+Gauge("pxe_asset_index_dirs", "Storage directories held in the asset index.",
+      collect=lambda: {(): len(ASSET_INDEX.indexed_dirs())})
+Gauge("pxe_boot_script_cache_entries", "Rendered boot scripts held in the cache.",
+      collect=lambda: {(): len(_MENU_CACHE)})
+Gauge("pxe_overlay_jobs", "Overlay provisioning jobs by state.", ("state",),
+      collect=lambda: {(state,): sum(1 for j in list(overlays.jobs.values()) if j["state"] == state)
+                       for state in (OVERLAY_PENDING, OVERLAY_CREATING, OVERLAY_READY, OVERLAY_FAILED,
+                                     OVERLAY_MAINTENANCE)})
+Gauge("pxe_overlay_allocated_bytes", "Disk space allocated to overlays.",
+      collect=lambda: {(): overlay_lifecycle.allocated_bytes()})
+Gauge("pxe_cluster_leader", "1 if this process owns targets, overlays and background jobs.",
+      collect=lambda: {(): int(cluster.is_leader)})
+
+class MetricsMiddleware:
+    """Pure ASGI so it adds no task or body copy per request (unlike BaseHTTPMiddleware)."""
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        started = time.perf_counter()
+        status_code = 500
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = scope.get("route")
+            # Route templates keep the label set bounded (no raw paths or MACs)
+            route = getattr(route, "path", None) or "unmatched"
+            HTTP_LATENCY.observe(time.perf_counter() - started, route, scope["method"])
+            HTTP_REQUESTS.inc(route, scope["method"], status_code)
+
+app.add_middleware(MetricsMiddleware)
+
+# --- Execution Model ---
+# The event loop only does cheap, non-blocking work. Anything that touches the
+# disk, the config store or an external tool runs on one bounded pool, so a
+# slow NFS stat or tgtadm call ties up a worker instead of every in-flight
+# boot. Bulk transfers (HTTP SAN reads, uploads, target syncs) get a pool of
+# their own: a few clients streaming a disk image must not queue the short
+# lookups every boot script needs. A lag monitor reports when the loop is
+# blocked anyway.
+
+LOOP_LAG_INTERVAL = 0.25
+LOOP_LAG_THRESHOLD = 0.1 # Seconds of lag that count as a stall
+LOOP_LAG = Histogram("pxe_event_loop_lag_seconds", "Event loop scheduling delay.")
+LOOP_STALLS = Counter("pxe_event_loop_stalls_total", "Event loop stalls over the lag threshold.")
+
+_DISK_POOL: Optional[ThreadPoolExecutor] = None
+_DISK_POOL_LOCK = threading.Lock()
+
+def disk_pool() -> ThreadPoolExecutor:
+    global _DISK_POOL
+    with _DISK_POOL_LOCK:
+        if _DISK_POOL is None:
+            workers = int(get_config_snapshot().config.get("disk_workers", 32))
+            _DISK_POOL = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="disk")
+        return _DISK_POOL
+
+async def run_disk(func, *args, **kwargs):
+    """Runs blocking func on the disk pool and awaits its result."""
+    return await asyncio.get_running_loop().run_in_executor(disk_pool(), functools.partial(func, *args, **kwargs))
+
+_BULK_POOL: Optional[ThreadPoolExecutor] = None
+
+def bulk_pool() -> ThreadPoolExecutor:
+    global _BULK_POOL
+    with _DISK_POOL_LOCK:
+        if _BULK_POOL is None:
+            workers = int(get_config_snapshot().config.get("bulk_workers", 8))
+            _BULK_POOL = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="bulk")
+        return _BULK_POOL
+
+async def run_bulk(func, *args, **kwargs):
+    """Runs blocking func on the bulk pool and awaits its result."""
+    return await asyncio.get_running_loop().run_in_executor(bulk_pool(), functools.partial(func, *args, **kwargs))
+
+def off_loop(func):
+    """Turns a blocking handler into an async one that runs on the disk pool."""
+    @functools.wraps(func) # FastAPI reads the parameters through __wrapped__
+    async def handler(*args, **kwargs):
+        return await run_disk(func, *args, **kwargs)
+    return handler
+
+def shutdown_pools():
+    global _DISK_POOL, _BULK_POOL
+    with _DISK_POOL_LOCK:
+        pools, _DISK_POOL, _BULK_POOL = (_DISK_POOL, _BULK_POOL), None, None
+    for pool in pools:
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+async def monitor_event_loop_lag():
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        lag = max(0.0, loop.time() - started - LOOP_LAG_INTERVAL)
+        LOOP_LAG.observe(lag)
+        if lag > LOOP_LAG_THRESHOLD:
+            LOOP_STALLS.inc()
+            logger.warning(f"Event loop stalled for {lag * 1000:.0f} ms")
 
 # --- Models ---
 
@@ -148,6 +437,8 @@ class ClientModel(BaseModel):
     overlay: bool = False # For VHD: Use Copy-On-Write overlay?
     injection_file: Optional[str] = None # Filename in INJECTION_DIR
     kernel_args: Optional[str] = None # Extra args for ISO/Linux boot
+    san_protocol: str = "iscsi" # For VHD: 'iscsi' (tgtd) or 'http' (iPXE sanboot over /san/, read-only)
+    vars: Dict[str, Any] = {} # Free-form values for .j2 injection templates
 
 class ConfigModel(BaseModel):
     server_ip: str
@@ -157,29 +448,437 @@ class ConfigModel(BaseModel):
     menu_title: str
     admin_password: str
     license_key: Optional[str] = ""
+    asset_watch: str = "auto"
+    static_boot_export: bool = False
+    overlay_workers: int = 4
+    overlay_gc_interval: int = 3600
+    san_http_url: str = ""
+    disk_workers: int = 32
+    bulk_workers: int = 8
+    image_index_workers: int = 2
+    image_index_interval: int = 300
+    image_index_read_mbps: int = 0
+    tgt_live_apply: bool = True
+    iso_kernel_boot: bool = True
+    max_injection_upload_mb: int = 64
+    admission_control: bool = False
+    admission_budgets: Dict[str, int] = {"memdisk": 10, "kernel": 40, "iscsi": 60}
+    admission_lease: Dict[str, int] = {"memdisk": 300, "kernel": 120, "iscsi": 45}
+    admission_backoff: int = 5
+    session_poll_interval: int = 5
     clients: List[ClientModel]
 
+# --- Config Store ---
+# Settings and clients persist through a pluggable store. SQLite (WAL) is the
+# default: each client is a row keyed by its normalized MAC, so saving a
+# change writes only the rows that differ and concurrent writers (other
+# workers, the sqlite3 shell) are serialised by the database rather than
+# racing on one file. SUPER_PXE_STORE=json keeps the legacy config.json.
+# WAL keeps its index in shared memory, which only works on one host: on a
+# network filesystem the database falls back to a rollback journal and POSIX
+# locks, and says so loudly.
+
+CONFIG_STORE_KIND = os.environ.get("SUPER_PXE_STORE", "sqlite")
+CONFIG_DB = CONFIG_FILE.with_suffix(".db")
+NETWORK_FILESYSTEMS = {"nfs", "nfs4", "cifs", "smb3", "smbfs", "ceph", "glusterfs", "fuse.glusterfs",
+                       "fuse.sshfs", "fuse.cephfs", "9p", "lustre", "gpfs", "ocfs2", "gfs2", "beegfs"}
+
+def filesystem_type(path: Path) -> Optional[str]:
+    """Type of the filesystem holding path, from the longest matching mount point."""
+    target = os.path.realpath(path)
+    best, fstype = "", None
+    try:
+        with open("/proc/self/mounts") as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                mount = fields[1].replace("\\040", " ")
+                if (target == mount or target.startswith(mount.rstrip("/") + "/")) and len(mount) >= len(best):
+                    best, fstype = mount, fields[2]
+    except OSError:
+        return None
+    return fstype
+
+def sqlite_journal_mode(path: Path) -> str:
+    fstype = filesystem_type(path.parent)
+    if fstype in NETWORK_FILESYSTEMS:
+        logger.warning(f"{path} is on {fstype}: WAL does not work across hosts, using a rollback journal. "
+                       f"Writes are slower and only as safe as the server's locking; keep SQLite "
+                       f"databases on local disk where you can")
+        return "DELETE"
+    return "WAL"
+
+def normalize_mac(mac: str) -> str:
+    """Canonical lowercase colon form: 'AA-BB-CC-DD-EE-FF' -> 'aa:bb:cc:dd:ee:ff'."""
+    mac = mac.strip().lower().replace("-", ":")
+    if ":" not in mac and len(mac) == 12:
+        mac = ":".join(mac[i:i + 2] for i in range(0, 12, 2))
+    return mac
+
+class JsonConfigStore:
+    """Everything in one JSON file, rewritten whole on every save."""
+    name = "json"
+
+    def __init__(self, path: Path):
+        self.path = path
+
+    def stamp(self):
+        try:
+            st = self.path.stat()
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    def load(self) -> Dict[str, Any]:
+        if not self.path.exists():
+            return {}
+        with open(self.path, "r") as f:
+            return json.load(f)
+
+    def save(self, config: Dict[str, Any]):
+        """Writes config and returns the new stamp."""
+        # Write-then-rename so concurrent readers never parse a half-written file
+        tmp_path = self.path.with_name(self.path.name + ".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(config, f, indent=4)
+        os.replace(tmp_path, self.path)
+        return self.stamp()
+
+    def update_clients(self, upserts: List[Dict], deletes: List[str] = ()):
+        """Upserts clients by MAC and deletes others; returns the stamps before and after."""
+        previous = self.stamp()
+        config = self.load()
+        upserts = {normalize_mac(c.get("mac") or ""): c for c in upserts}
+        deletes = {normalize_mac(m) for m in deletes}
+        clients = []
+        for client in config.get("clients", []):
+            mac = normalize_mac(client.get("mac") or "")
+            if mac not in deletes:
+                clients.append(upserts.pop(mac, client))
+        config["clients"] = clients + list(upserts.values())
+        return previous, self.save(config)
+
+    def get_client(self, mac: str) -> Optional[Dict]:
+        mac = normalize_mac(mac)
+        for client in self.load().get("clients", []):
+            if normalize_mac(client.get("mac", "")) == mac:
+                return client
+        return None
+
+    def overlay_count(self, exclude_macs: List[str] = ()) -> int:
+        exclude = {normalize_mac(m) for m in exclude_macs}
+        return sum(1 for c in self.load().get("clients", [])
+                   if c.get("overlay") and normalize_mac(c.get("mac", "")) not in exclude)
+
+class SqliteConfigStore:
+    name = "sqlite"
+    SCHEMA_VERSION = 1
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL);
+        CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS clients (
+            mac TEXT PRIMARY KEY, -- normalized; the primary key index serves lookups
+            position INTEGER NOT NULL,
+            type TEXT,
+            image TEXT,
+            overlay INTEGER NOT NULL DEFAULT 0,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS clients_overlay ON clients(overlay) WHERE overlay = 1;
+    """
+    # Any write from any connection bumps the generation, which is what stamp() reads
+    TRIGGERS = [f"""
+        CREATE TRIGGER IF NOT EXISTS {table}_{op}_generation AFTER {op.upper()} ON {table}
+        BEGIN UPDATE meta SET value = value + 1 WHERE key = 'generation'; END;
+    """ for table in ("settings", "clients") for op in ("insert", "update", "delete")]
+
+    def __init__(self, path: Path, legacy_json: Optional[Path] = None):
+        self.path = path
+        self.local = threading.local()
+        self._stamp_cache = None
+        conn = self._conn()
+        conn.execute(f"PRAGMA journal_mode={sqlite_journal_mode(path)}")
+        conn.executescript("BEGIN IMMEDIATE;" + self.SCHEMA + "".join(self.TRIGGERS) + "COMMIT;")
+        migrated = None
+        with self._transaction() as conn:
+            row = conn.execute("SELECT value FROM meta WHERE key = 'schema_version'").fetchone()
+            if row is not None and row[0] > self.SCHEMA_VERSION:
+                raise RuntimeError(f"{path} has schema v{row[0]}, newer than this brain (v{self.SCHEMA_VERSION})")
+            if row is None:
+                conn.execute("INSERT INTO meta VALUES ('schema_version', ?)", (self.SCHEMA_VERSION,))
+                conn.execute("INSERT INTO meta VALUES ('generation', 0)")
+                # Inside the same transaction, so another worker never sees a half-migrated store
+                if legacy_json is not None and legacy_json.exists():
+                    with open(legacy_json, "r") as f:
+                        migrated = json.load(f)
+                    self._write(conn, migrated)
+                    # The file itself stays put, so a rollback to a JSON-only brain still has its config
+                    conn.execute("INSERT INTO meta VALUES ('migrated_from_json', ?)", (int(time.time()),))
+        if migrated is not None:
+            logger.info(f"Migrated {legacy_json} ({len(migrated.get('clients', []))} clients) into {path}; "
+                        f"the original is left in place and no longer read")
+
+    def _conn(self) -> sqlite3.Connection:
+        # One connection per thread; sqlite3 connections must not cross threads
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    # stamp() runs on every request. Writes from any process touch the db or its
+    # WAL, so the generation is only re-read when their stat changes, or after
+    # STAMP_RECHECK seconds in case a write landed within the same mtime tick.
+    STAMP_RECHECK = 1.0
+
+    def _files_stamp(self) -> tuple:
+        stamps = []
+        for path in (self.path, self.path.with_name(self.path.name + "-wal")):
+            try:
+                st = path.stat()
+                stamps.append((st.st_mtime_ns, st.st_size, st.st_ino))
+            except OSError:
+                stamps.append(None)
+        return tuple(stamps)
+
+    def stamp(self):
+        files = self._files_stamp()
+        cached = self._stamp_cache
+        if cached is not None and cached[0] == files and time.monotonic() - cached[1] < self.STAMP_RECHECK:
+            return cached[2]
+        checked = time.monotonic()
+        generation = self._conn().execute("SELECT value FROM meta WHERE key = 'generation'").fetchone()[0]
+        self._stamp_cache = (files, checked, generation)
+        return generation
+
+    def load(self) -> Dict[str, Any]:
+        conn = self._conn()
+        conn.execute("BEGIN")
+        try:
+            config = {key: json.loads(value) for key, value in conn.execute("SELECT key, value FROM settings")}
+            config["clients"] = [json.loads(data) for (data,) in
+                                 conn.execute("SELECT data FROM clients ORDER BY position")]
+        finally:
+            conn.execute("COMMIT")
+        return config
+
+    @staticmethod
+    def _client_row(position: int, client: Dict) -> tuple:
+        return (normalize_mac(client.get("mac") or ""), position, client.get("type"), client.get("image"),
+                1 if client.get("overlay") else 0, json.dumps(client, sort_keys=True))
+
+    def save(self, config: Dict[str, Any]):
+        """Writes only the settings and client rows that changed; returns the new stamp.
+        Without a 'clients' key the stored clients are left alone."""
+        with self._transaction() as conn:
+            self._write(conn, config)
+            return conn.execute("SELECT value FROM meta WHERE key = 'generation'").fetchone()[0]
+
+    def _write(self, conn: sqlite3.Connection, config: Dict[str, Any]):
+        settings = {k: json.dumps(v, sort_keys=True) for k, v in config.items() if k != "clients"}
+        current = dict(conn.execute("SELECT key, value FROM settings"))
+        conn.executemany("DELETE FROM settings WHERE key = ?", [(k,) for k in current if k not in settings])
+        conn.executemany("INSERT OR REPLACE INTO settings VALUES (?, ?)",
+                         [(k, v) for k, v in settings.items() if current.get(k) != v])
+        if config.get("clients") is not None:
+            rows = {}
+            for position, client in enumerate(config["clients"]):
+                row = self._client_row(position, client)
+                if row[0] in rows:
+                    logger.warning(f"Duplicate client MAC {row[0]}; keeping the later entry")
+                rows[row[0]] = row
+            current = {r[0]: r for r in conn.execute(
+                "SELECT mac, position, type, image, overlay, data FROM clients")}
+            conn.executemany("DELETE FROM clients WHERE mac = ?", [(m,) for m in current if m not in rows])
+            conn.executemany("INSERT OR REPLACE INTO clients VALUES (?, ?, ?, ?, ?, ?)",
+                             [r for m, r in rows.items() if current.get(m) != r])
+
+    def update_clients(self, upserts: List[Dict], deletes: List[str] = ()):
+        """Upserts clients by MAC and deletes others in one transaction; returns the
+        generations before and after, read under the same write lock."""
+        with self._transaction() as conn:
+            previous = conn.execute("SELECT value FROM meta WHERE key = 'generation'").fetchone()[0]
+            conn.executemany("DELETE FROM clients WHERE mac = ?", [(normalize_mac(m),) for m in deletes])
+            positions = dict(conn.execute("SELECT mac, position FROM clients"))
+            next_position = max(positions.values(), default=-1) + 1
+            rows = []
+            for client in upserts:
+                mac = normalize_mac(client.get("mac") or "")
+                if mac not in positions:
+                    positions[mac] = next_position
+                    next_position += 1
+                rows.append(self._client_row(positions[mac], client))
+            conn.executemany("INSERT OR REPLACE INTO clients VALUES (?, ?, ?, ?, ?, ?)", rows)
+            return previous, conn.execute("SELECT value FROM meta WHERE key = 'generation'").fetchone()[0]
+
+    def get_client(self, mac: str) -> Optional[Dict]:
+        row = self._conn().execute("SELECT data FROM clients WHERE mac = ?", (normalize_mac(mac),)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def overlay_count(self, exclude_macs: List[str] = ()) -> int:
+        conn = self._conn()
+        total = conn.execute("SELECT COUNT(*) FROM clients WHERE overlay = 1").fetchone()[0]
+        exclude = list({normalize_mac(m) for m in exclude_macs})
+        for i in range(0, len(exclude), 500): # Stay under SQLite's bound-parameter limit
+            chunk = exclude[i:i + 500]
+            total -= conn.execute(f"SELECT COUNT(*) FROM clients WHERE overlay = 1 AND mac IN "
+                                  f"({','.join('?' * len(chunk))})", chunk).fetchone()[0]
+        return total
+
+def open_config_store():
+    if CONFIG_STORE_KIND == "json":
+        return JsonConfigStore(CONFIG_FILE)
+    if CONFIG_STORE_KIND == "sqlite":
+        return SqliteConfigStore(CONFIG_DB, legacy_json=CONFIG_FILE)
+    raise ValueError(f"Unknown SUPER_PXE_STORE '{CONFIG_STORE_KIND}' (expected 'sqlite' or 'json')")
+
+CONFIG_STORE = open_config_store()
+
+# --- Config Snapshot ---
+# Loading the stored config on every /boot.ipxe hit does not survive a boot
+# storm. The loaded config is kept in memory as a versioned snapshot and is
+# only re-read when the store's stamp changes or save_config() replaces it.
+
+class ConfigSnapshot:
+    def __init__(self, config: Dict[str, Any], version: int, stamp, previous: Optional["ConfigSnapshot"] = None):
+        self.config = config
+        self.version = version
+        self.stamp = stamp
+        self.clients_by_mac = {}
+        for client in config.get("clients", []):
+            if client.get("mac"):
+                self.clients_by_mac[normalize_mac(client["mac"])] = client
+
+        # Versions at which the settings and each client last changed, so caches
+        # keyed on them survive edits to unrelated clients
+        self.settings = {k: v for k, v in config.items() if k != "clients"}
+        if previous is not None and previous.settings == self.settings:
+            self.settings_version = previous.settings_version
+        else:
+            self.settings_version = version
+        self.client_revisions = {}
+        for mac, client in self.clients_by_mac.items():
+            if previous is not None and previous.clients_by_mac.get(mac) == client:
+                self.client_revisions[mac] = previous.client_revisions[mac]
+            else:
+                self.client_revisions[mac] = version
+
+    def find_client(self, mac: str) -> Optional[Dict]:
+        return self.clients_by_mac.get(normalize_mac(mac))
+
+_CONFIG_LOCK = threading.Lock()
+_CONFIG_SNAPSHOT: Optional[ConfigSnapshot] = None
+_CONFIG_VERSION = 0
+
+def _config_stamp():
+    return CONFIG_STORE.stamp()
+
+def _install_snapshot(config: Dict[str, Any], stamp) -> ConfigSnapshot:
+    global _CONFIG_SNAPSHOT, _CONFIG_VERSION
+    _CONFIG_VERSION += 1
+    _CONFIG_SNAPSHOT = ConfigSnapshot(config, _CONFIG_VERSION, stamp, _CONFIG_SNAPSHOT)
+    return _CONFIG_SNAPSHOT
+
+def get_config_snapshot() -> ConfigSnapshot:
+    """Returns the current snapshot, reloading from the store only if it changed."""
+    stamp = _config_stamp()
+    snapshot = _CONFIG_SNAPSHOT
+    if snapshot is not None and snapshot.stamp == stamp:
+        return snapshot
+    with _CONFIG_LOCK:
+        snapshot = _CONFIG_SNAPSHOT
+        if snapshot is not None and snapshot.stamp == stamp:
+            return snapshot
+        config = DEFAULT_CONFIG.copy()
+        if stamp is not None:
+            try:
+                with CONFIG_PARSE_SECONDS.time():
+                    config.update(CONFIG_STORE.load())
+            except Exception as e:
+                logger.error(f"Failed to load config: {e}")
+        return _install_snapshot(config, stamp)
+
+def invalidate_config_snapshot():
+    global _CONFIG_SNAPSHOT
+    with _CONFIG_LOCK:
+        _CONFIG_SNAPSHOT = None
+
 # --- Helpers ---
 
 def load_config():
-    config = DEFAULT_CONFIG.copy()
-    if CONFIG_FILE.exists():
-        try:
-            with open(CONFIG_FILE, "r") as f:
-                file_config = json.load(f)
-                config.update(file_config)
-        except Exception as e:
-            logger.error(f"Failed to load config: {e}")
-    return config
+    """Returns a private, mutable copy of the current config."""
+    return copy.deepcopy(get_config_snapshot().config)
 
 def save_config(config_data):
     if isinstance(config_data.get('clients'), list):
         config_data['clients'] = [c if isinstance(c, dict) else c.dict() for c in config_data['clients']]
     
-    # Enforce Limits on Save
+    enforce_license_limits(config_data.get('clients', []))
+
+    with _CONFIG_LOCK:
+        stamp = CONFIG_STORE.save(config_data)
+        config = DEFAULT_CONFIG.copy()
+        config.update(copy.deepcopy(config_data))
+        _install_snapshot(config, stamp)
+
+def apply_server_ip(server_ip: str) -> List[str]:
+    """Replaces the 127.0.0.1 placeholder in settings with server_ip; returns the keys changed.
+    The Docker entrypoint runs this on every start, whichever store holds the config."""
+    with _CONFIG_LOCK:
+        config = CONFIG_STORE.load()
+        changed = [key for key, value in config.items()
+                   if key != "clients" and isinstance(value, str) and "127.0.0.1" in value]
+        if not changed:
+            return []
+        for key in changed:
+            config[key] = config[key].replace("127.0.0.1", server_ip)
+        stamp = CONFIG_STORE.save(config)
+        merged = DEFAULT_CONFIG.copy()
+        merged.update(config)
+        _install_snapshot(merged, stamp)
+    return changed
+
+def save_clients(upserts: List[Dict], deletes: List[str] = ()) -> ConfigSnapshot:
+    """Writes only the given clients; settings and all other clients are untouched."""
+    touched = [c['mac'] for c in upserts] + list(deletes)
+    with _CONFIG_LOCK:
+        # Counted under the lock, so two concurrent saves cannot both take the last overlay slot
+        enforce_license_limits(upserts, CONFIG_STORE.overlay_count(exclude_macs=touched))
+        previous, stamp = CONFIG_STORE.update_clients(upserts, deletes)
+        snapshot = _CONFIG_SNAPSHOT
+        if snapshot is None or snapshot.stamp != previous:
+            # Someone else wrote since our snapshot; only a full reload is correct
+            config = DEFAULT_CONFIG.copy()
+            config.update(CONFIG_STORE.load())
+            return _install_snapshot(config, stamp)
+        # Patch the snapshot's client list the way the store did: in place by MAC, new ones appended
+        upserts = {normalize_mac(c['mac']): copy.deepcopy(c) for c in upserts}
+        deletes = {normalize_mac(m) for m in deletes}
+        clients = []
+        for client in snapshot.config.get("clients", []):
+            mac = normalize_mac(client.get("mac") or "")
+            if mac not in deletes:
+                clients.append(upserts.pop(mac, client))
+        config = dict(snapshot.config, clients=clients + list(upserts.values()))
+        return _install_snapshot(config, stamp)
+
+def enforce_license_limits(clients: List[Dict], overlay_count: int = 0):
+    """Applies edition limits to clients in place. overlay_count is overlays held by other clients."""
     licenser.status = licenser._refresh_status() # Refresh status before check
-    overlay_count = 0
-    for client in config_data.get('clients', []):
+    for client in clients:
         if client.get('overlay'):
             overlay_count += 1
             allowed, msg = licenser.check_feature("diskless_overlay", overlay_count)
@@ -194,11 +893,8 @@ def save_config(config_data):
                 client['injection_file'] = None
                 logger.warning(f"Feature Limit: {msg}")
 
-    with open(CONFIG_FILE, "w") as f:
-        json.dump(config_data, f, indent=4)
-
 def get_current_username(credentials: HTTPBasicCredentials = Depends(security)):
-    config = load_config()
+    config = get_config_snapshot().config
     correct_password = config.get("admin_password", "admin")
     if not secrets.compare_digest(credentials.password, correct_password):
         raise HTTPException(
@@ -208,13 +904,8 @@ def get_current_username(credentials: HTTPBasicCredentials = Depends(security)):
         )
     return credentials.username
 
-def get_directory_contents(base_dir: Path, sub_path: str = ""):
-    target_dir = (base_dir / sub_path).resolve()
-    if not str(target_dir).startswith(str(base_dir.resolve())):
-        return [], []
+def _scan_directory(target_dir: Path, sub_path: str):
     files, dirs = [], []
-    if not target_dir.exists():
-        return files, dirs
     try:
         with os.scandir(target_dir) as it:
             for entry in it:
@@ -222,10 +913,13 @@ def get_directory_contents(base_dir: Path, sub_path: str = ""):
                 if entry.is_dir(follow_symlinks=True):
                     dirs.append({"name": entry.name, "path": rel_entry_path})
                 elif entry.is_file(follow_symlinks=True):
+                    st = entry.stat()
                     files.append({
                         "name": entry.name,
                         "path": rel_entry_path,
-                        "size": entry.stat().st_size,
+                        "size": st.st_size,
+                        "mtime": st.st_mtime_ns,
+                        "inode": st.st_ino,
                         "label": Path(entry.name).stem
                     })
     except Exception as e:
@@ -234,167 +928,3478 @@ def get_directory_contents(base_dir: Path, sub_path: str = ""):
     dirs.sort(key=lambda x: x["name"].lower())
     return files, dirs
 
+def _dir_stamp(path: Path):
+    try:
+        st = path.stat()
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_ino)
+
+# --- Asset Index ---
+# A full scandir + stat() per entry on every menu hit is the main latency on
+# large NFS libraries. Listings are kept in memory per directory and dropped
+# only when a watcher reports a change. Directories no watcher covers are
+# revalidated with a single stat() of the directory itself.
+
+ISO_EXTENSIONS = (".iso",)
+VHD_EXTENSIONS = (".vhd", ".qcow2", ".img")
+
+class _DirListing:
+    __slots__ = ("files", "dirs", "stamp", "watched")
+
+    def __init__(self, files, dirs, stamp, watched):
+        self.files = files
+        self.dirs = dirs
+        self.stamp = stamp
+        self.watched = watched
+
+class AssetIndex:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.version = 0
+        self.entries: Dict[tuple, _DirListing] = {}
+        self.keys_by_dir: Dict[str, set] = {}
+        self.invalidations: Dict[str, int] = {}
+        self.changes = 0 # Invalidations seen; the cluster leader publishes it to followers
+        self.watcher = None
+
+    def listing(self, base_dir: Path, sub_path: str = ""):
+        """Returns (files, dirs) for base_dir/sub_path. The lists are shared; do not mutate."""
+        key = (str(base_dir), sub_path)
+        entry = self.entries.get(key)
+        if entry is not None and entry.watched:
+            return entry.files, entry.dirs
+
+        target_dir = (base_dir / sub_path).resolve()
+        if not str(target_dir).startswith(str(base_dir.resolve())):
+            return [], []
+        stamp = _dir_stamp(target_dir)
+        if entry is not None and entry.stamp == stamp:
+            return entry.files, entry.dirs
+        if stamp is None:
+            return [], []
+
+        abs_dir = str(target_dir)
+        watcher = self.watcher
+        watched = watcher.watch(abs_dir) if watcher else False
+        generation = self.invalidations.get(abs_dir, 0)
+        with ASSET_SCAN_SECONDS.time(base_dir.name):
+            files, dirs = _scan_directory(target_dir, sub_path)
+        ASSET_SCAN_ENTRIES.observe(len(files) + len(dirs), base_dir.name)
+        with self.lock:
+            if self.invalidations.get(abs_dir, 0) != generation:
+                # Changed while we were scanning; let the stat() check catch up
+                watched = False
+            previous = self.entries.get(key)
+            if previous is None or previous.files != files or previous.dirs != dirs:
+                self.version += 1
+            self.entries[key] = _DirListing(files, dirs, stamp, watched)
+            self.keys_by_dir.setdefault(abs_dir, set()).add(key)
+        return files, dirs
+
+    def cached(self, base_dir: Path, sub_path: str = ""):
+        """Like listing(), but only answers from a watched entry and never touches the disk."""
+        entry = self.entries.get((str(base_dir), sub_path))
+        if entry is not None and entry.watched:
+            return entry.files, entry.dirs
+        return None
+
+    def invalidate_dir(self, abs_dir: str):
+        with self.lock:
+            self.invalidations[abs_dir] = self.invalidations.get(abs_dir, 0) + 1
+            self.changes += 1
+            keys = self.keys_by_dir.pop(abs_dir, ())
+            dropped = [self.entries.pop(k, None) for k in keys]
+            if any(dropped):
+                self.version += 1
+
+    def invalidate_all(self):
+        with self.lock:
+            self.changes += 1
+            self.entries.clear()
+            self.keys_by_dir.clear()
+            self.version += 1
+
+    def indexed_dirs(self) -> List[str]:
+        with self.lock:
+            return list(self.keys_by_dir)
+
+    def start_watcher(self, mode: str = "auto"):
+        if self.watcher:
+            return
+        watcher = None
+        if mode in ("auto", "inotify"):
+            try:
+                watcher = InotifyWatcher(self)
+            except (OSError, AttributeError) as e:
+                logger.warning(f"inotify unavailable ({e}), falling back to polling")
+        if watcher is None:
+            watcher = PollingWatcher(self)
+        # Listings cached before the watcher existed are not covered by it
+        self.invalidate_all()
+        self.watcher = watcher
+        watcher.start()
+        logger.info(f"Asset index watching storage via {watcher.name}")
+
+    def stop_watcher(self):
+        watcher, self.watcher = self.watcher, None
+        if watcher:
+            watcher.stop()
+        self.invalidate_all()
+
+class InotifyWatcher:
+    name = "inotify"
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    WATCH_MASK = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+                  IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+    EVENT_HEADER = struct.Struct("iIII")
+
+    def __init__(self, index: AssetIndex):
+        self.index = index
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.lock = threading.Lock()
+        self.dirs_by_wd: Dict[int, str] = {}
+        self.wds_by_dir: Dict[str, int] = {}
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="asset-inotify", daemon=True)
+
+    def watch(self, abs_dir: str) -> bool:
+        with self.lock:
+            if abs_dir in self.wds_by_dir:
+                return True
+            wd = self.libc.inotify_add_watch(self.fd, abs_dir.encode(), self.WATCH_MASK)
+            if wd < 0:
+                # Typically fs.inotify.max_user_watches; the stat() check still covers us
+                logger.warning(f"inotify_add_watch({abs_dir}) failed: {os.strerror(ctypes.get_errno())}")
+                return False
+            self.dirs_by_wd[wd] = abs_dir
+            self.wds_by_dir[abs_dir] = wd
+            return True
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join(timeout=2)
+        os.close(self.fd)
+
+    def _forget(self, wd: int):
+        with self.lock:
+            abs_dir = self.dirs_by_wd.pop(wd, None)
+            if abs_dir:
+                self.wds_by_dir.pop(abs_dir, None)
+        return abs_dir
+
+    def _run(self):
+        while not self.stop_event.is_set():
+            ready, _, _ = select.select([self.fd], [], [], 1.0)
+            if not ready:
+                continue
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                continue
+            changed = set()
+            offset = 0
+            while offset + self.EVENT_HEADER.size <= len(data):
+                wd, mask, _cookie, length = self.EVENT_HEADER.unpack_from(data, offset)
+                offset += self.EVENT_HEADER.size + length
+                if mask & self.IN_Q_OVERFLOW:
+                    self.index.invalidate_all()
+                    changed.clear()
+                    continue
+                if mask & (self.IN_IGNORED | self.IN_DELETE_SELF | self.IN_MOVE_SELF):
+                    abs_dir = self._forget(wd)
+                else:
+                    abs_dir = self.dirs_by_wd.get(wd)
+                if abs_dir:
+                    changed.add(abs_dir)
+            for abs_dir in changed:
+                self.index.invalidate_dir(abs_dir)
+
+class PollingWatcher:
+    """Fallback for platforms without inotify and for network filesystems it cannot see."""
+    name = "polling"
+    INTERVAL = 5.0
+    FULL_RESCAN_EVERY = 12 # Directory mtimes miss in-place size changes
+
+    def __init__(self, index: AssetIndex):
+        self.index = index
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="asset-poll", daemon=True)
+
+    def watch(self, abs_dir: str) -> bool:
+        return True
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join(timeout=2)
+
+    def _run(self):
+        cycle = 0
+        while not self.stop_event.wait(self.INTERVAL):
+            cycle += 1
+            full = cycle % self.FULL_RESCAN_EVERY == 0
+            for abs_dir in self.index.indexed_dirs():
+                with self.index.lock:
+                    keys = list(self.index.keys_by_dir.get(abs_dir, ()))
+                    entries = [self.index.entries.get(k) for k in keys]
+                if full:
+                    if any(e and (e.files, e.dirs) != _scan_directory(Path(abs_dir), k[1])
+                           for k, e in zip(keys, entries)):
+                        self.index.invalidate_dir(abs_dir)
+                elif any(e and e.stamp != _dir_stamp(Path(abs_dir)) for e in entries):
+                    self.index.invalidate_dir(abs_dir)
+
+ASSET_INDEX = AssetIndex()
+
+def get_directory_contents(base_dir: Path, sub_path: str = ""):
+    return ASSET_INDEX.listing(base_dir, sub_path)
+
+class AssetView:
+    """Read-only, always-current view of the images in a storage root."""
+    def __init__(self, base_dir: Path, extensions: tuple):
+        self.base_dir = base_dir
+        self.extensions = extensions
+        self._cached = (None, [])
+
+    def _items(self) -> List[Dict]:
+        current = ASSET_INDEX.version
+        files, _ = ASSET_INDEX.listing(self.base_dir)
+        version, items = self._cached
+        if version != current or ASSET_INDEX.version != current:
+            items = [f for f in files if f['name'].endswith(self.extensions)]
+            if ASSET_INDEX.version == current: # Otherwise the listing may predate it, as in boot_response
+                self._cached = (current, items)
+        return items
+
+    def __iter__(self):
+        return iter(self._items())
+
+    def __len__(self):
+        return len(self._items())
+
+    def __getitem__(self, i):
+        return self._items()[i]
+
+licenser = LicenseManager(CONFIG_FILE.parent)
+
 # --- Advanced Diskless Logic ---
 
+def overlay_path_for(master_vhd_path: str, client_mac: str) -> Path:
+    clean_mac = client_mac.replace(":", "").lower()
+    overlay_name = f"{clean_mac}_{Path(master_vhd_path).name}.qcow2"
+    return OVERLAY_DIR / overlay_name
+
+def overlay_master_file(overlay_path: Path) -> Path:
+    """Sidecar recording which master (and which version of it) an overlay was created on."""
+    return overlay_path.with_name(f".{overlay_path.name}.master.json")
+
+def master_stamp(path: Path) -> Optional[List[int]]:
+    try:
+        st = path.stat()
+    except OSError:
+        return None
+    return [st.st_size, st.st_mtime_ns, st.st_ino]
+
+def record_overlay_master(overlay_path: Path, master_full: Path):
+    overlay_master_file(overlay_path).write_text(json.dumps({"path": str(master_full), "stamp": master_stamp(master_full)}))
+
 def ensure_overlay(master_vhd_path: str, client_mac: str) -> str:
     """
     Creates a QCOW2 overlay for the given master VHD specific to the client.
-    Returns the absolute path to the overlay file.
+    Returns the absolute path to the overlay file. Raises on failure; clients
+    must never be silently handed the shared master instead.
     """
-    clean_mac = client_mac.replace(":", "").lower()
     master_full = (VHD_DIR / master_vhd_path).resolve()
-    overlay_name = f"{clean_mac}_{Path(master_vhd_path).name}.qcow2"
-    overlay_path = OVERLAY_DIR / overlay_name
+    overlay_path = overlay_path_for(master_vhd_path, client_mac)
     
     if not overlay_path.exists():
         logger.info(f"Creating overlay for {client_mac} on {master_vhd_path}")
+        if not master_full.is_file():
+            raise FileNotFoundError(f"Master image {master_vhd_path} not found")
+        # Create under a temporary name so a half-written overlay is never picked up
+        tmp_path = overlay_path.with_name(f".{overlay_path.name}.creating")
+        started = time.perf_counter()
         try:
             # qemu-img create -f qcow2 -b <backing_file> <overlay_file>
             subprocess.run(
-                ["qemu-img", "create", "-f", "qcow2", "-F", "raw", "-b", str(master_full), str(overlay_path)],
-                check=True, stdout=subprocess.DEVNULL
+                ["qemu-img", "create", "-f", "qcow2", "-F", "raw", "-b", str(master_full), str(tmp_path)],
+                check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE
             )
-        except subprocess.CalledProcessError as e:
-            logger.error(f"Failed to create overlay: {e}")
-            return str(master_full) # Fallback to master if fail
+            os.replace(tmp_path, overlay_path)
+            record_overlay_master(overlay_path, master_full)
+        except (OSError, subprocess.CalledProcessError) as e:
+            tmp_path.unlink(missing_ok=True)
+            OVERLAY_CREATE_SECONDS.observe(time.perf_counter() - started, "failed")
+            if isinstance(e, OSError):
+                raise
+            raise RuntimeError(f"qemu-img failed: {e.stderr.decode(errors='replace').strip() or e}")
+        OVERLAY_CREATE_SECONDS.observe(time.perf_counter() - started, "ok")
             
     return str(overlay_path)
 
+# --- Overlay Provisioning ---
+# qemu-img runs on a bounded worker pool instead of inside POST /api/config or
+# startup. Each overlay has a job with a state; boot scripts for clients whose
+# overlay is not ready yet tell iPXE to wait and re-chain.
+
+OVERLAY_PENDING = "pending"
+OVERLAY_CREATING = "creating"
+OVERLAY_READY = "ready"
+OVERLAY_FAILED = "failed"
+OVERLAY_MAINTENANCE = "maintenance" # Reset, commit or rebase in progress; target detached
+OVERLAY_EXPORTING = "exporting" # Boot path only: ready on disk, target not yet applied to tgtd
+
+class OverlayProvisioner:
+    RETRY_BACKOFF = 30 # Seconds per failed attempt before a boot retries on its own
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.jobs: Dict[str, Dict[str, Any]] = {}
+        self.executor = None
+        self.version = 0 # Bumped on every state change
+        self.on_ready = []
+        self.remote: Optional[Dict[str, Dict]] = None # The leader's jobs, when this process follows
+
+    def _pool(self):
+        if self.executor is None:
+            workers = int(get_config_snapshot().config.get("overlay_workers", 4))
+            self.executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="overlay")
+        return self.executor
+
+    def _set_state(self, job: Dict, state: str, error: Optional[str] = None):
+        job["state"] = state
+        job["error"] = error
+        job["updated"] = time.time()
+        job["exported"] = False # Until the next targets sync confirms tgtd serves it
+        self.version += 1
+        events.emit("overlay", mac=job["mac"], image=job["image"], state=state, error=error,
+                    operation=job.get("operation"))
+
+    def status(self, image: str, mac: str) -> Dict[str, Any]:
+        key = overlay_path_for(image, mac).name
+        with self.lock:
+            job = (self.jobs if self.remote is None else self.remote).get(key)
+            if job is not None:
+                return dict(job)
+        if (OVERLAY_DIR / key).exists(): # From an earlier run; tgtd still holds its target
+            return {"mac": mac, "image": image, "state": OVERLAY_READY, "error": None, "attempts": 0,
+                    "exported": True}
+        return {"mac": mac, "image": image, "state": None, "error": None, "attempts": 0}
+
+    def job(self, image: str, mac: str) -> Dict[str, Any]:
+        """Returns the job for an overlay, creating an idle one. Call with self.lock held."""
+        key = overlay_path_for(image, mac).name
+        job = self.jobs.get(key)
+        if job is None:
+            job = {"mac": mac, "image": image, "state": None, "error": None, "attempts": 0, "updated": 0,
+                   "exported": False}
+            self.jobs[key] = job
+        return job
+
+    def submit(self, image: str, mac: str, force: bool = False) -> str:
+        """Queues creation unless the overlay is ready or already queued. Returns the state."""
+        if self.remote is not None:
+            # Followers never run qemu-img; the leader creates every configured overlay
+            if force:
+                cluster.send("overlay_retry", image=image, mac=mac)
+                return OVERLAY_PENDING
+            return self.status(image, mac)["state"] or OVERLAY_PENDING
+        key = overlay_path_for(image, mac).name
+        with self.lock:
+            job = self.job(image, mac)
+            if job["state"] in (OVERLAY_PENDING, OVERLAY_CREATING, OVERLAY_MAINTENANCE):
+                return job["state"]
+            if job["state"] == OVERLAY_READY and (OVERLAY_DIR / key).exists():
+                return job["state"]
+            if (job["state"] == OVERLAY_FAILED and not force and
+                    time.time() - job["updated"] < self.RETRY_BACKOFF * job["attempts"]):
+                return job["state"]
+            if job["state"] is None and (OVERLAY_DIR / key).exists():
+                self._set_state(job, OVERLAY_READY)
+                return job["state"]
+            self._set_state(job, OVERLAY_PENDING)
+        self._pool().submit(self._create, job)
+        return OVERLAY_PENDING
+
+    def _create(self, job: Dict):
+        with self.lock:
+            self._set_state(job, OVERLAY_CREATING)
+            job["attempts"] += 1
+        try:
+            ensure_overlay(job["image"], job["mac"])
+        except Exception as e:
+            logger.error(f"Failed to create overlay for {job['mac']}: {e}")
+            with self.lock:
+                self._set_state(job, OVERLAY_FAILED, str(e))
+            return
+        with self.lock:
+            self._set_state(job, OVERLAY_READY)
+            job["attempts"] = 0
+        for callback in self.on_ready:
+            try:
+                callback(job)
+            except Exception as e:
+                logger.error(f"Overlay ready callback failed: {e}")
+
+    def mark_exported(self, iqns: set):
+        """Records which ready overlays tgtd now serves. Boots wait for this, not just the file."""
+        with self.lock:
+            for job in self.jobs.values():
+                exported = job["state"] == OVERLAY_READY and overlay_iqn(job["mac"], job["image"]) in iqns
+                if job.get("exported") != exported:
+                    job["exported"] = exported
+                    self.version += 1
+
+    def forget(self, keep: set):
+        """Drops finished jobs for overlays no longer configured."""
+        with self.lock:
+            for key in [k for k, j in self.jobs.items()
+                        if k not in keep and j["state"] in (OVERLAY_READY, OVERLAY_FAILED)]:
+                del self.jobs[key]
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+overlays = OverlayProvisioner()
+
+# --- Overlay Lifecycle ---
+# Overlays outlive the clients that made them, so a periodic sweep deletes
+# orphans (no configured client, not served by tgtd, untouched for a while).
+# Reset, commit and rebase run on a single maintenance worker and detach the
+# affected targets first: tgtd must never serve a file qemu-img is rewriting.
+
+QCOW2_HEADER = struct.Struct(">4sIQIIQ") # magic, version, backing offset, backing size, cluster bits, size
+
+def read_qcow2_header(path: Path) -> Optional[Dict[str, Any]]:
+    try:
+        with open(path, "rb") as f:
+            magic, version, backing_offset, backing_size, _, size = QCOW2_HEADER.unpack(f.read(QCOW2_HEADER.size))
+            if magic != b"QFI\xfb":
+                return None
+            backing = None
+            if backing_offset and backing_size:
+                f.seek(backing_offset)
+                backing = f.read(backing_size).decode(errors="replace")
+    except (OSError, struct.error):
+        return None
+    return {"version": version, "virtual_size": size, "backing_file": backing}
+
+def _qemu_img(*args):
+    try:
+        subprocess.run(["qemu-img", *args], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    except subprocess.CalledProcessError as e:
+        raise RuntimeError(f"qemu-img {args[0]} failed: {e.stderr.decode(errors='replace').strip() or e}")
+
+class OverlayLifecycle:
+    GC_GRACE = 600 # Orphans younger than this may belong to a client being added right now
+    TEMP_MAX_AGE = 3600 # Leftover .creating files from a crashed qemu-img
+    ALLOCATED_TTL = 60 # The metrics gauge re-scans at most this often
+
+    def __init__(self):
+        self.executor = None
+        self.allocated = None # (monotonic time, bytes)
+        self.maintenance_masters = set() # Master images whose target is held back during a commit
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def _pool(self):
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="overlay-maint")
+        return self.executor
+
+    @staticmethod
+    def configured() -> Dict[str, Dict]:
+        """Overlay file name -> client, for every configured overlay client."""
+        return {overlay_path_for(c['image'], c['mac']).name: c for c in get_config_snapshot().config.get("clients", [])
+                if c.get('type') == 'vhd' and c.get('overlay')}
+
+    @staticmethod
+    def live_paths() -> set:
+        live = targets.live or {}
+        return {t["backing_store"] for t in live.values() if t.get("backing_store")}
+
+    def inventory(self) -> List[Dict[str, Any]]:
+        """Every overlay on disk with its owner, state and allocated vs. virtual size."""
+        configured = self.configured()
+        live = self.live_paths()
+        result = []
+        with os.scandir(OVERLAY_DIR) as it:
+            entries = [e for e in it if not e.name.startswith(".") and e.is_file()]
+        for entry in sorted(entries, key=lambda e: e.name):
+            path = OVERLAY_DIR / entry.name
+            st = entry.stat()
+            header = read_qcow2_header(path) or {}
+            client = configured.get(entry.name)
+            stale = None
+            try:
+                recorded = json.loads(overlay_master_file(path).read_text())
+                stale = master_stamp(Path(recorded["path"])) != recorded["stamp"]
+            except (OSError, ValueError, KeyError):
+                pass # Created before masters were recorded
+            job = (overlays.jobs if overlays.remote is None else overlays.remote).get(entry.name, {})
+            result.append({
+                "file": entry.name,
+                "mac": client['mac'] if client else None,
+                "image": client['image'] if client else None,
+                "orphan": client is None,
+                "state": job.get("state"),
+                "operation": job.get("operation"),
+                "live": str(path) in live,
+                "allocated_bytes": st.st_blocks * 512,
+                "virtual_bytes": header.get("virtual_size"),
+                "backing_file": header.get("backing_file"),
+                "stale": stale,
+            })
+        self.allocated = (time.monotonic(), sum(o["allocated_bytes"] for o in result))
+        return result
+
+    def allocated_bytes(self) -> int:
+        """Space allocated to overlays, for scrapes. Only stats the files and is cached for
+        ALLOCATED_TTL; inventory() and the GC sweep refresh it as a side effect."""
+        cached = self.allocated
+        if cached is not None and time.monotonic() - cached[0] < self.ALLOCATED_TTL:
+            return cached[1]
+        total = 0
+        with os.scandir(OVERLAY_DIR) as it:
+            for entry in it:
+                if not entry.name.startswith(".") and entry.is_file():
+                    total += entry.stat().st_blocks * 512
+        self.allocated = (time.monotonic(), total)
+        return total
+
+    def gc(self, dry_run: bool = False) -> Dict[str, Any]:
+        """Deletes orphaned overlays, their sidecars and abandoned temp files."""
+        if not dry_run and not cluster.is_leader:
+            cluster.send("overlay_gc")
+            return {"removed": [], "freed_bytes": 0, "dry_run": False, "queued": True}
+        configured = self.configured()
+        live = self.live_paths()
+        now = time.time()
+        removed, freed = [], 0
+        for path in OVERLAY_DIR.iterdir():
+            try:
+                st = path.stat()
+            except OSError:
+                continue
+            name = path.name
+            if name.startswith("."):
+                if name.endswith(".creating") and now - st.st_mtime > self.TEMP_MAX_AGE:
+                    pass
+                elif name.endswith(".master.json") and not (OVERLAY_DIR / name[1:-len(".master.json")]).exists():
+                    pass
+                else:
+                    continue
+            elif (name in configured or str(path) in live or name in overlays.jobs
+                    or now - st.st_mtime < self.GC_GRACE):
+                continue
+            removed.append(name)
+            freed += st.st_blocks * 512
+            if not dry_run:
+                path.unlink(missing_ok=True)
+                if not name.startswith("."):
+                    overlay_master_file(path).unlink(missing_ok=True)
+        if removed and not dry_run:
+            self.allocated = None
+            OVERLAY_GC_REMOVED.inc(amount=len(removed))
+            logger.info(f"Overlay GC removed {len(removed)} files, {freed // (1024 * 1024)} MB freed")
+        return {"removed": removed, "freed_bytes": freed, "dry_run": dry_run}
+
+    def start(self):
+        if self.thread:
+            return
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._run_gc, name="overlay-gc", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join(timeout=5)
+        self.thread = None
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+    def _run_gc(self):
+        while True:
+            interval = int(get_config_snapshot().config.get("overlay_gc_interval", 3600))
+            if self.stop_event.wait(interval if interval > 0 else 60):
+                return
+            if interval > 0:
+                try:
+                    self.gc()
+                except Exception as e:
+                    logger.error(f"Overlay GC failed: {e}")
+
+    def schedule(self, client: Dict, operation: str) -> List[str]:
+        """Queues reset, commit or rebase for a client's overlay. Returns the affected MACs."""
+        if operation == "rebase":
+            # Rebasing onto the file the overlay already uses would change nothing, and recording
+            # the master afterwards would hide that the master's contents moved under the overlay
+            master_full = (VHD_DIR / client['image']).resolve()
+            header = read_qcow2_header(overlay_path_for(client['image'], client['mac'])) or {}
+            if header.get("backing_file") == str(master_full):
+                raise RuntimeError(f"Overlay for {client['mac']} is already backed by {client['image']}. "
+                                   f"Rebase re-points it at a different master file; if the master was "
+                                   f"changed in place, reset the overlay instead")
+        group = [client]
+        if operation == "commit":
+            # Every other overlay on this master is invalid once the master changes
+            group += [c for c in self.configured().values()
+                      if c['image'] == client['image'] and normalize_mac(c['mac']) != normalize_mac(client['mac'])]
+        if not cluster.is_leader:
+            busy = [c['mac'] for c in group if overlays.status(c['image'], c['mac'])["state"]
+                    in (OVERLAY_PENDING, OVERLAY_CREATING, OVERLAY_MAINTENANCE)]
+            if busy:
+                raise RuntimeError(f"Overlay busy for {', '.join(busy)}")
+            cluster.send("overlay_operation", mac=client['mac'], operation=operation)
+            return [c['mac'] for c in group]
+        with overlays.lock:
+            jobs = [overlays.job(c['image'], c['mac']) for c in group]
+            busy = [j["mac"] for j in jobs if j["state"] in (OVERLAY_PENDING, OVERLAY_CREATING, OVERLAY_MAINTENANCE)]
+            if busy:
+                raise RuntimeError(f"Overlay busy for {', '.join(busy)}")
+            for job in jobs:
+                overlays._set_state(job, OVERLAY_MAINTENANCE)
+                job["operation"] = operation
+        self._pool().submit(self._run, jobs, operation)
+        return [j["mac"] for j in jobs]
+
+    def _detach(self, iqns: List[str]):
+        """Re-syncs targets (maintenance overlays are left out) and checks they are really gone."""
+        with _TARGETS_LOCK:
+            _targets_dirty.clear()
+            refresh_root_caches()
+        live = targets.live or {}
+        connected = [iqn for iqn in iqns if iqn in live]
+        if connected:
+            raise RuntimeError(f"{', '.join(connected)} still has a connected initiator; disconnect it first")
+
+    def _run(self, jobs: List[Dict], operation: str):
+        golden = jobs[0]
+        path = overlay_path_for(golden["image"], golden["mac"])
+        master_full = (VHD_DIR / golden["image"]).resolve()
+        iqns = [overlay_iqn(j["mac"], j["image"]) for j in jobs]
+        error = None
+        try:
+            if operation == "commit":
+                self.maintenance_masters.add(golden["image"])
+                iqns.append(master_iqn(golden["image"]))
+            self._detach(iqns)
+            if operation == "reset":
+                path.unlink(missing_ok=True)
+                ensure_overlay(golden["image"], golden["mac"])
+            elif operation == "rebase":
+                # Safe rebase keeps the guest's view if the old backing file is still readable
+                _qemu_img("rebase", "-f", "qcow2", "-F", "raw", "-b", str(master_full), str(path))
+                record_overlay_master(path, master_full)
+            elif operation == "commit":
+                # Writes the golden client's changes into the master and empties its overlay
+                _qemu_img("commit", "-f", "qcow2", str(path))
+                record_overlay_master(path, master_full)
+                for job in jobs[1:]:
+                    overlay_path_for(job["image"], job["mac"]).unlink(missing_ok=True)
+                    ensure_overlay(job["image"], job["mac"])
+            logger.info(f"Overlay {operation} for {golden['mac']} done")
+        except Exception as e:
+            error = f"{operation} failed: {e}"
+            logger.error(f"Overlay {error} ({golden['mac']})")
+        finally:
+            self.maintenance_masters.discard(golden["image"])
+            with overlays.lock:
+                for job in jobs:
+                    exists = overlay_path_for(job["image"], job["mac"]).exists()
+                    overlays._set_state(job, OVERLAY_READY if exists else OVERLAY_FAILED, error)
+                    job["operation"] = None
+        request_targets_refresh()
+
+overlay_lifecycle = OverlayLifecycle()
+
+def master_iqn(vhd_path: str) -> str:
+    safe_name = vhd_path.lower().replace("/", "-").replace("\\", "-").replace("_", "-").replace(".", "-")
+    return f"iqn.2024-01.com.pxeserver:{safe_name}"
+
+def overlay_iqn(client_mac: str, image: str) -> str:
+    safe_mac = client_mac.replace(":", "").lower()
+    safe_image = image.lower().replace("/", "-").replace(".", "-")
+    return f"iqn.2024-01.com.pxeserver:{safe_mac}:{safe_image}"
+
 def generate_iscsi_config_full(vhds: List[Dict], clients: List[Dict], allowed_initiators="ALL"):
     """
     Generates TGTD config for:
     1. Generic Read-Only masters (for guests/installers)
     2. Client-specific Writeable Overlays
+    and applies the difference to the running tgtd.
     """
-    config_lines = []
+    initiators = tuple(allowed_initiators.replace(",", " ").split()) or ("ALL",)
+    desired = {}
     
     # 1. Generic Masters (Read-Only recommended, but currently R/W in legacy)
     # We will make them Read-Only by default if accessed generically to prevent corruption
     for vhd in vhds:
-        safe_name = vhd['path'].lower().replace("/", "-").replace("\\", "-").replace("_", "-").replace(".", "-")
-        iqn = f"iqn.2024-01.com.pxeserver:{safe_name}"
-        config_lines.append(f"<target {iqn}>")
-        config_lines.append(f"    backing-store {vhd['full_path']}")
-        config_lines.append(f"    initiator-address {allowed_initiators}")
-        # config_lines.append("    readonly 1") # Uncomment to enforce safety for generic
-        config_lines.append("</target>")
-
-    # 2. Client Overlays
+        if vhd['path'] in overlay_lifecycle.maintenance_masters:
+            continue # Being committed into; back once the commit is done
+        desired[master_iqn(vhd['path'])] = {"backing_store": vhd['full_path'], "initiators": initiators}
+
+    # 2. Client Overlays (only once provisioned; the ready callback adds the rest)
+    configured = set()
     for client in clients:
         if client.get('type') == 'vhd' and client.get('overlay'):
-            overlay_path = ensure_overlay(client['image'], client['mac'])
-            safe_mac = client['mac'].replace(":", "").lower()
-            safe_image = client['image'].lower().replace("/", "-").replace(".", "-")
-            iqn = f"iqn.2024-01.com.pxeserver:{safe_mac}:{safe_image}"
-            
+            configured.add(overlay_path_for(client['image'], client['mac']).name)
+            if overlays.submit(client['image'], client['mac']) != OVERLAY_READY:
+                continue
+            overlay_path = overlay_path_for(client['image'], client['mac'])
+            # Could restrict to client IP if known
+            desired[overlay_iqn(client['mac'], client['image'])] = {
+                "backing_store": str(overlay_path), "initiators": initiators}
+
+    overlays.forget(configured)
+    with TARGETS_SYNC_SECONDS.time():
+        diff = targets.sync(desired)
+    overlays.mark_exported(targets.serving)
+    return diff
+
+# --- iSCSI Target Sync ---
+# Rewriting targets.conf and reloading tgtd would drop every diskless session.
+# The manager keeps a model of what tgtd is serving and applies only the
+# targets that were added, removed or changed, one tgtadm call each.
+
+class TargetManager:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.live: Optional[Dict[str, Dict]] = None # iqn -> {"tid", "backing_store", "initiators"}
+        self.serving: set = set() # IQNs whose target is in place as desired after the last sync
+
+    @staticmethod
+    def render(desired: Dict[str, Dict]) -> str:
+        config_lines = []
+        for iqn, target in desired.items():
             config_lines.append(f"<target {iqn}>")
-            config_lines.append(f"    backing-store {overlay_path}")
-            config_lines.append(f"    initiator-address {allowed_initiators}") # Could restrict to client IP if known
+            config_lines.append(f"    backing-store {target['backing_store']}")
+            for address in target['initiators']:
+                config_lines.append(f"    initiator-address {address}")
+            # config_lines.append("    readonly 1") # Uncomment to enforce safety for generic masters
             config_lines.append("</target>")
+        return "\n".join(config_lines)
 
-    config_path = GENERATED_DIR / "targets.conf"
-    try:
-        with open(config_path, "w") as f:
-            f.write("\n".join(config_lines))
-        # Reload TGTD (Optional: might disrupt. Ideally use tgt-admin --update) 
-        # subprocess.run(["tgt-admin", "--update", "ALL"], check=False) 
-    except Exception as e:
-        logger.error(f"Failed to write iSCSI config: {e}")
+    def sync(self, desired: Dict[str, Dict]) -> Dict[str, List[str]]:
+        with self.lock:
+            try:
+                write_file_atomic(GENERATED_DIR / "targets.conf", self.render(desired))
+            except Exception as e:
+                logger.error(f"Failed to write iSCSI config: {e}")
+            if not get_config_snapshot().config.get("tgt_live_apply", True) or not shutil.which("tgtadm"):
+                self.serving = set(desired) # tgtd reads targets.conf itself; nothing to confirm
+                return {"added": [], "removed": [], "changed": []}
+            if self.live is None:
+                self.live = self._read_live()
+            diff = self._apply(desired)
+            self.serving = {iqn for iqn, target in desired.items()
+                            if self.live.get(iqn, {}).get("backing_store") == target["backing_store"]}
+            return diff
 
-# --- Caching ---
-ISO_CACHE, VHD_CACHE = [], []
+    def _tgtadm(self, *args) -> str:
+        result = subprocess.run(["tgtadm", "--lld", "iscsi", *args], check=True, capture_output=True, text=True)
+        return result.stdout
 
-def refresh_root_caches():
-    global ISO_CACHE, VHD_CACHE
-    isos, _ = get_directory_contents(ISO_DIR)
-    ISO_CACHE = [f for f in isos if f['name'].endswith('.iso')]
-    vhds, _ = get_directory_contents(VHD_DIR)
-    VHD_CACHE = [f for f in vhds if any(f['name'].endswith(ext) for ext in [".vhd", ".qcow2", ".img"])]
-    
-    # Trigger iSCSI config update based on current config + new files
-    config = load_config()
-    # Need to augment VHD_CACHE with full paths for generator
-    vhd_list = []
-    for f in VHD_CACHE:
-         vhd_list.append({
-             "path": f['path'],
-             "full_path": str((VHD_DIR / f['path']).absolute())
-         })
-    generate_iscsi_config_full(vhd_list, config.get('clients', []), config.get("iscsi_allowed_initiators", "ALL"))
+    def _read_live(self) -> Dict[str, Dict]:
+        """Parses 'tgtadm --op show' so a restarted brain adopts existing targets."""
+        live, target, in_acl = {}, None, False
+        try:
+            output = self._tgtadm("--mode", "target", "--op", "show")
+        except (OSError, subprocess.CalledProcessError) as e:
+            logger.error(f"Failed to read tgtd state: {e}")
+            return live
+        for line in output.splitlines():
+            stripped = line.strip()
+            if line.startswith("Target "):
+                tid, iqn = line[len("Target "):].split(":", 1)
+                target = {"tid": int(tid), "backing_store": None, "initiators": ()}
+                live[iqn.strip()] = target
+                in_acl = False
+            elif target is None:
+                continue
+            elif stripped.startswith("Backing store path:"):
+                path = stripped.split(":", 1)[1].strip()
+                if path != "None":
+                    target["backing_store"] = path
+            elif stripped == "ACL information:":
+                in_acl = True
+            elif in_acl and stripped and not stripped.endswith(":"):
+                target["initiators"] += (stripped,)
+            elif stripped.endswith(":"):
+                in_acl = False
+        return live
 
-@app.on_event("startup")
-async def startup_event():
-    refresh_root_caches()
+    def sessions(self) -> List[Dict[str, Any]]:
+        """Logged-in initiators per target, parsed from the same 'tgtadm --op show'."""
+        output = self._tgtadm("--mode", "target", "--op", "show")
+        owners = {overlay_iqn(c['mac'], c['image']): c for c in get_config_snapshot().config.get("clients", [])
+                  if c.get('type') == 'vhd'}
+        sessions, iqn, session, in_nexus = [], None, None, False
+        for line in output.splitlines():
+            stripped = line.strip()
+            indent = len(line) - len(line.lstrip())
+            if line.startswith("Target "):
+                iqn = line[len("Target "):].split(":", 1)[1].strip()
+                session, in_nexus = None, False
+            elif indent == 4: # Section headers: System, I_T nexus, LUN, Account, ACL
+                session, in_nexus = None, stripped == "I_T nexus information:"
+            elif not in_nexus:
+                continue
+            elif stripped.startswith("I_T nexus:"):
+                owner = owners.get(iqn)
+                session = {"type": "iscsi", "target": iqn, "initiator": None, "client": None,
+                           "mac": owner['mac'] if owner else None,
+                           "hostname": owner.get('hostname') if owner else None}
+                sessions.append(session)
+            elif session is None:
+                continue
+            elif stripped.startswith("Initiator:"):
+                session["initiator"] = stripped.split(":", 1)[1].split(" alias:")[0].strip()
+            elif stripped.startswith("IP Address:") and session["client"] is None:
+                session["client"] = stripped.split(":", 1)[1].strip() # First connection's address
+        for session in sessions:
+            session["client"] = session["client"] or session["initiator"]
+        return sessions
 
-# --- API Endpoints ---
+    def _apply(self, desired: Dict[str, Dict]) -> Dict[str, List[str]]:
+        diff = {"added": [], "removed": [], "changed": []}
+        for iqn in [i for i in self.live if i not in desired]:
+            tid = str(self.live[iqn]["tid"])
+            try:
+                # Not forced: a target with a logged-in initiator stays until it disconnects
+                self._tgtadm("--mode", "target", "--op", "delete", "--tid", tid)
+            except subprocess.CalledProcessError as e:
+                logger.warning(f"Deferring removal of {iqn}: {e.stderr.strip()}")
+                continue
+            del self.live[iqn]
+            diff["removed"].append(iqn)
 
-@app.get("/")
-async def read_root(username: str = Depends(get_current_username)):
-    return FileResponse(STATIC_DIR / "index.html")
+        for iqn, target in desired.items():
+            current = self.live.get(iqn)
+            try:
+                if current is None:
+                    tid = max((t["tid"] for t in self.live.values()), default=0) + 1
+                    self._tgtadm("--mode", "target", "--op", "new", "--tid", str(tid), "-T", iqn)
+                    self.live[iqn] = current = {"tid": tid, "backing_store": None, "initiators": ()}
+                    diff["added"].append(iqn)
+                elif (current["backing_store"], tuple(current["initiators"])) != (target["backing_store"], target["initiators"]):
+                    diff["changed"].append(iqn)
+                else:
+                    continue
+                tid = str(current["tid"])
+                if current["backing_store"] != target["backing_store"]:
+                    if current["backing_store"] is not None:
+                        self._tgtadm("--mode", "logicalunit", "--op", "delete", "--tid", tid, "--lun", "1")
+                    self._tgtadm("--mode", "logicalunit", "--op", "new", "--tid", tid, "--lun", "1",
+                                 "-b", target["backing_store"])
+                    current["backing_store"] = target["backing_store"]
+                for address in set(current["initiators"]) - set(target["initiators"]):
+                    self._tgtadm("--mode", "target", "--op", "unbind", "--tid", tid, "-I", address)
+                for address in set(target["initiators"]) - set(current["initiators"]):
+                    self._tgtadm("--mode", "target", "--op", "bind", "--tid", tid, "-I", address)
+                current["initiators"] = target["initiators"]
+            except subprocess.CalledProcessError as e:
+                logger.error(f"Failed to apply target {iqn}: {e.stderr.strip()}")
 
-@app.get("/api/config")
-async def get_config(username: str = Depends(get_current_username)):
-    config = load_config()
-    licenser.status = licenser._refresh_status()
-    config["license_status"] = licenser.status
-    config["hardware_id"] = licenser.machine_id
-    return config
+        if any(diff.values()):
+            logger.info(f"iSCSI targets: +{len(diff['added'])} -{len(diff['removed'])} ~{len(diff['changed'])}")
+            events.emit("targets", **diff)
+        return diff
 
-@app.post("/api/config")
-async def update_config(config: ConfigModel, username: str = Depends(get_current_username)):
-    save_config(config.dict())
-    refresh_root_caches() # Re-generate iSCSI targets
-    return {"status": "success", "config": config}
+targets = TargetManager()
 
-@app.get("/api/assets")
-async def get_assets(username: str = Depends(get_current_username), path: str = "", type: str = "root"):
-    iso_files, iso_dirs = [], []
-    vhd_files, vhd_dirs = [], []
-    if type == "root" or type == "iso":
-        iso_files, iso_dirs = get_directory_contents(ISO_DIR, path)
-    if type == "root" or type == "vhd":
-        vhd_files, vhd_dirs = get_directory_contents(VHD_DIR, path)
-    
-    injections, _ = get_directory_contents(INJECTION_DIR)
-    
-    return {
-        "isos": iso_files, "iso_dirs": iso_dirs,
-        "vhds": vhd_files, "vhd_dirs": vhd_dirs,
-        "injections": injections,
-        "current_path": path
-    }
+# --- ISO Analysis ---
+# memdisk pulls the whole ISO into client RAM before anything starts. For
+# distros we recognise, the kernel and initrd are read straight out of the
+# ISO9660 image (no loop mounts) into a content-addressed cache that nginx
+# serves under /storage/cache/iso/<key>/, and scripts boot them directly.
 
-@app.post("/api/upload_injection")
-async def upload_injection(file: UploadFile = File(...), username: str = Depends(get_current_username)):
-    file_path = INJECTION_DIR / file.filename
-    try:
-        with open(file_path, "wb") as f:
-            shutil.copyfileobj(file.file, f)
-    except Exception as e:
-        return {"status": "error", "message": str(e)}
-    return {"status": "success", "filename": file.filename}
+ISO_SECTOR = 2048
+ISO_CACHE_DIR = STORAGE_ROOT / "cache" / "iso"
 
-# --- Boot Logic (Next-Gen) ---
+class DiscReader:
+    """
+    Shared plumbing for the ISO9660 and UDF readers. Nodes are
+    (name, is_dir, extents) where extents is a list of (sector, size), or
+    (None, data) for file data embedded in UDF metadata.
+    """
 
-@app.get("/boot.ipxe", response_class=PlainTextResponse)
-async def get_menu(request: Request, path: str = "", type: str = "root", mac: Optional[str] = None):
+    def __init__(self, path: Path):
+        self.f = open(path, "rb")
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _read(self, sector: int, length: int) -> bytes:
+        self.f.seek(sector * ISO_SECTOR)
+        return self.f.read(length)
+
+    def file_size(self, node: tuple) -> int:
+        return sum(size if sector is not None else len(size) for sector, size in node[2])
+
+    def copy_file(self, node: tuple, dest: Path):
+        with open(dest, "wb") as out:
+            for sector, size in node[2]:
+                if sector is None:
+                    out.write(size)
+                    continue
+                self.f.seek(sector * ISO_SECTOR)
+                remaining = size
+                while remaining:
+                    chunk = self.f.read(min(remaining, 1024 * 1024))
+                    if not chunk:
+                        raise ValueError("Truncated disc image")
+                    out.write(chunk)
+                    remaining -= len(chunk)
+
+class IsoReader(DiscReader):
+    """Minimal read-only ISO9660 reader with Rock Ridge / Joliet names and El Torito."""
+
+    def __init__(self, path: Path):
+        super().__init__(path)
+        self.volume_id = ""
+        self.boot_catalog = None
+        self.rock_ridge = False
+        root = joliet_root = None
+        for sector in range(16, 64):
+            vd = self._read(sector, ISO_SECTOR)
+            if vd[1:6] != b"CD001":
+                break
+            if vd[0] == 255:
+                break
+            if vd[0] == 0 and vd[7:30] == b"EL TORITO SPECIFICATION":
+                self.boot_catalog = struct.unpack_from("<I", vd, 71)[0]
+            elif vd[0] == 1 and root is None:
+                self.volume_id = vd[40:72].decode("ascii", "replace").strip()
+                root = self._record_extent(vd[156:190])
+            elif vd[0] == 2 and vd[88:91] in (b"%/@", b"%/C", b"%/E"):
+                joliet_root = self._record_extent(vd[156:190])
+        if root is None:
+            self.f.close()
+            raise ValueError("Not an ISO9660 image")
+        # Rock Ridge images announce SUSP with an 'SP' entry in the root's '.' record
+        first = self._read(root[0], ISO_SECTOR)
+        self.rock_ridge = first[34:36] == b"SP"
+        self.joliet = joliet_root is not None and not self.rock_ridge
+        self.root = joliet_root if self.joliet else root
+        self._dirs: Dict[tuple, Dict[str, tuple]] = {}
+
+    @staticmethod
+    def _record_extent(record: bytes) -> tuple:
+        return struct.unpack_from("<I", record, 2)[0], struct.unpack_from("<I", record, 10)[0]
+
+    def _record_name(self, record: bytes) -> str:
+        name_len = record[32]
+        raw = record[33:33 + name_len]
+        if self.rock_ridge:
+            su = record[33 + name_len + (1 - name_len % 2):]
+            name, i = b"", 0
+            while i + 4 <= len(su):
+                sig, length = su[i:i + 2], su[i + 2]
+                if length < 4:
+                    break
+                if sig == b"NM":
+                    name += su[i + 5:i + length]
+                i += length
+            if name:
+                return name.decode("utf-8", "replace")
+        name = raw.decode("utf-16-be", "replace") if self.joliet else raw.decode("ascii", "replace")
+        return name.split(";")[0].rstrip(".")
+
+    def listdir(self, extent: tuple) -> Dict[str, tuple]:
+        """Maps lowercase name -> (name, is_dir, [(sector, size), ...]) for one directory."""
+        cached = self._dirs.get(extent)
+        if cached is not None:
+            return cached
+        entries: Dict[str, tuple] = {}
+        data = self._read(*extent)
+        i, pending = 0, None
+        while i < len(data):
+            length = data[i]
+            if length == 0:
+                i = (i // ISO_SECTOR + 1) * ISO_SECTOR # Records never straddle sectors
+                continue
+            record = data[i:i + length]
+            i += length
+            if record[32] == 1 and record[33] in (0, 1):
+                continue # '.' and '..'
+            flags = record[25]
+            chunk = self._record_extent(record)
+            if pending is not None:
+                pending[2].append(chunk) # Multi-extent file (> 4 GiB) continuation
+            else:
+                pending = (self._record_name(record), bool(flags & 0x02), [chunk])
+            if not flags & 0x80:
+                entries[pending[0].lower()] = pending
+                pending = None
+        self._dirs[extent] = entries
+        return entries
+
+    def find(self, path: str) -> Optional[tuple]:
+        """Case-insensitive lookup of a '/'-separated path."""
+        node = ("", True, [self.root])
+        for part in [p for p in path.lower().split("/") if p]:
+            if not node[1]:
+                return None
+            node = self.listdir(node[2][0]).get(part)
+            if node is None:
+                return None
+        return node
+
+    def boot_platforms(self) -> List[str]:
+        """El Torito platforms with a boot entry, e.g. ['bios', 'efi']."""
+        if self.boot_catalog is None:
+            return []
+        catalog = self._read(self.boot_catalog, ISO_SECTOR)
+        names = {0x00: "bios", 0xEF: "efi"}
+        platforms = []
+        if catalog[0] == 0x01 and catalog[32] == 0x88:
+            platforms.append(names.get(catalog[1], hex(catalog[1])))
+        offset = 64
+        while offset + 32 <= len(catalog) and catalog[offset] in (0x90, 0x91):
+            platform_id = catalog[offset + 1]
+            count = struct.unpack_from("<H", catalog, offset + 2)[0]
+            name = names.get(platform_id, hex(platform_id))
+            if name not in platforms:
+                platforms.append(name)
+            if catalog[offset] == 0x91:
+                break
+            offset += 32 * (count + 1)
+        return platforms
+
+class UdfReader(DiscReader):
+    """
+    Minimal read-only UDF reader. Windows installer ISOs keep their real
+    content in UDF; the ISO9660 side only holds a README.
+    """
+
+    def __init__(self, path: Path):
+        super().__init__(path)
+        anchor = self._read(256, ISO_SECTOR)
+        if struct.unpack_from("<H", anchor, 0)[0] != 2:
+            self.close()
+            raise ValueError("No UDF anchor volume descriptor")
+        vds_length, vds_sector = struct.unpack_from("<II", anchor, 16)
+        self.partition_start = None
+        fsd = None
+        for sector in range(vds_sector, vds_sector + max(1, vds_length // ISO_SECTOR)):
+            desc = self._read(sector, ISO_SECTOR)
+            tag = struct.unpack_from("<H", desc, 0)[0]
+            if tag == 5 and self.partition_start is None: # Partition Descriptor
+                self.partition_start = struct.unpack_from("<I", desc, 188)[0]
+            elif tag == 6: # Logical Volume Descriptor: long_ad of the File Set Descriptor
+                fsd = struct.unpack_from("<I", desc, 248 + 4)[0]
+            elif tag == 8: # Terminating Descriptor
+                break
+        if self.partition_start is None or fsd is None:
+            self.close()
+            raise ValueError("Incomplete UDF volume descriptor sequence")
+        fsd_block = self._read(self.partition_start + fsd, ISO_SECTOR)
+        root_icb = struct.unpack_from("<I", fsd_block, 400 + 4)[0]
+        self.root = ("", True, root_icb)
+
+    def _entry(self, icb: int) -> tuple:
+        """Reads a (Extended) File Entry; returns (is_dir, extents)."""
+        fe = self._read(self.partition_start + icb, ISO_SECTOR)
+        tag = struct.unpack_from("<H", fe, 0)[0]
+        if tag == 261:
+            l_ea, l_ad = struct.unpack_from("<II", fe, 168)
+            ad_offset = 176 + l_ea
+        elif tag == 266:
+            l_ea, l_ad = struct.unpack_from("<II", fe, 208)
+            ad_offset = 216 + l_ea
+        else:
+            raise ValueError(f"Unexpected UDF descriptor {tag} at block {icb}")
+        is_dir = fe[16 + 11] == 4 # ICB tag file type
+        ad_type = struct.unpack_from("<H", fe, 16 + 18)[0] & 7
+        ads = fe[ad_offset:ad_offset + l_ad]
+        if ad_type == 3:
+            return is_dir, [(None, bytes(ads))]
+        size = 8 if ad_type == 0 else 16
+        extents = []
+        for i in range(0, len(ads) - size + 1, size):
+            length, block = struct.unpack_from("<II", ads, i)
+            if length >> 30 == 3:
+                raise ValueError("Chained UDF allocation descriptors are not supported")
+            if length & 0x3FFFFFFF:
+                extents.append((self.partition_start + block, length & 0x3FFFFFFF))
+        return is_dir, extents
+
+    def _children(self, extents: list) -> Dict[str, tuple]:
+        data = b"".join(size if sector is None else self._read(sector, size) for sector, size in extents)
+        children, i = {}, 0
+        while i + 38 <= len(data):
+            if struct.unpack_from("<H", data, i)[0] != 257: # File Identifier Descriptor
+                break
+            characteristics, l_fi = data[i + 18], data[i + 19]
+            icb = struct.unpack_from("<I", data, i + 20 + 4)[0]
+            l_iu = struct.unpack_from("<H", data, i + 36)[0]
+            raw = data[i + 38 + l_iu:i + 38 + l_iu + l_fi]
+            i += (38 + l_iu + l_fi + 3) & ~3
+            if characteristics & 0x0C or not raw: # Deleted or parent entry
+                continue
+            name = raw[1:].decode("utf-16-be" if raw[0] == 16 else "latin-1", "replace")
+            children[name.lower()] = (name, icb)
+        return children
+
+    def find(self, path: str) -> Optional[tuple]:
+        """Case-insensitive lookup of a '/'-separated path."""
+        name, icb = "", self.root[2]
+        is_dir, extents = self._entry(icb)
+        for part in [p for p in path.lower().split("/") if p]:
+            if not is_dir:
+                return None
+            child = self._children(extents).get(part)
+            if child is None:
+                return None
+            name, icb = child
+            is_dir, extents = self._entry(icb)
+        return (name, is_dir, extents)
+
+# First match wins. Paths are relative to the ISO root; {iso_url} is the
+# ISO over HTTP and {cache_url} the extraction directory (same layout as the ISO).
+LINUX_BOOT_PROFILES = [
+    # casper can only fetch the whole ISO (url=), and recent releases split the
+    # root into layered squashfs files: the transfer is memdisk's, but it starts
+    # from the real kernel with the ISO on a ramdisk it manages itself
+    {"name": "ubuntu-casper", "kernel": ["casper/vmlinuz", "casper/hwe-vmlinuz"],
+     "initrd": ["casper/initrd", "casper/initrd.gz", "casper/initrd.lz", "casper/hwe-initrd"],
+     "args": "boot=casper ip=dhcp url={iso_url}"},
+    {"name": "fedora-installer", "kernel": ["images/pxeboot/vmlinuz"], "initrd": ["images/pxeboot/initrd.img"],
+     "requires": ["images/install.img"], "extra": ["images/install.img", ".treeinfo"],
+     "args": "ip=dhcp inst.stage2={cache_url}"},
+    {"name": "fedora-live", "kernel": ["images/pxeboot/vmlinuz", "isolinux/vmlinuz"],
+     "initrd": ["images/pxeboot/initrd.img", "isolinux/initrd.img"], "requires": ["LiveOS/squashfs.img"],
+     "extra": ["LiveOS/squashfs.img"],
+     "args": "ip=dhcp rd.live.image root=live:{cache_url}/LiveOS/squashfs.img"},
+    {"name": "debian-live", "kernel": ["live/vmlinuz"], "initrd": ["live/initrd.img"],
+     "extra": ["live/filesystem.squashfs"],
+     "args": "boot=live components ip=dhcp fetch={cache_url}/live/filesystem.squashfs"},
+    {"name": "archlinux", "kernel": ["arch/boot/x86_64/vmlinuz-linux"],
+     "initrd": ["arch/boot/x86_64/initramfs-linux.img"], "extra": ["arch/x86_64/airootfs.sfs"],
+     "args": "archisobasedir=arch archiso_http_srv={cache_url}/ ip=dhcp"},
+]
+
+# wimboot file name -> candidate paths on the media, and whether booting needs it
+WINDOWS_BOOT_FILES = [
+    ("bootmgr", ["bootmgr"], False),
+    ("bootx64.efi", ["efi/boot/bootx64.efi"], False),
+    ("BCD", ["boot/bcd"], True),
+    ("boot.sdi", ["boot/boot.sdi"], True),
+    ("boot.wim", ["sources/boot.wim"], True),
+]
+
+# Injected next to unattend.xml so WinPE starts Setup with it
+WINPESHL_UNATTEND = """[LaunchApps]
+"%SYSTEMDRIVE%\\setup.exe", "/unattend:%SYSTEMROOT%\\System32\\unattend.xml"
+"""
+
+def detect_windows_profile(reader: DiscReader) -> Optional[Dict[str, Any]]:
+    wimboot_files = []
+    for name, candidates, required in WINDOWS_BOOT_FILES:
+        rel = next((p for p in candidates if reader.find(p)), None)
+        if rel is None:
+            if required:
+                return None
+            continue
+        wimboot_files.append([name, rel])
+    return {"profile": "windows", "wimboot_files": wimboot_files, "files": [rel for _, rel in wimboot_files]}
+
+def iso_fingerprint(path: Path) -> str:
+    """Content key from the size and volume descriptor area (creation stamps, volume id)."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        digest.update(str(os.fstat(f.fileno()).st_size).encode())
+        f.seek(16 * ISO_SECTOR)
+        digest.update(f.read(32 * ISO_SECTOR))
+    return digest.hexdigest()[:24]
+
+def detect_linux_profile(reader: IsoReader) -> Optional[Dict[str, Any]]:
+    for profile in LINUX_BOOT_PROFILES:
+        if not all(reader.find(p) for p in profile.get("requires", [])):
+            continue
+        kernel = next((p for p in profile["kernel"] if reader.find(p)), None)
+        initrd = next((p for p in profile["initrd"] if reader.find(p)), None)
+        if kernel and initrd:
+            return {"profile": profile["name"], "kernel": kernel, "initrd": initrd,
+                    "args": profile["args"], "files": [kernel, initrd] + profile.get("extra", [])}
+    return None
+
+class IsoBootCache:
+    """Analyses ISOs in the background and remembers how each one can be booted."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.manifests: Dict[tuple, Dict[str, Any]] = {} # (path, size, mtime_ns) -> manifest
+        self.pending = set()
+        self.executor = None
+        self.version = 0 # Bumped whenever a manifest appears
+
+    def lookup(self, iso_path: str, stamp: tuple, analyse: bool = True) -> Optional[Dict[str, Any]]:
+        """
+        Returns the boot manifest if known. Otherwise, if analyse is set (an
+        actual boot, not a menu listing), queues analysis; returns None.
+        """
+        if not get_config_snapshot().config.get("iso_kernel_boot", True):
+            return None # Also for manifests we already have: the toggle takes effect at once
+        key = (iso_path, *stamp)
+        manifest = self.manifests.get(key)
+        if manifest is not None or not analyse:
+            return manifest
+        with self.lock:
+            if key in self.pending:
+                return None
+            self.pending.add(key)
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="iso-extract")
+        self.executor.submit(self._analyse, key)
+        return None
+
+    def _analyse(self, key: tuple):
+        iso_path = key[0]
+        full_path = ISO_DIR / iso_path
+        try:
+            manifest = self._load_or_extract(full_path)
+        except Exception as e:
+            logger.warning(f"ISO analysis failed for {iso_path}: {e}")
+            manifest = {"profile": None, "error": str(e)}
+        with self.lock:
+            self.pending.discard(key)
+            self.manifests[key] = manifest
+            self.version += 1
+
+    def _load_or_extract(self, full_path: Path) -> Dict[str, Any]:
+        fingerprint = iso_fingerprint(full_path)
+        cache_dir = ISO_CACHE_DIR / fingerprint
+        manifest_file = cache_dir / "manifest.json"
+        if manifest_file.exists():
+            return json.loads(manifest_file.read_text())
+        # Every worker and node may be asked to boot the same new ISO at once. One
+        # extracts under the lock; the others wait and then read its manifest.
+        ISO_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        with open(ISO_CACHE_DIR / f".{fingerprint}.lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if manifest_file.exists():
+                return json.loads(manifest_file.read_text())
+            return self._extract(full_path, fingerprint, cache_dir)
+
+    def _extract(self, full_path: Path, fingerprint: str, cache_dir: Path) -> Dict[str, Any]:
+        manifest = {"fingerprint": fingerprint, "volume_id": "", "boot_platforms": [], "profile": None}
+        tmp_dir = ISO_CACHE_DIR / f".{fingerprint}.{os.getpid()}.tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        tmp_dir.mkdir(parents=True)
+        try:
+            # Windows media only expose their boot files through UDF
+            for reader_class in (IsoReader, UdfReader):
+                try:
+                    reader = reader_class(full_path)
+                except ValueError:
+                    continue
+                with reader:
+                    if isinstance(reader, IsoReader):
+                        manifest["volume_id"] = reader.volume_id
+                        manifest["boot_platforms"] = reader.boot_platforms()
+                    detected = detect_linux_profile(reader) or detect_windows_profile(reader)
+                    if not detected:
+                        continue
+                    started = time.time()
+                    for rel in detected["files"]:
+                        node = reader.find(rel)
+                        if node is None:
+                            continue
+                        dest = tmp_dir / rel
+                        dest.parent.mkdir(parents=True, exist_ok=True)
+                        reader.copy_file(node, dest)
+                    if detected["profile"] == "windows":
+                        (tmp_dir / "winpeshl.ini").write_text(WINPESHL_UNATTEND)
+                    manifest.update(detected)
+                    logger.info(f"Extracted {detected['profile']} boot files from {full_path.name} "
+                                f"in {time.time() - started:.1f}s")
+                    break
+            (tmp_dir / "manifest.json").write_text(json.dumps(manifest, indent=4))
+            shutil.rmtree(cache_dir, ignore_errors=True) # A crashed extraction's leftovers, if any
+            os.replace(tmp_dir, cache_dir)
+        except Exception:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+        return manifest
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+iso_boot = IsoBootCache()
+
+def iso_boot_lines(server_ip: str, iso_path: str, stamp: Optional[tuple], label: str, extra_args: str = "",
+                   unattend_url: Optional[str] = None, release: List[str] = (), analyse: bool = True) -> List[str]:
+    """
+    iPXE lines that boot an ISO: wimboot or direct kernel/initrd when a
+    profile matched, memdisk otherwise (and as the fallback if those fail).
+    release lines run once the downloads are done, right before booting
+    (memdisk and wimboot only; Linux profiles keep downloading after 'boot').
+    Menus pass analyse=False: an ISO nobody analysed yet chains to
+    /boot/iso.ipxe, so only a client actually booting it queues extraction.
+    """
+    iso_url = f"http://{server_ip}/storage/isos/{iso_path}"
+    memdisk = [f"initrd {iso_url}", *release, f"chain http://{server_ip}/tftpboot/memdisk iso raw"]
+    if stamp is None or not get_config_snapshot().config.get("iso_kernel_boot", True):
+        return memdisk
+    manifest = iso_boot.lookup(iso_path, stamp, analyse)
+    if manifest is None and not analyse:
+        return [f"chain http://{server_ip}:8000/boot/iso.ipxe?path={quote(iso_path)}"]
+    if not manifest or not manifest.get("profile"):
+        return memdisk
+    cache_url = f"http://{server_ip}/storage/cache/iso/{manifest['fingerprint']}"
+    if manifest["profile"] == "windows":
+        lines = [f"kernel http://{server_ip}/tftpboot/wimboot || goto {label}_memdisk"]
+        for name, rel in manifest["wimboot_files"]:
+            lines.append(f"initrd -n {name} {cache_url}/{rel} || goto {label}_memdisk")
+        if unattend_url:
+            lines.append(f"initrd -n unattend.xml {unattend_url} || goto {label}_memdisk")
+            lines.append(f"initrd -n winpeshl.ini {cache_url}/winpeshl.ini || goto {label}_memdisk")
+        return lines + [*release, f"boot || goto {label}_memdisk", f":{label}_memdisk"] + memdisk
+    args = manifest["args"].format(iso_url=iso_url, cache_url=cache_url)
+    if extra_args:
+        args = f"{args} {extra_args.strip()}"
+    # No release here: every Linux profile pulls its root filesystem once the kernel
+    # runs (url=, root=live:, fetch=, inst.stage2=, archiso_http_srv=), so the heavy
+    # part of the boot starts after 'boot' and the slot is held until the lease ends
+    return [
+        f"kernel {cache_url}/{manifest['kernel']} initrd=initrd {args} || goto {label}_memdisk",
+        f"initrd --name initrd {cache_url}/{manifest['initrd']} || goto {label}_memdisk",
+        f"boot || goto {label}_memdisk",
+        f":{label}_memdisk",
+    ] + memdisk
+
+def iso_stamp(iso_path: str) -> Optional[tuple]:
+    """(size, mtime_ns) of an ISO from the asset index (no extra stat on the hot path)."""
+    files, _ = get_directory_contents(ISO_DIR, os.path.dirname(iso_path))
+    name = os.path.basename(iso_path)
+    return next(((f['size'], f['mtime']) for f in files if f['name'] == name), None)
+
+# --- Image Metadata Index ---
+# Checksums, formats, virtual sizes and detected OSes for every image, kept in
+# SQLite next to the ISO cache so /api/assets can return them without touching
+# the images. Rows carry (inode, size, mtime) and are only trusted while the
+# file still matches; a rename keeps its row. The leader walks storage in the
+# background and hands new or changed images to a process pool, which reads
+# each one once, sequentially, at idle I/O priority and around the page cache,
+# so the pages booting clients are using stay where they are. Images that fail
+# are retried with a growing backoff rather than on every walk.
+
+IMAGE_INDEX_DB = STORAGE_ROOT / "cache" / "images.db"
+IMAGE_READ_CHUNK = 8 * 1024 * 1024
+IMAGE_HASHED_BYTES = Counter("pxe_image_index_hashed_bytes_total", "Image bytes read by the metadata indexer.")
+Gauge("pxe_image_index_pending", "Images queued for metadata indexing.",
+      collect=lambda: {(): len(image_index.pending)})
+
+# ioprio_set(2) has no libc wrapper; syscall numbers for the common targets
+IOPRIO_SET_SYSCALL = {"x86_64": 251, "aarch64": 30, "i686": 289, "armv7l": 314}
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_IDLE = 3
+
+def _image_worker_init():
+    os.nice(10) # Boots and API requests come first
+    # The idle class only gets the disk when nobody else wants it. Schedulers that
+    # ignore it (mq-deadline, none) are covered by image_index_read_mbps instead
+    number = IOPRIO_SET_SYSCALL.get(platform.machine())
+    if number is not None:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        if libc.syscall(number, IOPRIO_WHO_PROCESS, 0, IOPRIO_CLASS_IDLE << 13) != 0:
+            logger.debug(f"ioprio_set failed: {os.strerror(ctypes.get_errno())}")
+
+def _read_image_chunks(full_path: str, buffer: mmap.mmap, read_mbps: int = 0):
+    """
+    Yields successive chunks of the file as memoryviews over buffer, without
+    leaving them in the page cache. O_DIRECT bypasses the cache entirely; where
+    it is refused (tmpfs, some FUSE mounts) reads are buffered, each chunk is
+    first probed with RWF_NOWAIT, and only the part that was not already
+    resident is dropped afterwards.
+    """
+    view = memoryview(buffer)
+    fd, direct = None, hasattr(os, "O_DIRECT")
+    if direct:
+        try:
+            fd = os.open(full_path, os.O_RDONLY | os.O_DIRECT)
+            os.preadv(fd, [buffer], 0) # Some filesystems accept the flag but refuse the read
+        except OSError as e:
+            if e.errno != errno.EINVAL:
+                raise
+            if fd is not None:
+                os.close(fd)
+            fd, direct = None, False
+    if fd is None:
+        fd = os.open(full_path, os.O_RDONLY)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_RANDOM) # No read-ahead past what we probed
+    try:
+        started, offset = time.monotonic(), 0
+        while True:
+            resident = 0
+            if direct:
+                n = os.preadv(fd, [buffer], offset)
+            else:
+                try:
+                    resident = os.preadv(fd, [buffer], offset, os.RWF_NOWAIT)
+                except OSError:
+                    pass # EAGAIN: nothing cached here; EOPNOTSUPP: can't tell, so treat as cold
+                n = resident
+                if resident < len(buffer):
+                    n += os.preadv(fd, [view[resident:]], offset + resident)
+            yield view[:n]
+            if not direct and n > resident:
+                os.posix_fadvise(fd, offset + resident, n - resident, os.POSIX_FADV_DONTNEED)
+            offset += n
+            if n < len(buffer):
+                return # Short read: end of file (and O_DIRECT must not read from an unaligned offset)
+            if read_mbps > 0:
+                ahead = offset / (read_mbps * 1024 * 1024) - (time.monotonic() - started)
+                if ahead > 0:
+                    time.sleep(ahead)
+    finally:
+        os.close(fd)
+
+def _disk_layout(head: bytes) -> Optional[str]:
+    if head[512:520] == b"EFI PART":
+        return "gpt"
+    if head[510:512] == b"\x55\xaa":
+        return "mbr"
+    return None
+
+def analyse_image(full_path: str, kind: str, read_mbps: int = 0) -> Dict[str, Any]:
+    """Runs in a worker process: SHA-256 of the whole image plus what its headers reveal."""
+    path = Path(full_path)
+    before = os.stat(full_path)
+    meta = {"sha256": None, "format": "raw", "virtual_size": before.st_size, "os": None, "volume_id": None,
+            "boot_platforms": [], "hybrid": False, "layout": None, "backing_file": None, "error": None}
+    digest = hashlib.sha256()
+    head, tail = None, b""
+    buffer = mmap.mmap(-1, IMAGE_READ_CHUNK) # Page-aligned, as O_DIRECT needs
+    for chunk in _read_image_chunks(full_path, buffer, read_mbps):
+        if head is None:
+            head = bytes(chunk[:64 * 1024])
+        digest.update(chunk)
+        tail = (tail + bytes(chunk[-512:]))[-512:]
+    head = head or b""
+    footer = tail if before.st_size >= 512 else b""
+    meta["sha256"] = digest.hexdigest()
+
+    qcow2 = read_qcow2_header(path)
+    if qcow2:
+        meta.update(format="qcow2", virtual_size=qcow2["virtual_size"], backing_file=qcow2["backing_file"])
+    elif footer[:8] == b"conectix" or head[:8] == b"conectix":
+        vhd = footer if footer[:8] == b"conectix" else head
+        disk_type = struct.unpack_from(">I", vhd, 60)[0]
+        meta.update(format={2: "vhd-fixed", 3: "vhd-dynamic", 4: "vhd-differencing"}.get(disk_type, "vhd"),
+                    virtual_size=struct.unpack_from(">Q", vhd, 48)[0])
+    elif kind == "iso":
+        meta["hybrid"] = _disk_layout(head) is not None # isohybrid images also carry a partition table
+        for reader_class in (IsoReader, UdfReader):
+            try:
+                reader = reader_class(path)
+            except ValueError:
+                continue
+            with reader:
+                if isinstance(reader, IsoReader):
+                    meta.update(format="iso9660", volume_id=reader.volume_id,
+                                boot_platforms=reader.boot_platforms())
+                    volume_bytes = struct.unpack_from("<I", reader._read(16, ISO_SECTOR), 80)[0] * ISO_SECTOR
+                    if volume_bytes > before.st_size:
+                        meta["error"] = f"Truncated: volume is {volume_bytes} bytes, file is {before.st_size}"
+                elif meta["format"] == "raw":
+                    meta["format"] = "udf"
+                detected = detect_linux_profile(reader) if isinstance(reader, IsoReader) else None
+                detected = detected or detect_windows_profile(reader)
+                if detected:
+                    meta["os"] = detected["profile"]
+                    break
+        if meta["format"] == "raw":
+            meta["error"] = "Not an ISO9660 or UDF image"
+    else:
+        meta["layout"] = _disk_layout(head)
+
+    after = os.stat(full_path)
+    if (after.st_size, after.st_mtime_ns) != (before.st_size, before.st_mtime_ns):
+        raise RuntimeError("Image changed while it was read")
+    return meta
+
+class ImageMetadataIndex:
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS images (
+            kind TEXT NOT NULL, path TEXT NOT NULL,
+            inode INTEGER NOT NULL, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL,
+            sha256 TEXT, data TEXT NOT NULL, indexed_at REAL NOT NULL,
+            PRIMARY KEY (kind, path));
+        CREATE INDEX IF NOT EXISTS images_stamp ON images(inode, size, mtime_ns);
+        CREATE INDEX IF NOT EXISTS images_sha256 ON images(sha256);
+    """
+    ROOTS = (("iso", ISO_DIR, ISO_EXTENSIONS), ("vhd", VHD_DIR, VHD_EXTENSIONS))
+    TICK = 5.0 # How often the asset index is checked for changes between full walks
+    RETRY_BACKOFF = 60 # Seconds before a failed image is read again, doubling per failure
+    RETRY_BACKOFF_MAX = 6 * 3600
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.local = threading.local()
+        self.schema_ready = False
+        self.lock = threading.Lock()
+        self.pending: Dict[tuple, tuple] = {} # (kind, path) -> stamp being analysed
+        self.failures: Dict[tuple, tuple] = {} # (kind, path) -> (failed attempts, monotonic time of next try)
+        self.executor = None
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            if not self.schema_ready:
+                conn.execute(f"PRAGMA journal_mode={sqlite_journal_mode(self.path)}") # Persists in the file
+                conn.executescript(self.SCHEMA)
+                self.schema_ready = True
+            self.local.conn = conn
+        return conn
+
+    def _pool(self) -> ProcessPoolExecutor:
+        if self.executor is None:
+            workers = int(get_config_snapshot().config.get("image_index_workers", 2))
+            # spawn: forking a process full of threads and sqlite handles is not safe
+            self.executor = ProcessPoolExecutor(max_workers=max(1, workers), initializer=_image_worker_init,
+                                                mp_context=multiprocessing.get_context("spawn"))
+        return self.executor
+
+    @staticmethod
+    def _row(row) -> Dict[str, Any]:
+        kind, path, size, sha256, data, indexed_at = row
+        return {"kind": kind, "path": path, "size": size, "sha256": sha256, "indexed_at": indexed_at, **json.loads(data)}
+
+    def lookup(self, kind: str, files: List[Dict]) -> Dict[str, Dict]:
+        """Metadata for listed files, by path. Files that changed since they were indexed,
+        including in-place writes that keep the size, are left out until re-indexed."""
+        if not files:
+            return {}
+        stamps = {f['path']: (f['inode'], f['size'], f['mtime']) for f in files}
+        conn = self._conn()
+        result = {}
+        paths = list(stamps)
+        for i in range(0, len(paths), 500): # SQLite's bound-parameter limit
+            batch = paths[i:i + 500]
+            rows = conn.execute(
+                f"SELECT kind, path, size, sha256, data, indexed_at, inode, mtime_ns FROM images "
+                f"WHERE kind = ? AND path IN ({','.join('?' * len(batch))})", [kind, *batch]).fetchall()
+            for row in rows:
+                if (row[6], row[2], row[7]) == stamps[row[1]]:
+                    result[row[1]] = self._row(row[:6])
+        digests = {m["sha256"] for m in result.values() if m["sha256"]}
+        if digests:
+            copies: Dict[str, List[str]] = {}
+            for sha256, other_kind, other_path in conn.execute(
+                    f"SELECT sha256, kind, path FROM images WHERE sha256 IN ({','.join('?' * len(digests))})",
+                    list(digests)):
+                copies.setdefault(sha256, []).append(f"{other_kind}/{other_path}")
+            for path, meta in result.items():
+                meta["duplicates"] = [c for c in copies.get(meta["sha256"], []) if c != f"{kind}/{path}"]
+        return result
+
+    def summary(self) -> Dict[str, Any]:
+        conn = self._conn()
+        images, total = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM images").fetchone()
+        duplicates = []
+        for sha256, size, paths in conn.execute(
+                "SELECT sha256, size, GROUP_CONCAT(kind || '/' || path, char(10)) FROM images "
+                "WHERE sha256 IS NOT NULL GROUP BY sha256 HAVING COUNT(*) > 1 ORDER BY size DESC"):
+            duplicates.append({"sha256": sha256, "size": size, "paths": sorted(paths.split("\n"))})
+        errors = [{"path": f"{kind}/{path}", "error": error} for kind, path, error in conn.execute(
+            "SELECT kind, path, json_extract(data, '$.error') AS error FROM images WHERE error IS NOT NULL")]
+        return {"images": images, "bytes": total, "pending": len(self.pending), "retrying": len(self.failures),
+                "duplicates": duplicates, "errors": errors}
+
+    def walk(self) -> Dict[tuple, tuple]:
+        """(kind, path) -> (inode, size, mtime_ns) for every image under the storage roots."""
+        found = {}
+        for kind, base, extensions in self.ROOTS:
+            for root, dirs, files in os.walk(base):
+                dirs[:] = [d for d in dirs if not d.startswith(".")]
+                for name in files:
+                    if name.startswith(".") or not name.endswith(extensions):
+                        continue
+                    full = os.path.join(root, name)
+                    try:
+                        st = os.stat(full)
+                    except OSError:
+                        continue
+                    found[(kind, os.path.relpath(full, base))] = (st.st_ino, st.st_size, st.st_mtime_ns)
+        return found
+
+    def sync(self) -> int:
+        """Drops rows for removed images, carries renamed ones over and queues the rest. Returns queued count."""
+        found = self.walk()
+        conn = self._conn()
+        stored = {(kind, path): (inode, size, mtime_ns) for kind, path, inode, size, mtime_ns in
+                  conn.execute("SELECT kind, path, inode, size, mtime_ns FROM images")}
+        by_stamp = {stamp: key for key, stamp in stored.items() if key not in found}
+        queue = []
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for key, stamp in found.items():
+                if stored.get(key) == stamp:
+                    continue
+                moved = by_stamp.pop(stamp, None)
+                if moved is not None:
+                    conn.execute("UPDATE images SET kind = ?, path = ? WHERE kind = ? AND path = ?", (*key, *moved))
+                    continue
+                queue.append((key, stamp))
+            for key in by_stamp.values():
+                conn.execute("DELETE FROM images WHERE kind = ? AND path = ?", key)
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+        queued = 0
+        now = time.monotonic()
+        read_mbps = int(get_config_snapshot().config.get("image_index_read_mbps", 0))
+        for key, stamp in queue:
+            with self.lock:
+                if self.pending.get(key) == stamp or self.failures.get(key, (0, 0))[1] > now:
+                    continue
+                self.pending[key] = stamp
+            kind, path = key
+            base = ISO_DIR if kind == "iso" else VHD_DIR
+            future = self._pool().submit(analyse_image, str(base / path), kind, read_mbps)
+            future.add_done_callback(functools.partial(self._record, key, stamp))
+            queued += 1
+        return queued
+
+    def _record(self, key: tuple, stamp: tuple, future):
+        with self.lock:
+            if self.pending.get(key) == stamp:
+                del self.pending[key]
+        if future.cancelled():
+            return
+        try:
+            meta = future.result()
+        except Exception as e:
+            # Typically an image still being copied in, or an I/O error; either way
+            # reading all of it again on every walk would not help
+            with self.lock:
+                attempts = self.failures.get(key, (0, 0))[0] + 1
+                delay = min(self.RETRY_BACKOFF * 2 ** (attempts - 1), self.RETRY_BACKOFF_MAX)
+                self.failures[key] = (attempts, time.monotonic() + delay)
+            logger.warning(f"Image indexing failed for {key[0]}/{key[1]} ({attempts}x), retrying in {delay}s: {e}")
+            return
+        with self.lock:
+            self.failures.pop(key, None)
+        inode, size, mtime_ns = stamp
+        IMAGE_HASHED_BYTES.inc(amount=size)
+        sha256 = meta.pop("sha256")
+        self._conn().execute("INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                             (*key, inode, size, mtime_ns, sha256, json.dumps(meta), time.time()))
+
+    def start(self):
+        if self.thread:
+            return
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._run, name="image-index", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join(timeout=5)
+        self.thread = None
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+        with self.lock:
+            self.pending.clear()
+            self.failures.clear()
+
+    def _run(self):
+        last_walk, last_changes = 0.0, None
+        while True:
+            interval = int(get_config_snapshot().config.get("image_index_interval", 300))
+            if interval > 0 and (ASSET_INDEX.changes != last_changes or time.time() - last_walk >= interval):
+                last_walk, last_changes = time.time(), ASSET_INDEX.changes
+                try:
+                    queued = self.sync()
+                    if queued:
+                        logger.info(f"Image index: {queued} images queued for checksumming")
+                except Exception as e:
+                    logger.error(f"Image index sync failed: {e}")
+            if self.stop_event.wait(self.TICK):
+                return
+
+image_index = ImageMetadataIndex(IMAGE_INDEX_DB)
+
+# --- Caching ---
+ISO_CACHE = AssetView(ISO_DIR, ISO_EXTENSIONS)
+VHD_CACHE = AssetView(VHD_DIR, VHD_EXTENSIONS)
+
+_TARGETS_LOCK = threading.Lock()
+_targets_dirty = threading.Event()
+
+def request_targets_refresh(*_):
+    """Coalesces refreshes: concurrent callers leave the work to whoever holds the lock."""
+    if not cluster.is_leader:
+        return # The leader applies it once it sees the new config stamp
+    _targets_dirty.set()
+    while _targets_dirty.is_set() and _TARGETS_LOCK.acquire(blocking=False):
+        try:
+            while _targets_dirty.is_set():
+                _targets_dirty.clear()
+                refresh_root_caches()
+        finally:
+            _TARGETS_LOCK.release()
+
+overlays.on_ready.append(request_targets_refresh)
+
+def refresh_root_caches():
+    # Trigger iSCSI config update based on current config + indexed files
+    config = get_config_snapshot().config
+    # Need to augment VHD_CACHE with full paths for generator
+    vhd_list = []
+    for f in VHD_CACHE:
+         vhd_list.append({
+             "path": f['path'],
+             "full_path": str((VHD_DIR / f['path']).absolute())
+         })
+    generate_iscsi_config_full(vhd_list, config.get('clients', []), config.get("iscsi_allowed_initiators", "ALL"))
+
+def schedule_targets_refresh():
+    """Refreshes targets in the background; callers never wait on tgtadm."""
+    bulk_pool().submit(request_targets_refresh)
+
+# --- Cluster Coordination ---
+# Several workers (uvicorn --workers N) or brain nodes can serve one runtime.
+# They share the config store, whose stamp already tells each of them when to
+# reload. Everything with effects outside the process -- tgtd targets, overlay
+# creation and maintenance, GC, the asset watcher and the static export -- is
+# owned by a single leader, elected with an flock in CLUSTER_DIR. The leader
+# publishes an asset generation and its overlay jobs to state.json; followers
+# poll it, drop their listings when the generation moves, and spool the admin
+# actions they cannot perform into commands/ for the leader to run.
+# Multi-node setups point SUPER_PXE_CLUSTER_DIR at storage all nodes share.
+
+CLUSTER_DIR = Path(os.environ.get("SUPER_PXE_CLUSTER_DIR", RUNTIME_ROOT / "cluster"))
+
+class Cluster:
+    POLL_INTERVAL = 1.0
+    EVENT_FILES = 100 # Newest event files kept in events/; a follower behind that re-reads them all
+
+    def __init__(self, state_dir: Path):
+        self.dir = state_dir
+        self.node = f"{platform.node()}:{os.getpid()}"
+        self.is_leader = True # A process that never joined (tests, the CLI) leads itself
+        self.joined = False
+        self.lock_fd = None
+        self.state: Dict[str, Any] = {}
+        self.state_stamp = None
+        self.published = None
+        self.events_stamp = None
+        self.events_published = None
+        self.events_seq = 0 # Newest event id written to events/
+        self.events_leader = None # Leader whose numbering our ring follows
+        self.config_stamp = None
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    @property
+    def state_file(self) -> Path:
+        return self.dir / "state.json"
+
+    @property
+    def commands_dir(self) -> Path:
+        return self.dir / "commands"
+
+    @property
+    def events_dir(self) -> Path:
+        return self.dir / "events"
+
+    def event_chunks(self) -> List[tuple]:
+        """(first id, last id, path) of each published event file, oldest first."""
+        chunks = []
+        for path in self.events_dir.glob("[!.]*.json"):
+            first, _, last = path.stem.partition("-")
+            if first.isdigit() and last.isdigit():
+                chunks.append((int(first), int(last), path))
+        return sorted(chunks)
+
+    def leader(self) -> Optional[str]:
+        try:
+            return (self.dir / "leader.lock").read_text().strip() or None
+        except OSError:
+            return None
+
+    def try_lead(self) -> bool:
+        """Takes the leader lock if nobody holds it. The kernel drops it if we die."""
+        fd = os.open(self.dir / "leader.lock", os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        os.ftruncate(fd, 0)
+        os.write(fd, self.node.encode())
+        self.lock_fd = fd
+        return True
+
+    def prepare(self):
+        """Called at startup, before warm-up. Until join() has run the election this
+        process is a follower: requests arriving meanwhile spool leader work instead
+        of touching tgtd or overlays alongside the real leader."""
+        self.commands_dir.mkdir(parents=True, exist_ok=True)
+        self.is_leader = False
+        overlays.remote = {}
+
+    def join(self):
+        """Elects a leader among the processes sharing CLUSTER_DIR and starts polling."""
+        if self.joined:
+            return
+        self.commands_dir.mkdir(parents=True, exist_ok=True)
+        self.stop_event.clear()
+        self.is_leader = self.try_lead()
+        if self.is_leader:
+            try:
+                self.lead()
+            except Exception:
+                # Step down so a warm-up retry runs the election and lead() again
+                os.close(self.lock_fd)
+                self.lock_fd = None
+                self.is_leader = False
+                overlays.remote = {}
+                raise
+        else:
+            logger.info(f"Cluster: {self.node} follows {self.leader()}")
+            overlays.remote = {} # Until the leader's state is read, nothing is ready here
+            self.follow()
+        self.joined = True
+        self.thread = threading.Thread(target=self._run, name="cluster", daemon=True)
+        self.thread.start()
+
+    def leave(self):
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join(timeout=5)
+        self.thread = None
+        if self.lock_fd is not None:
+            os.close(self.lock_fd) # Releases the flock; a follower takes over
+            self.lock_fd = None
+        self.joined = False
+        self.is_leader = True
+        overlays.remote = None
+
+    def lead(self):
+        logger.info(f"Cluster: {self.node} is the leader")
+        overlays.remote = None
+        self.config_stamp = CONFIG_STORE.stamp()
+        with warmup.phase("leader.asset_watcher"):
+            ASSET_INDEX.start_watcher(get_config_snapshot().config.get("asset_watch", "auto"))
+        with warmup.phase("leader.targets"):
+            refresh_root_caches()
+        static_exporter.start()
+        overlay_lifecycle.start()
+        image_index.start()
+        session_poller.start()
+        backlog = events.take_outbox() # Spooled as a follower but never sent
+        if backlog:
+            events.ingest(backlog)
+        self.reset_events()
+        self.publish()
+
+    def publish(self):
+        """Writes the asset generation, overlay jobs and live events for followers, if they moved."""
+        if events.version != self.events_published:
+            self.events_published = events.version
+            self.publish_events()
+        current = (ASSET_INDEX.changes, overlays.version)
+        if current == self.published:
+            return
+        with overlays.lock:
+            jobs = {key: dict(job) for key, job in overlays.jobs.items()}
+        write_file_atomic(self.state_file, json.dumps(
+            {"leader": self.node, "assets": [self.node, current[0]], "overlays": jobs}))
+        self.published = current
+
+    def follow(self):
+        """Picks up the leader's latest state.json, dropping asset listings if they went stale."""
+        try:
+            st = self.state_file.stat()
+            stamp = (st.st_ino, st.st_mtime_ns, st.st_size)
+            if stamp == self.state_stamp:
+                return
+            state = json.loads(self.state_file.read_text())
+        except (OSError, ValueError):
+            return
+        if state.get("assets") != self.state.get("assets"):
+            ASSET_INDEX.invalidate_all()
+        overlays.remote = state.get("overlays", {})
+        self.state = state
+        self.state_stamp = stamp
+
+    def reset_events(self):
+        """Starts the event files over; the next publish writes our whole ring, once per leadership."""
+        self.events_dir.mkdir(parents=True, exist_ok=True)
+        for _, _, path in self.event_chunks():
+            path.unlink(missing_ok=True)
+        self.events_seq, self.events_published = 0, None
+
+    def publish_events(self):
+        """Writes the events numbered since the last publish as one file in events/,
+        named by its id range, so followers read what is new instead of the whole
+        ring every second. Files whose events fell out of the ring are pruned."""
+        batch, seq, sessions = events.tail(self.events_seq)
+        if not batch:
+            return
+        name = f"{batch[0]['id']:012d}-{seq:012d}.json"
+        write_file_atomic(self.events_dir / name,
+                          json.dumps({"leader": self.node, "events": batch, "sessions": sessions}))
+        self.events_seq = seq
+        chunks = self.event_chunks()
+        for i, (_, last, path) in enumerate(chunks):
+            if last <= seq - events.SIZE or i < len(chunks) - self.EVENT_FILES:
+                path.unlink(missing_ok=True)
+
+    def follow_events(self):
+        """Appends the leader's event files newer than our ring. A new leader numbers
+        from its own ring, and a follower too far behind finds files pruned; both
+        re-read everything published instead."""
+        try:
+            st = self.events_dir.stat()
+            stamp = (st.st_ino, st.st_mtime_ns) # Each publish renames a file in
+            if stamp == self.events_stamp:
+                return
+            chunks = self.event_chunks()
+            if not chunks:
+                self.events_stamp = stamp
+                return
+            newer = [c for c in chunks if c[1] > events.seq]
+            full = chunks[-1][1] < events.seq or (newer and newer[0][0] > events.seq + 1)
+            published = [json.loads(path.read_text()) for _, _, path in (chunks if full else newer)]
+            if not full and any(p.get("leader") != self.events_leader for p in published):
+                full = True
+                published = [json.loads(path.read_text()) for _, _, path in chunks]
+        except (OSError, ValueError):
+            return # Pruned or replaced while we read: try again next poll
+        if published:
+            batch = [event for p in published for event in p.get("events", [])]
+            if full:
+                events.adopt({"seq": batch[-1]["id"] if batch else 0, "events": batch,
+                              "sessions": published[-1].get("sessions", [])})
+            else:
+                events.extend(batch, published[-1].get("sessions", []))
+            self.events_leader = published[-1].get("leader")
+        self.events_stamp = stamp
+
+    def send(self, action: str, **args):
+        """Spools an action for the leader. Followers only; the leader acts directly."""
+        path = self.commands_dir / f"{time.time_ns()}-{uuid.uuid4().hex}.json"
+        write_file_atomic(path, json.dumps({"action": action, **args}))
+
+    def take_commands(self) -> List[Dict]:
+        commands = []
+        for path in sorted(self.commands_dir.glob("[!.]*.json")):
+            try:
+                commands.append(json.loads(path.read_text()))
+            except (OSError, ValueError) as e:
+                logger.warning(f"Cluster: dropping unreadable command {path.name}: {e}")
+            path.unlink(missing_ok=True)
+        return commands
+
+    def execute(self, command: Dict):
+        action = command.get("action")
+        if action == "refresh":
+            ASSET_INDEX.invalidate_all()
+            request_targets_refresh()
+        elif action == "overlay_retry":
+            overlays.submit(command["image"], command["mac"], force=True)
+        elif action == "overlay_operation":
+            client = get_config_snapshot().find_client(command["mac"])
+            if client:
+                overlay_lifecycle.schedule(client, command["operation"])
+        elif action == "overlay_gc":
+            overlay_lifecycle.gc()
+        elif action == "events":
+            events.ingest(command["events"])
+        else:
+            logger.warning(f"Cluster: unknown command '{action}'")
+
+    def _run(self):
+        while not self.stop_event.wait(self.POLL_INTERVAL):
+            try:
+                if not self.is_leader and self.try_lead():
+                    self.is_leader = True
+                    self.lead()
+                if not self.is_leader:
+                    self.follow()
+                    self.follow_events()
+                    batch = events.take_outbox()
+                    if batch:
+                        self.send("events", events=batch) # One spool file per poll, not per boot
+                    continue
+                stamp = CONFIG_STORE.stamp()
+                if stamp != self.config_stamp:
+                    # Possibly saved by a follower, which leaves tgtd to us
+                    self.config_stamp = stamp
+                    request_targets_refresh()
+                for command in self.take_commands():
+                    try:
+                        self.execute(command)
+                    except Exception as e:
+                        logger.error(f"Cluster: command {command.get('action')} failed: {e}")
+                self.publish()
+            except Exception as e:
+                logger.error(f"Cluster coordination failed: {e}")
+
+cluster = Cluster(CLUSTER_DIR)
+
+# --- Live Events ---
+# The dashboard follows boots, menu navigation, overlay and target changes and
+# iSCSI sessions over one Server-Sent Events stream instead of polling. Events
+# land in a bounded ring that every open console reads, so N consoles cost N
+# idle sockets rather than N request loops against the boot path. Sessions
+# come from a single tgtadm poll on the leader. Followers spool their events
+# to the leader, which numbers them and publishes each new run of them as a small
+# file in events/ so a console sees the same stream whichever worker it is
+# connected to. Boots answered by nginx from the static export never reach the
+# brain and produce no boot or menu events.
+
+EVENTS_HEARTBEAT = 15 # Seconds between keep-alive comments on an idle stream
+EVENTS_BACKLOG = 100 # Events replayed to a console connecting without Last-Event-ID
+EVENTS_EMITTED = Counter("pxe_events_total", "Events added to the live stream.", ("type",))
+Gauge("pxe_event_streams", "Open /api/events connections.", collect=lambda: {(): events.streams})
+
+def sse_message(event: str, data: Any, event_id: Optional[int] = None) -> str:
+    lines = [f"id: {event_id}"] if event_id is not None else []
+    lines += [f"event: {event}", f"data: {json.dumps(data)}"]
+    return "\n".join(lines) + "\n\n"
+
+class EventBus:
+    SIZE = 1000
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ring = deque(maxlen=self.SIZE)
+        self.seq = 0 # Id of the newest event; ids in the ring are consecutive
+        self.outbox: List[Dict] = [] # A follower's events, until the cluster loop spools them
+        self.sessions: List[Dict] = []
+        self.version = 0 # Bumped whenever the ring or sessions change
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.changed: Optional[asyncio.Event] = None
+        self.wake_pending = False
+        self.streams = 0
+
+    def emit(self, type: str, **data):
+        """Records an event. Cheap enough for the boot path: a dict, a lock and an append."""
+        EVENTS_EMITTED.inc(type)
+        event = {"type": type, "time": round(time.time(), 3), **data}
+        if cluster.is_leader:
+            self.ingest([event])
+            return
+        with self.lock:
+            if len(self.outbox) < self.SIZE: # A leader that stopped reading must not cost us memory
+                self.outbox.append(event)
+
+    def ingest(self, batch: List[Dict]):
+        with self.lock:
+            for event in batch:
+                self.seq += 1
+                self.ring.append({**event, "id": self.seq})
+            self.version += 1
+        self._wake()
+
+    def take_outbox(self) -> List[Dict]:
+        with self.lock:
+            batch, self.outbox = self.outbox, []
+        return batch
+
+    def set_sessions(self, sessions: List[Dict]):
+        """Replaces the session list, recording a start or end event for each difference."""
+        key = lambda s: (s["target"], s["initiator"], s["client"])
+        previous = {key(s): s for s in self.sessions}
+        current = {key(s): s for s in sessions}
+        if previous.keys() == current.keys():
+            return
+        self.sessions = sessions
+        now = round(time.time(), 3)
+        changes = [{"type": "session_start", "time": now, "session": s} for k, s in current.items() if k not in previous]
+        changes += [{"type": "session_end", "time": now, "session": s} for k, s in previous.items() if k not in current]
+        for change in changes:
+            EVENTS_EMITTED.inc(change["type"])
+        self.ingest(changes)
+
+    def tail(self, after: int) -> tuple:
+        """(events numbered after `after`, the newest id, sessions), for the leader to publish."""
+        with self.lock:
+            skip = max(0, len(self.ring) - (self.seq - after))
+            return list(itertools.islice(self.ring, skip, None)), self.seq, self.sessions
+
+    def extend(self, batch: List[Dict], sessions: List[Dict]):
+        """Appends the leader's newer events to a follower's ring, keeping their ids."""
+        with self.lock:
+            fresh = [event for event in batch if event["id"] > self.seq]
+            self.ring.extend(fresh)
+            if fresh:
+                self.seq = fresh[-1]["id"]
+            self.sessions = sessions
+            self.version += 1
+        self._wake()
+
+    def adopt(self, state: Dict[str, Any]):
+        """Mirrors the leader's ring on a follower."""
+        with self.lock:
+            self.ring = deque(state.get("events", []), maxlen=self.SIZE)
+            self.seq = state.get("seq", 0)
+            self.sessions = state.get("sessions", [])
+            self.version += 1
+        self._wake()
+
+    def since(self, last_id: Optional[int]) -> tuple:
+        """(events after last_id, how many of them already fell out of the ring)."""
+        with self.lock:
+            if not self.ring:
+                return [], 0
+            first = self.ring[0]["id"]
+            if last_id is None or last_id > self.seq: # New console, or ids restarted under it
+                return list(self.ring)[-EVENTS_BACKLOG:], 0
+            skip = last_id - first + 1
+            if skip < 0:
+                return list(self.ring), -skip
+            return list(itertools.islice(self.ring, skip, None)), 0
+
+    def subscribe(self) -> asyncio.Event:
+        """The event set on the next change. Call from the loop before reading with since()."""
+        loop = asyncio.get_running_loop()
+        if self.loop is not loop: # First console, or a new loop (tests, reloads)
+            self.loop, self.changed, self.wake_pending = loop, asyncio.Event(), False
+        return self.changed
+
+    def _wake(self):
+        # One callback per burst, however many events and consoles there are
+        with self.lock:
+            if self.loop is None or not self.streams or self.wake_pending:
+                return
+            self.wake_pending = True
+        try:
+            self.loop.call_soon_threadsafe(self._notify)
+        except RuntimeError: # Loop closed
+            self.wake_pending = False
+
+    def _notify(self):
+        self.wake_pending = False
+        changed, self.changed = self.changed, asyncio.Event()
+        changed.set()
+
+events = EventBus()
+
+class SessionPoller:
+    """Polls tgtd for logged-in initiators on the leader; everyone else reads the result."""
+    def __init__(self):
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.last_error = None
+
+    def start(self):
+        if self.thread:
+            return
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._run, name="session-poller", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join(timeout=5)
+        self.thread = None
+
+    def poll(self):
+        if not shutil.which("tgtadm"):
+            return
+        try:
+            events.set_sessions(targets.sessions())
+            self.last_error = None
+        except (OSError, subprocess.CalledProcessError) as e:
+            error = getattr(e, "stderr", None) or str(e)
+            if error != self.last_error: # tgtd down: say so once, not every few seconds
+                logger.warning(f"Session poll failed: {error.strip()}")
+                self.last_error = error
+
+    def _run(self):
+        while True:
+            interval = int(get_config_snapshot().config.get("session_poll_interval", 5))
+            if interval > 0:
+                self.poll()
+            if self.stop_event.wait(interval if interval > 0 else 5):
+                return
+
+session_poller = SessionPoller()
+
+async def event_stream(request: Request, last_id: Optional[int]):
+    events.streams += 1
+    try:
+        yield "retry: 3000\n\n"
+        yield sse_message("sessions", events.sessions) # Full list; session_* events update it
+        while True:
+            changed = events.subscribe()
+            batch, missed = events.since(last_id)
+            if missed:
+                yield sse_message("gap", {"missed": missed})
+            for event in batch:
+                yield sse_message(event["type"], event, event["id"])
+            if batch:
+                last_id = batch[-1]["id"]
+            try:
+                await asyncio.wait_for(changed.wait(), EVENTS_HEARTBEAT)
+            except asyncio.TimeoutError:
+                if await request.is_disconnected():
+                    return
+                yield ": keep-alive\n\n"
+    finally:
+        events.streams -= 1
+
+# --- Startup & Readiness ---
+# Startup only starts the lag monitor and a warm-up thread, so /boot.ipxe is
+# answered from persisted state (the config store, overlay files on disk and
+# the targets tgtd still holds) as soon as uvicorn listens. Leader election,
+# the storage scan and the targets sync happen during warm-up; each phase is
+# timed, logged and reported by /readyz until it finishes.
+
+Gauge("pxe_startup_phase_seconds", "Duration of each startup and warm-up phase.", ("phase",),
+      collect=lambda: {(name,): p["seconds"] for name, p in list(warmup.phases.items())
+                       if p["seconds"] is not None})
+Gauge("pxe_ready", "1 once background warm-up has finished.", collect=lambda: {(): int(warmup.ready)})
+
+class WarmUp:
+    RETRY_MIN = 5 # Seconds before retrying a failed warm-up, doubling up to RETRY_MAX
+    RETRY_MAX = 60
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.phases: Dict[str, Dict[str, Any]] = {}
+        self.ready = False
+        self.error = None
+        self.attempts = 0
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def record(self, name: str, seconds: float, error: Optional[str] = None):
+        with self.lock:
+            self.phases[name] = {"state": "failed" if error else "done", "seconds": round(seconds, 4), "error": error}
+        if error:
+            logger.error(f"Startup phase {name} failed after {seconds * 1000:.0f} ms: {error}")
+        else:
+            logger.info(f"Startup phase {name} took {seconds * 1000:.0f} ms")
+
+    @contextmanager
+    def phase(self, name: str):
+        started = time.perf_counter()
+        with self.lock:
+            self.phases[name] = {"state": "running", "seconds": None, "error": None}
+        try:
+            yield
+        except Exception as e:
+            self.record(name, time.perf_counter() - started, str(e))
+            raise
+        self.record(name, time.perf_counter() - started)
+
+    def start(self):
+        if self.thread:
+            return
+        self.ready = False
+        self.error = None
+        self.attempts = 0
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._run, name="warm-up", daemon=True)
+        self.thread.start()
+
+    def wait(self, timeout: Optional[float] = None):
+        if self.thread:
+            self.thread.join(timeout)
+
+    def stop(self, timeout: Optional[float] = None):
+        """Abandons pending retries and waits for a running attempt to finish."""
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join(timeout)
+        self.thread = None
+
+    def _run(self):
+        # A failed phase (NFS not mounted yet, tgtd still starting) would otherwise
+        # leave /readyz at 503 until a restart; every phase is safe to repeat
+        started = time.perf_counter()
+        delay = self.RETRY_MIN
+        while not self.stop_event.is_set():
+            self.attempts += 1
+            try:
+                with self.phase("config"):
+                    get_config_snapshot()
+                    licenser.status = licenser._refresh_status()
+                with self.phase("asset_scan"):
+                    # Root menus are the first thing every booting client asks for
+                    get_directory_contents(ISO_DIR)
+                    get_directory_contents(VHD_DIR)
+                with self.phase("cluster"): # The leader also syncs targets and starts the exporter and GC
+                    cluster.join()
+            except Exception as e:
+                self.error = str(e)
+                logger.warning(f"Warm-up attempt {self.attempts} failed, retrying in {delay}s")
+                self.stop_event.wait(delay)
+                delay = min(delay * 2, self.RETRY_MAX)
+                continue
+            self.error = None
+            self.ready = True
+            logger.info(f"Warm-up finished in {(time.perf_counter() - started) * 1000:.0f} ms, ready")
+            return
+
+    def report(self) -> Dict[str, Any]:
+        with self.lock:
+            phases = {name: dict(p) for name, p in self.phases.items()}
+        return {"ready": self.ready, "error": self.error, "attempts": self.attempts, "phases": phases}
+
+warmup = WarmUp()
+
+_LAG_MONITOR: Optional[asyncio.Task] = None
+
+@app.on_event("startup")
+async def startup_event():
+    global _LAG_MONITOR
+    warmup.record("import", time.perf_counter() - _IMPORT_STARTED)
+    _LAG_MONITOR = asyncio.get_running_loop().create_task(monitor_event_loop_lag())
+    cluster.prepare()
+    warmup.start()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    if _LAG_MONITOR is not None:
+        _LAG_MONITOR.cancel()
+    await run_disk(warmup.stop, 30) # Otherwise it may elect us leader after we leave
+    cluster.leave()
+    session_poller.stop()
+    image_index.stop()
+    static_exporter.stop()
+    overlay_lifecycle.stop()
+    overlays.shutdown()
+    iso_boot.shutdown()
+    ASSET_INDEX.stop_watcher()
+    shutdown_pools()
+
+# --- API Endpoints ---
+
+@app.get("/")
+async def read_root(username: str = Depends(get_current_username)):
+    return FileResponse(STATIC_DIR / "index.html")
+
+@app.get("/healthz")
+async def healthz():
+    # Liveness only: the process answers. Boots are served before warm-up ends.
+    return {"status": "ok"}
+
+@app.get("/readyz")
+async def readyz():
+    report = warmup.report()
+    return JSONResponse(report, status_code=200 if report["ready"] else 503)
+
+@app.get("/metrics")
+@off_loop
+def get_metrics():
+    # Unauthenticated like /boot.ipxe, so Prometheus can scrape it
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+@app.get("/api/config")
+@off_loop
+def get_config(username: str = Depends(get_current_username)):
     config = load_config()
+    licenser.status = licenser._refresh_status()
+    config["license_status"] = licenser.status
+    config["hardware_id"] = licenser.machine_id
+    return config
+
+@app.post("/api/config")
+@off_loop
+def update_config(config: ConfigModel, username: str = Depends(get_current_username)):
+    config_data = config.dict()
+    clients = []
+    for i, data in enumerate(config_data.get("clients") or []):
+        try:
+            clients.append(validate_client(data)) # Same MAC form as the per-client API
+        except ValueError as e:
+            raise HTTPException(status_code=422, detail=f"clients[{i}]: {e}")
+    config_data["clients"] = clients
+    save_config(config_data)
+    schedule_targets_refresh() # Re-generate iSCSI targets; overlays are queued, not awaited
+    static_exporter.schedule()
+    # Rendered here on the pool: encoding thousands of clients on the loop stalls every boot
+    return JSONResponse({"status": "success", "config": config_data})
+
+@app.post("/api/refresh")
+@off_loop
+def refresh_assets(username: str = Depends(get_current_username)):
+    ASSET_INDEX.invalidate_all()
+    if not cluster.is_leader:
+        cluster.send("refresh") # So the leader rescans and every follower follows
+    schedule_targets_refresh()
+    return {"status": "success"}
+
+@app.get("/api/cluster")
+@off_loop
+def get_cluster(username: str = Depends(get_current_username)):
+    if not cluster.joined:
+        role = "standalone" if cluster.is_leader else "joining"
+    else:
+        role = "leader" if cluster.is_leader else "follower"
+    return {"node": cluster.node, "role": role, "leader": cluster.node if role == "standalone" else cluster.leader()}
+
+@app.get("/api/events")
+async def stream_events(request: Request, last_event_id: Optional[int] = None,
+                        username: str = Depends(get_current_username)):
+    """Server-Sent Events; browsers resume from the Last-Event-ID header on reconnect."""
+    header = request.headers.get("last-event-id", "")
+    if header.isdigit():
+        last_event_id = int(header)
+    return StreamingResponse(event_stream(request, last_event_id), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.get("/api/sessions")
+async def get_sessions(username: str = Depends(get_current_username)):
+    return events.sessions # Kept current by the leader's poller; no tgtadm call here
+
+@app.get("/api/overlays")
+@off_loop
+def get_overlays(username: str = Depends(get_current_username)):
+    result = []
+    for client in get_config_snapshot().config.get("clients", []):
+        if client.get('type') == 'vhd' and client.get('overlay'):
+            result.append(overlays.status(client['image'], client['mac']))
+    return result
+
+@app.post("/api/overlays/{mac}/retry")
+@off_loop
+def retry_overlay(mac: str, username: str = Depends(get_current_username)):
+    client = get_config_snapshot().find_client(mac)
+    if not client or client.get('type') != 'vhd' or not client.get('overlay'):
+        raise HTTPException(status_code=404, detail="No overlay client with that MAC")
+    state = overlays.submit(client['image'], client['mac'], force=True)
+    return {"status": "success", "state": state}
+
+@app.get("/api/overlays/storage")
+@off_loop
+def get_overlay_storage(username: str = Depends(get_current_username)):
+    inventory = overlay_lifecycle.inventory()
+    return {
+        "overlays": inventory,
+        "allocated_bytes": sum(o["allocated_bytes"] for o in inventory),
+        "virtual_bytes": sum(o["virtual_bytes"] or 0 for o in inventory),
+        "orphans": sum(1 for o in inventory if o["orphan"]),
+    }
+
+@app.post("/api/overlays/gc")
+@off_loop
+def gc_overlays(dry_run: bool = False, username: str = Depends(get_current_username)):
+    return {"status": "success", **overlay_lifecycle.gc(dry_run)}
+
+@app.post("/api/overlays/{mac}/{operation}")
+@off_loop
+def overlay_operation(mac: str, operation: str, username: str = Depends(get_current_username)):
+    """reset: recreate an empty overlay. rebase: re-point it at the file the client's
+    image now resolves to (e.g. a re-pointed symlink), keeping the guest's view.
+    commit: promote this client into the master; every other overlay on that
+    master is reset. All run in the background; poll GET /api/overlays."""
+    if operation not in ("reset", "rebase", "commit"):
+        raise HTTPException(status_code=404, detail=f"Unknown overlay operation '{operation}'")
+    client = get_config_snapshot().find_client(mac)
+    if not client or client.get('type') != 'vhd' or not client.get('overlay'):
+        raise HTTPException(status_code=404, detail="No overlay client with that MAC")
+    if operation != "reset" and not overlay_path_for(client['image'], client['mac']).exists():
+        raise HTTPException(status_code=409, detail="Overlay does not exist yet")
+    try:
+        affected = overlay_lifecycle.schedule(client, operation)
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return {"status": "success", "state": OVERLAY_MAINTENANCE, "affected": affected}
+
+# --- Client API ---
+# Per-client edits go straight to the store and refresh only what the touched
+# clients affect, instead of round-tripping the whole ConfigModel.
+
+CLIENT_FIELDS = ("mac", "image", "type", "hostname", "overlay", "injection_file", "kernel_args", "san_protocol", "vars")
+_MAC_RE = re.compile(r"([0-9a-f]{2}:){5}[0-9a-f]{2}")
+
+class ClientPatchModel(BaseModel):
+    image: Optional[str] = None
+    type: Optional[str] = None
+    hostname: Optional[str] = None
+    overlay: Optional[bool] = None
+    injection_file: Optional[str] = None
+    kernel_args: Optional[str] = None
+    san_protocol: Optional[str] = None
+    vars: Optional[Dict[str, Any]] = None
+
+def validate_client(data: Dict[str, Any]) -> Dict[str, Any]:
+    """Returns the client as ClientModel would store it, MAC normalized. Raises ValueError."""
+    try:
+        client = ClientModel(**data).dict()
+    except ValidationError as e:
+        raise ValueError("; ".join(f"{'.'.join(map(str, err['loc']))}: {err['msg']}" for err in e.errors()))
+    if not _MAC_RE.fullmatch(normalize_mac(client['mac'])):
+        raise ValueError(f"invalid MAC address '{client['mac']}'")
+    client['mac'] = normalize_mac(client['mac'])
+    if client['type'] not in ("iso", "vhd"):
+        raise ValueError(f"type must be 'iso' or 'vhd', not '{client['type']}'")
+    if client['san_protocol'] not in SAN_PROTOCOLS:
+        raise ValueError(f"san_protocol must be 'iscsi' or 'http', not '{client['san_protocol']}'")
+    return client
+
+def refresh_for_clients(touched: List[Optional[Dict]]):
+    """Regenerates what the touched clients (before and after) feed into."""
+    if any(c and c.get('type') == 'vhd' for c in touched):
+        schedule_targets_refresh() # Diff-applied, so only these clients' targets change
+    static_exporter.schedule() # Re-renders only the changed client scripts
+
+def _require_client(mac: str) -> Dict:
+    client = get_config_snapshot().find_client(mac)
+    if client is None:
+        raise HTTPException(status_code=404, detail=f"No client with MAC {mac}")
+    return client
+
+def _put_client(mac: str, data: Dict[str, Any]) -> Dict:
+    try:
+        client = validate_client(data)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    if client['mac'] != normalize_mac(mac):
+        raise HTTPException(status_code=400, detail="MAC in body does not match the URL")
+    previous = get_config_snapshot().find_client(mac)
+    snapshot = save_clients([client])
+    refresh_for_clients([previous, client])
+    return snapshot.find_client(mac)
+
+@app.get("/api/clients")
+@off_loop
+def list_clients(username: str = Depends(get_current_username)):
+    return get_config_snapshot().config.get("clients", [])
+
+@app.get("/api/clients/{mac}")
+@off_loop
+def get_client(mac: str, username: str = Depends(get_current_username)):
+    return _require_client(mac)
+
+@app.put("/api/clients/{mac}")
+@off_loop
+def put_client(mac: str, body: Dict[str, Any], username: str = Depends(get_current_username)):
+    """Creates or replaces one client. The body's mac may be omitted."""
+    return {"status": "success", "client": _put_client(mac, {"mac": mac, **body})}
+
+@app.patch("/api/clients/{mac}")
+@off_loop
+def patch_client(mac: str, patch: ClientPatchModel, username: str = Depends(get_current_username)):
+    client = _require_client(mac)
+    changes = patch.dict(exclude_unset=True)
+    return {"status": "success", "client": _put_client(mac, {**client, **changes})}
+
+@app.delete("/api/clients/{mac}")
+@off_loop
+def delete_client(mac: str, username: str = Depends(get_current_username)):
+    client = _require_client(mac)
+    save_clients([], [client['mac']])
+    refresh_for_clients([client])
+    return {"status": "success"}
+
+def parse_client_rows(body: bytes, content_type: str) -> List[Dict[str, Any]]:
+    """Accepts a JSON list (or {"clients": [...]}) or CSV with a header row."""
+    text = body.decode("utf-8-sig")
+    if "json" in content_type or text.lstrip()[:1] in ("[", "{"):
+        rows = json.loads(text)
+        if isinstance(rows, dict):
+            rows = rows.get("clients", [])
+        if not isinstance(rows, list):
+            raise ValueError("expected a list of clients")
+        return rows
+    rows = []
+    for row in csv.DictReader(io.StringIO(text)):
+        client = {k.strip(): (v or "").strip() for k, v in row.items() if k and k.strip() in CLIENT_FIELDS}
+        client = {k: v for k, v in client.items() if v != ""} # Blank cells fall back to defaults
+        # Template variables come as one column each: vars.disk, vars.role, ...
+        variables = {k.strip()[5:]: (v or "").strip() for k, v in row.items()
+                     if k and k.strip().startswith("vars.") and (v or "").strip()}
+        if variables:
+            client["vars"] = variables
+        elif "vars" in client:
+            try:
+                client["vars"] = json.loads(client["vars"])
+            except ValueError:
+                raise ValueError(f"line {len(rows) + 2}: vars must be a JSON object")
+        if "overlay" in client:
+            flag = client["overlay"].lower()
+            if flag not in ("1", "0", "true", "false", "yes", "no", "y", "n", "on", "off"):
+                raise ValueError(f"line {len(rows) + 2}: overlay must be a yes/no value")
+            client["overlay"] = flag in ("1", "true", "yes", "y", "on")
+        rows.append(client)
+    return rows
+
+@app.post("/api/clients/import")
+async def import_clients(request: Request, mode: str = "merge", username: str = Depends(get_current_username)):
+    """
+    Bulk create/update clients from JSON or CSV (columns: mac,image,type,hostname,
+    overlay,injection_file,kernel_args,san_protocol and vars.<name>). Every row is validated before anything
+    is written; the batch is then applied in one transaction. mode=replace also
+    removes clients missing from the batch.
+    """
+    if mode not in ("merge", "replace"):
+        raise HTTPException(status_code=400, detail="mode must be 'merge' or 'replace'")
+    return await run_disk(_import_clients, await request.body(), request.headers.get("content-type", ""), mode)
+
+def _import_clients(body: bytes, content_type: str, mode: str) -> Dict[str, Any]:
+    try:
+        rows = parse_client_rows(body, content_type)
+    except (ValueError, UnicodeDecodeError) as e:
+        raise HTTPException(status_code=400, detail=f"Could not parse import: {e}")
+
+    clients, errors, seen = [], [], {}
+    for number, row in enumerate(rows, start=1):
+        try:
+            if not isinstance(row, dict):
+                raise ValueError("expected an object")
+            client = validate_client(row)
+            mac = normalize_mac(client['mac'])
+            if mac in seen:
+                raise ValueError(f"duplicate of row {seen[mac]}")
+            seen[mac] = number
+            clients.append(client)
+        except ValueError as e:
+            errors.append({"row": number, "mac": row.get("mac") if isinstance(row, dict) else None, "error": str(e)})
+    if errors:
+        raise HTTPException(status_code=422, detail={
+            "message": f"{len(errors)} of {len(rows)} rows are invalid; nothing was imported",
+            "errors": errors[:100]})
+
+    existing = get_config_snapshot().clients_by_mac
+    changed = [c for c in clients if existing.get(normalize_mac(c['mac'])) != c]
+    removed = [c for mac, c in existing.items() if mac not in seen] if mode == "replace" else []
+    if changed or removed:
+        save_clients(changed, [c['mac'] for c in removed])
+        refresh_for_clients([existing.get(normalize_mac(c['mac'])) for c in changed] + changed + removed)
+    created = sum(1 for c in changed if normalize_mac(c['mac']) not in existing)
+    return {"status": "success", "imported": len(clients), "created": created,
+            "updated": len(changed) - created, "unchanged": len(clients) - len(changed), "removed": len(removed)}
+
+@app.get("/api/assets")
+@off_loop
+def get_assets(username: str = Depends(get_current_username), path: str = "", type: str = "root"):
+    iso_files, iso_dirs = [], []
+    vhd_files, vhd_dirs = [], []
+    if type == "root" or type == "iso":
+        iso_files, iso_dirs = get_directory_contents(ISO_DIR, path)
+    if type == "root" or type == "vhd":
+        vhd_files, vhd_dirs = get_directory_contents(VHD_DIR, path)
+    
+    injections, _ = get_directory_contents(INJECTION_DIR)
+
+    # Listings are shared, so metadata goes on copies; None means not indexed yet
+    iso_meta = image_index.lookup("iso", iso_files)
+    vhd_meta = image_index.lookup("vhd", vhd_files)
+    iso_files = [{**f, "meta": iso_meta.get(f['path'])} for f in iso_files]
+    vhd_files = [{**f, "meta": vhd_meta.get(f['path'])} for f in vhd_files]
+
+    return {
+        "isos": iso_files, "iso_dirs": iso_dirs,
+        "vhds": vhd_files, "vhd_dirs": vhd_dirs,
+        "injections": injections,
+        "current_path": path
+    }
+
+@app.get("/api/images")
+@off_loop
+def get_images(username: str = Depends(get_current_username)):
+    """Index totals, duplicate groups and images that failed validation (e.g. truncated uploads)."""
+    return image_index.summary()
+
+# Uploads are parsed straight off the request stream. Each file goes to a
+# temp file in UPLOAD_DIR (written off the event loop), is hashed while it
+# streams, and is renamed into place only once complete and within size.
+# UPLOAD_DIR is not served: INJECTION_DIR is, to anyone, so partial and
+# aborted uploads must never sit there.
+
+UPLOAD_DIR = RUNTIME_ROOT / "uploads"
+INJECTION_HASHES_MAX = 1024
+_INJECTION_HASHES: "OrderedDict[str, tuple]" = OrderedDict() # name -> (size, mtime_ns, sha256)
+_INJECTION_HASHES_LOCK = threading.Lock()
+
+def injection_sha256(path: Path) -> Optional[str]:
+    try:
+        st = path.stat()
+    except OSError:
+        return None
+    with _INJECTION_HASHES_LOCK:
+        cached = _INJECTION_HASHES.get(path.name)
+        if cached is not None and cached[:2] == (st.st_size, st.st_mtime_ns):
+            _INJECTION_HASHES.move_to_end(path.name)
+            return cached[2]
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    digest = h.hexdigest()
+    with _INJECTION_HASHES_LOCK:
+        _INJECTION_HASHES[path.name] = (st.st_size, st.st_mtime_ns, digest) # A replaced file overwrites its entry
+        _INJECTION_HASHES.move_to_end(path.name)
+        while len(_INJECTION_HASHES) > INJECTION_HASHES_MAX:
+            _INJECTION_HASHES.popitem(last=False)
+    return digest
+
+class _UploadPart:
+    def __init__(self):
+        self.headers: Dict[str, str] = {}
+        self.header_field = b""
+        self.header_value = b""
+        self.filename = None
+        self.tmp_path = None
+        self.f = None
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+        self.buffer: List[bytes] = []
+
+    def flush(self):
+        """Runs in a worker thread."""
+        if self.f is None:
+            UPLOAD_DIR.mkdir(mode=0o700, parents=True, exist_ok=True)
+            self.tmp_path = UPLOAD_DIR / f"upload-{uuid.uuid4().hex}.tmp"
+            self.f = open(self.tmp_path, "wb")
+        for chunk in self.buffer:
+            self.f.write(chunk)
+        self.buffer = []
+
+    def discard(self):
+        if self.f is not None:
+            self.f.close()
+        if self.tmp_path is not None:
+            self.tmp_path.unlink(missing_ok=True)
+
+def _safe_injection_name(filename: str) -> Optional[str]:
+    name = Path(filename.replace("\\", "/")).name
+    if not name or name.startswith("."):
+        return None
+    return name
+
+def _commit_upload(part: _UploadPart) -> Dict[str, Any]:
+    """Runs in a worker thread: finalises one streamed file and reports duplicates."""
+    part.flush()
+    part.f.close()
+    digest = part.sha256.hexdigest()
+    target = INJECTION_DIR / part.filename
+    result = {"filename": part.filename, "size": part.size, "sha256": digest, "duplicate_of": None}
+    if injection_sha256(target) == digest:
+        part.tmp_path.unlink() # Identical re-upload: keep the existing file untouched
+        result["unchanged"] = True
+        return result
+    for other in INJECTION_DIR.iterdir():
+        if other.name != part.filename and not other.name.startswith(".") and other.is_file() \
+                and other.stat().st_size == part.size and injection_sha256(other) == digest:
+            result["duplicate_of"] = other.name
+            break
+    try:
+        os.replace(part.tmp_path, target)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        # Runtime and storage on different filesystems: copy the finished file next to
+        # its target, so the rename into place stays atomic
+        staged = INJECTION_DIR / f".upload-{uuid.uuid4().hex}.tmp"
+        try:
+            shutil.copyfile(part.tmp_path, staged)
+            os.replace(staged, target)
+        finally:
+            staged.unlink(missing_ok=True)
+            part.tmp_path.unlink(missing_ok=True)
+    return result
+
+@app.post("/api/upload_injection")
+async def upload_injection(request: Request, username: str = Depends(get_current_username)):
+    """Accepts one or more files (multipart field 'file' or 'files')."""
+    content_type, params = parse_options_header(request.headers.get("content-type", ""))
+    if content_type != b"multipart/form-data" or b"boundary" not in params:
+        raise HTTPException(status_code=400, detail="Expected multipart/form-data")
+    limit = int(get_config_snapshot().config.get("max_injection_upload_mb", 64)) * 1024 * 1024
+
+    parts: List[_UploadPart] = []
+    state = {"part": None, "error": None}
+
+    def on_part_begin():
+        state["part"] = _UploadPart()
+
+    def on_header_field(data, start, end):
+        state["part"].header_field += data[start:end]
+
+    def on_header_value(data, start, end):
+        state["part"].header_value += data[start:end]
+
+    def on_header_end():
+        part = state["part"]
+        part.headers[part.header_field.decode("latin-1").lower()] = part.header_value.decode("utf-8", "replace")
+        part.header_field, part.header_value = b"", b""
+
+    def on_headers_finished():
+        part = state["part"]
+        _, disposition = parse_options_header(part.headers.get("content-disposition", ""))
+        if b"filename" in disposition:
+            part.filename = _safe_injection_name(disposition[b"filename"].decode("utf-8", "replace"))
+            if part.filename is None:
+                state["error"] = (400, "Invalid file name")
+            parts.append(part)
+
+    def on_part_data(data, start, end):
+        part = state["part"]
+        if part not in parts or state["error"]:
+            return # Plain form fields are ignored
+        chunk = data[start:end]
+        part.size += len(chunk)
+        if part.size > limit:
+            state["error"] = (413, f"{part.filename} exceeds the {limit // (1024 * 1024)} MB upload limit")
+            return
+        part.sha256.update(chunk)
+        part.buffer.append(chunk)
+
+    parser = MultipartParser(params[b"boundary"], {
+        "on_part_begin": on_part_begin, "on_header_field": on_header_field,
+        "on_header_value": on_header_value, "on_header_end": on_header_end,
+        "on_headers_finished": on_headers_finished, "on_part_data": on_part_data,
+    })
+    try:
+        async for chunk in request.stream():
+            parser.write(chunk)
+            if state["error"]:
+                raise HTTPException(status_code=state["error"][0], detail=state["error"][1])
+            pending = [p for p in parts if p.buffer]
+            if pending:
+                await run_bulk(lambda: [p.flush() for p in pending])
+        parser.finalize()
+        if not parts:
+            raise HTTPException(status_code=400, detail="No file in upload")
+        results = [await run_bulk(_commit_upload, part) for part in parts]
+    except HTTPException:
+        for part in parts:
+            await run_bulk(part.discard)
+        raise
+    except Exception as e:
+        for part in parts:
+            await run_bulk(part.discard)
+        return {"status": "error", "message": str(e)}
+    return {"status": "success", "filename": results[0]["filename"], "files": results}
+
+# --- Injection Templates ---
+# Injection files ending in .j2 are Jinja templates, rendered per client at
+# /injections/render/<mac>/<name without .j2> so one kickstart or user-data
+# serves a whole rollout. Compiled templates are cached by content hash, and
+# rendered output by (template hash, MAC, settings version, client revision):
+# editing the template or the client drops exactly the entries it affects.
+
+TEMPLATE_SUFFIX = ".j2"
+BUILTIN_TEMPLATES = {
+    # cloud-init's NoCloud source fetches meta-data next to user-data
+    "meta-data": "instance-id: {{ mac | replace(':', '') }}\nlocal-hostname: {{ hostname }}\n",
+}
+TEMPLATE_RENDERS = Counter("pxe_injection_renders_total", "Templated injection requests by cache result.", ("result",))
+
+class LruCache:
+    def __init__(self, size: int):
+        self.size = size
+        self.lock = threading.Lock()
+        self.entries: "OrderedDict[Any, Any]" = OrderedDict()
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+_TEMPLATE_ENV = SandboxedEnvironment(undefined=StrictUndefined, keep_trailing_newline=True)
+_COMPILED_TEMPLATES = LruCache(256)
+_RENDERED_INJECTIONS = LruCache(4096)
+
+def client_injection_url(client: Dict, server_ip: str) -> tuple:
+    """(served name, URL) for a client's injection file; templates go through the brain."""
+    name = client['injection_file']
+    if name.endswith(TEMPLATE_SUFFIX):
+        name = name[:-len(TEMPLATE_SUFFIX)]
+        return name, f"http://{server_ip}:8000/injections/render/{normalize_mac(client['mac'])}/{quote(name)}"
+    return name, f"http://{server_ip}/injections/{name}"
+
+def template_context(snapshot: ConfigSnapshot, client: Dict) -> Dict[str, Any]:
+    mac = normalize_mac(client['mac'])
+    # Never the whole config: it holds the admin password
+    return {
+        "client": client,
+        "vars": client.get("vars") or {},
+        "mac": mac,
+        "hostname": client.get("hostname") or f"pxe-{mac.replace(':', '')}",
+        "image": client['image'],
+        "server_ip": snapshot.config.get("server_ip", "127.0.0.1"),
+        "boot_url": boot_url(snapshot.config),
+    }
+
+def render_injection(snapshot: ConfigSnapshot, client: Dict, name: str) -> Optional[tuple]:
+    """(text, etag) of name rendered for client, or None if name is not a template. Raises TemplateError."""
+    path = INJECTION_DIR / f"{name}{TEMPLATE_SUFFIX}"
+    digest = injection_sha256(path) # Memoized by size and mtime, so this is a stat on a hit
+    if digest is None:
+        if name not in BUILTIN_TEMPLATES:
+            return None
+        digest = f"builtin:{name}"
+    mac = normalize_mac(client['mac'])
+    key = (digest, mac, snapshot.settings_version, snapshot.client_revisions.get(mac))
+    hit = _RENDERED_INJECTIONS.get(key)
+    if hit is not None:
+        TEMPLATE_RENDERS.inc("hit")
+        return hit
+    template = _COMPILED_TEMPLATES.get(digest)
+    if template is None:
+        source = BUILTIN_TEMPLATES[name] if digest.startswith("builtin:") else path.read_text()
+        template = _TEMPLATE_ENV.from_string(source)
+        _COMPILED_TEMPLATES.put(digest, template)
+        TEMPLATE_RENDERS.inc("compiled")
+    else:
+        TEMPLATE_RENDERS.inc("rendered")
+    text = template.render(template_context(snapshot, client))
+    hit = (text, f'"{hashlib.sha1(text.encode()).hexdigest()[:20]}"')
+    _RENDERED_INJECTIONS.put(key, hit)
+    return hit
+
+@app.get("/injections/render/{mac}/{name}", response_class=PlainTextResponse)
+@off_loop
+def render_injection_file(request: Request, mac: str, name: str):
+    # Unauthenticated like /injections: installers fetch it mid-boot
+    snapshot = get_config_snapshot()
+    client = snapshot.find_client(mac)
+    if not client or _safe_injection_name(name) != name:
+        raise HTTPException(status_code=404, detail="Not found")
+    try:
+        rendered = render_injection(snapshot, client, name)
+    except TemplateError as e:
+        raise HTTPException(status_code=422, detail=f"Template {name}{TEMPLATE_SUFFIX}: {e}")
+    if rendered is None:
+        # Plain files are served as-is, so templated and static parts can sit side by side
+        if (INJECTION_DIR / name).is_file():
+            return FileResponse(INJECTION_DIR / name)
+        raise HTTPException(status_code=404, detail="Not found")
+    return script_response(request, *rendered)
+
+# Mounted after the render route, which it would otherwise shadow
+app.mount("/injections", StaticFiles(directory=INJECTION_DIR), name="injections")
+
+# --- HTTP SAN ---
+# iPXE can sanboot a raw image over HTTP instead of iSCSI. Images are mapped
+# once and shared by every request; each range gets a WILLNEED read-ahead hint
+# and is copied out of the page cache on a bulk pool thread. Servers offering the
+# ASGI zerocopysend extension get the file descriptor for sendfile() instead.
+# Mappings are dropped once idle, replaced, or pushed out by newer ones, so a
+# deleted image's space is not pinned by a forgotten file descriptor.
+
+SAN_PROTOCOLS = ("iscsi", "http")
+SAN_CHUNK = 1024 * 1024
+SAN_MAX_RANGES = 64
+SAN_MAX_IMAGES = 32
+SAN_IDLE_SECONDS = 600
+HTTP_SAN_FORMATS = (".img", ".vhd") # .img is raw; .vhd only when fixed (raw data plus a footer)
+VHD_FOOTER = struct.Struct(">8s52xI") # cookie, ..., disk type at offset 60
+VHD_FIXED = 2
+
+def fixed_vhd_data_size(path: Path) -> Optional[int]:
+    """Size of the raw data area if path is a fixed VHD, else None (dynamic and
+    differencing VHDs are block-mapped and cannot be served byte-for-byte)."""
+    try:
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < 512:
+                return None
+            f.seek(size - 512)
+            cookie, disk_type = VHD_FOOTER.unpack(f.read(VHD_FOOTER.size))
+    except (OSError, struct.error):
+        return None
+    return size - 512 if cookie == b"conectix" and disk_type == VHD_FIXED else None
+
+def http_san_capable(path: Path) -> bool:
+    if path.name.endswith(".vhd"):
+        return fixed_vhd_data_size(path) is not None
+    return path.name.endswith(HTTP_SAN_FORMATS)
+
+class _MappedImage:
+    def __init__(self, path: Path):
+        self.file = open(path, "rb")
+        st = os.fstat(self.file.fileno())
+        self.stamp = (st.st_ino, st.st_size, st.st_mtime_ns)
+        self.size = st.st_size
+        if path.name.endswith(".vhd"):
+            self.size = fixed_vhd_data_size(path)
+            if self.size is None:
+                self.file.close()
+                raise ValueError(f"{path.name} is not a fixed VHD")
+        self.mtime = st.st_mtime
+        self.used = time.monotonic()
+        self.map = None
+        if self.size:
+            self.map = mmap.mmap(self.file.fileno(), 0, prot=mmap.PROT_READ)
+            if hasattr(self.map, "madvise"):
+                # Guests read scattered blocks; each range is prefetched explicitly instead
+                self.map.madvise(mmap.MADV_RANDOM)
+        self.etag = f'"{st.st_ino:x}-{st.st_size:x}-{st.st_mtime_ns:x}"'
+
+    def prefetch(self, start: int, length: int):
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(self.file.fileno(), start, length, os.POSIX_FADV_WILLNEED)
+
+_SAN_IMAGES: "OrderedDict[str, _MappedImage]" = OrderedDict()
+_SAN_LOCK = threading.Lock()
+
+def _evict_san_images(now: float):
+    """Drops idle and surplus mappings, least recently used first. Caller holds _SAN_LOCK.
+    In-flight requests keep their mapping alive until they finish."""
+    while _SAN_IMAGES:
+        key, image = next(iter(_SAN_IMAGES.items()))
+        if len(_SAN_IMAGES) <= SAN_MAX_IMAGES and now - image.used < SAN_IDLE_SECONDS:
+            break
+        del _SAN_IMAGES[key]
+
+def open_san_image(path: Path) -> _MappedImage:
+    """Returns a shared mapping of path, remapping if the file was replaced."""
+    st = path.stat()
+    key = str(path)
+    now = time.monotonic()
+    with _SAN_LOCK:
+        image = _SAN_IMAGES.get(key)
+        if image is None or image.stamp != (st.st_ino, st.st_size, st.st_mtime_ns):
+            image = _SAN_IMAGES[key] = _MappedImage(path)
+        image.used = now
+        _SAN_IMAGES.move_to_end(key)
+        _evict_san_images(now)
+        return image
+
+def parse_ranges(header: str, size: int) -> Optional[List[tuple]]:
+    """Parses 'bytes=a-b,c-,-n' into [(start, end inclusive)]. None means unsatisfiable."""
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes":
+        return None
+    ranges = []
+    for part in spec.split(","):
+        first, sep, last = part.strip().partition("-")
+        if not sep:
+            return None
+        try:
+            if first:
+                start = int(first)
+                end = min(int(last), size - 1) if last else size - 1
+            else:
+                start, end = max(size - int(last), 0), size - 1
+        except ValueError:
+            return None
+        if start > end or start >= size:
+            continue # Unsatisfiable members are dropped (RFC 9110 14.1.2)
+        ranges.append((start, end))
+    if not ranges or len(ranges) > SAN_MAX_RANGES:
+        return None
+    return ranges
+
+class SanResponse(Response):
+    def __init__(self, image: _MappedImage, ranges: Optional[List[tuple]], head: bool):
+        super().__init__(status_code=206 if ranges else 200)
+        self.image = image
+        self.ranges = ranges
+        self.head = head
+        self.boundary = uuid.uuid4().hex
+        self.parts = []
+        headers = {"Accept-Ranges": "bytes", "ETag": image.etag,
+                   "Last-Modified": time.strftime("%a, %d %b %Y %H:%M:%S GMT", time.gmtime(image.mtime))}
+        if not ranges:
+            self.parts = [(b"", 0, image.size - 1)]
+            headers["Content-Type"] = "application/octet-stream"
+        elif len(ranges) == 1:
+            start, end = ranges[0]
+            self.parts = [(b"", start, end)]
+            headers["Content-Type"] = "application/octet-stream"
+            headers["Content-Range"] = f"bytes {start}-{end}/{image.size}"
+        else:
+            for start, end in ranges:
+                preamble = (f"\r\n--{self.boundary}\r\nContent-Type: application/octet-stream\r\n"
+                            f"Content-Range: bytes {start}-{end}/{image.size}\r\n\r\n").encode()
+                self.parts.append((preamble, start, end))
+            headers["Content-Type"] = f"multipart/byteranges; boundary={self.boundary}"
+        self.epilogue = f"\r\n--{self.boundary}--\r\n".encode() if ranges and len(ranges) > 1 else b""
+        length = sum(len(p) + max(0, e - s + 1) for p, s, e in self.parts) + len(self.epilogue)
+        headers["Content-Length"] = str(length)
+        self.init_headers(headers)
+
+    async def __call__(self, scope, receive, send):
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        if self.head or self.image.size == 0:
+            await send({"type": "http.response.body", "body": b""})
+            return
+        zerocopy = "http.response.zerocopysend" in scope.get("extensions", {})
+        for preamble, start, end in self.parts:
+            if preamble:
+                await send({"type": "http.response.body", "body": preamble, "more_body": True})
+            self.image.prefetch(start, end - start + 1)
+            if zerocopy:
+                await send({"type": "http.response.zerocopysend", "file": self.image.file,
+                            "offset": start, "count": end - start + 1, "more_body": True})
+                continue
+            position = start
+            while position <= end:
+                stop = min(position + SAN_CHUNK, end + 1)
+                chunk = await run_bulk(self.image.map.__getitem__, slice(position, stop))
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+                position = stop
+        await send({"type": "http.response.body", "body": self.epilogue})
+
+@app.api_route("/san/{image_path:path}", methods=["GET", "HEAD"])
+async def san_image(request: Request, image_path: str):
+    """Read-only block access to raw images under VHD_DIR for iPXE 'sanboot http://'."""
+    base = VHD_DIR.resolve()
+    target = (VHD_DIR / image_path).resolve()
+    if not str(target).startswith(str(base) + os.sep) or not target.name.endswith(HTTP_SAN_FORMATS):
+        raise HTTPException(status_code=404, detail="Not found")
+    try:
+        image = await run_bulk(open_san_image, target)
+    except (FileNotFoundError, IsADirectoryError):
+        raise HTTPException(status_code=404, detail="Not found")
+    except ValueError as e:
+        raise HTTPException(status_code=415, detail=str(e))
+    ranges = None
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if range_header and (not if_range or if_range == image.etag):
+        ranges = parse_ranges(range_header, image.size)
+        if ranges is None:
+            return Response(status_code=416, headers={"Content-Range": f"bytes */{image.size}"})
+    return SanResponse(image, ranges, request.method == "HEAD")
+
+def san_http_url(config: Dict, image: str) -> str:
+    base = config.get("san_http_url") or f"http://{config.get('server_ip', '127.0.0.1')}:8000/san"
+    return f"{base.rstrip('/')}/{quote(image)}"
+
+# --- Boot Logic (Next-Gen) ---
+
+# Rendered scripts are cached per (inputs, config version, asset index version)
+# and tagged with a content ETag, so repeat chains cost a dict lookup.
+MENU_CACHE_SIZE = 1024
+_MENU_CACHE: "OrderedDict[tuple, tuple]" = OrderedDict()
+_MENU_CACHE_LOCK = threading.Lock()
+
+def menu_item_id(path: str) -> str:
+    """Stable iPXE label for a path; unlike hash() it survives restarts and workers."""
+    return hashlib.sha1(path.encode()).hexdigest()[:12]
+
+def peek_script(key: tuple) -> Optional[tuple]:
+    """Returns (script, etag) for key if cached, else None; never renders."""
+    with _MENU_CACHE_LOCK:
+        hit = _MENU_CACHE.get(key)
+        if hit is not None:
+            _MENU_CACHE.move_to_end(key)
+    if hit is not None:
+        SCRIPT_CACHE.inc("hit")
+    return hit
+
+def cached_script(key: Optional[tuple], render) -> tuple:
+    """Returns (script, etag) for key, calling render() only on a miss. A None key never caches."""
+    hit = None
+    if key is not None:
+        with _MENU_CACHE_LOCK:
+            hit = _MENU_CACHE.get(key)
+            if hit is not None:
+                _MENU_CACHE.move_to_end(key)
+    if hit is not None:
+        SCRIPT_CACHE.inc("hit")
+        return hit
+    SCRIPT_CACHE.inc("miss")
+    script = render()
+    hit = (script, f'"{hashlib.sha1(script.encode()).hexdigest()[:20]}"')
+    if key is None:
+        return hit
+    with _MENU_CACHE_LOCK:
+        _MENU_CACHE[key] = hit
+        while len(_MENU_CACHE) > MENU_CACHE_SIZE:
+            _MENU_CACHE.popitem(last=False)
+    return hit
+
+def script_response(request: Request, script: str, etag: str) -> Response:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        tags = [t.strip().removeprefix("W/") for t in if_none_match.split(",")]
+        if etag in tags or "*" in tags:
+            return Response(status_code=304, headers={"ETag": etag})
+    return PlainTextResponse(script, headers={"ETag": etag})
+
+# --- Admission Control ---
+# A lab powering on at once asks for every ISO and every iSCSI disk in the
+# same second. With admission_control on, per-MAC boots take a slot from a
+# budget per boot type; over budget, the client gets a script that sleeps a
+# jittered backoff and re-chains. Slots are freed by a release fetch once the
+# downloads are done (memdisk and wimboot, which load everything before
+# booting) or when the lease runs out (iSCSI, whose load follows sanboot, and
+# Linux kernel boots, which fetch their root filesystem after the kernel
+# starts). State lives in SQLite on local disk, so every worker on a node
+# draws on the same budget; with several nodes, budgets apply per node.
+# Interactive menu boots are not queued.
+
+# Not under CLUSTER_DIR: that may be shared storage, where SQLite locking is unreliable
+ADMISSION_DB = Path(os.environ.get("SUPER_PXE_ADMISSION_DB", RUNTIME_ROOT / "run" / "admission.db"))
+ADMISSION_CLASSES = ("memdisk", "kernel", "iscsi")
+ADMISSION_WAIT = Histogram("pxe_admission_wait_seconds", "Time from first queued request to admission.", ("class",))
+ADMISSION = Counter("pxe_admission_total", "Per-MAC boot admission decisions.", ("class", "result"))
+Gauge("pxe_admission_active", "Boots holding an admission slot.", ("class",),
+      collect=lambda: {(c,): v["active"] for c, v in admission.classes().items()})
+Gauge("pxe_admission_waiting", "Clients queued for an admission slot.", ("class",),
+      collect=lambda: {(c,): v["waiting"] for c, v in admission.classes().items()})
+
+class AdmissionController:
+    # A waiting row expires at twice the backoff its client was told to sleep:
+    # a client that has not re-chained by then gave up
+    SCHEMA_VERSION = 2
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS leases (mac TEXT PRIMARY KEY, class TEXT NOT NULL,
+                                           admitted REAL NOT NULL, expires REAL NOT NULL);
+        CREATE TABLE IF NOT EXISTS waiting (mac TEXT PRIMARY KEY, class TEXT NOT NULL,
+                                            since REAL NOT NULL, expires REAL NOT NULL);
+    """
+    MAX_BACKOFF = 60
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.local = threading.local()
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA synchronous=OFF") # Leases are worthless after a crash anyway
+            if conn.execute("PRAGMA user_version").fetchone()[0] != self.SCHEMA_VERSION:
+                # Nothing here outlives a boot storm, so older layouts are simply dropped
+                conn.executescript(f"DROP TABLE IF EXISTS leases; DROP TABLE IF EXISTS waiting; {self.SCHEMA}"
+                                   f"PRAGMA user_version = {self.SCHEMA_VERSION};")
+            self.local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            now = time.time()
+            conn.execute("DELETE FROM leases WHERE expires < ?", (now,))
+            conn.execute("DELETE FROM waiting WHERE expires < ?", (now,))
+            yield conn, now
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def admit(self, mac: str, boot_class: str, config: Dict) -> Optional[tuple]:
+        """None if the boot may go ahead, else (queue position, backoff seconds) for the wait script."""
+        budget = int(config.get("admission_budgets", {}).get(boot_class, 0))
+        if budget <= 0:
+            return None
+        lease = int(config.get("admission_lease", {}).get(boot_class, 60))
+        with self._transaction() as (conn, now):
+            if conn.execute("SELECT 1 FROM leases WHERE mac = ?", (mac,)).fetchone():
+                return None # Already admitted; iPXE retried a failed download
+            row = conn.execute("SELECT since FROM waiting WHERE mac = ?", (mac,)).fetchone()
+            since = row[0] if row else now
+            active = conn.execute("SELECT COUNT(*) FROM leases WHERE class = ?", (boot_class,)).fetchone()[0]
+            # Earlier arrivals keep their place even if a newcomer retries first
+            ahead = conn.execute("SELECT COUNT(*) FROM waiting WHERE class = ? AND since < ? AND mac != ?",
+                                 (boot_class, since, mac)).fetchone()[0]
+            if active + ahead < budget:
+                conn.execute("INSERT INTO leases VALUES (?, ?, ?, ?)", (mac, boot_class, now, now + lease))
+                conn.execute("DELETE FROM waiting WHERE mac = ?", (mac,))
+                ADMISSION.inc(boot_class, "admitted")
+                ADMISSION_WAIT.observe(now - since, boot_class)
+                return None
+            position = ahead + 1
+            delay = admission_backoff(config, position, budget)
+            conn.execute("INSERT OR REPLACE INTO waiting VALUES (?, ?, ?, ?)",
+                         (mac, boot_class, since, now + 2 * delay))
+        ADMISSION.inc(boot_class, "queued")
+        return position, delay
+
+    def release(self, mac: str) -> bool:
+        with self._transaction() as (conn, _):
+            return conn.execute("DELETE FROM leases WHERE mac = ?", (mac,)).rowcount > 0
+
+    def classes(self) -> Dict[str, Dict[str, int]]:
+        result = {c: {"active": 0, "waiting": 0} for c in ADMISSION_CLASSES}
+        conn = self._conn()
+        now = time.time()
+        for boot_class, count in conn.execute(
+                "SELECT class, COUNT(*) FROM leases WHERE expires >= ? GROUP BY class", (now,)):
+            result.setdefault(boot_class, {"active": 0, "waiting": 0})["active"] = count
+        for boot_class, count in conn.execute(
+                "SELECT class, COUNT(*) FROM waiting WHERE expires >= ? GROUP BY class", (now,)):
+            result.setdefault(boot_class, {"active": 0, "waiting": 0})["waiting"] = count
+        return result
+
+    def report(self, config: Dict) -> Dict[str, Any]:
+        now = time.time()
+        conn = self._conn()
+        classes = self.classes()
+        for boot_class, counts in classes.items():
+            counts["budget"] = int(config.get("admission_budgets", {}).get(boot_class, 0))
+        return {
+            "enabled": bool(config.get("admission_control")),
+            "classes": classes,
+            "active": [{"mac": mac, "class": c, "held_seconds": round(now - admitted, 1)} for mac, c, admitted in
+                       conn.execute("SELECT mac, class, admitted FROM leases WHERE expires >= ? ORDER BY admitted",
+                                    (now,))],
+            "waiting": [{"mac": mac, "class": c, "waited_seconds": round(now - since, 1)} for mac, c, since in
+                        conn.execute("SELECT mac, class, since FROM waiting WHERE expires >= ? ORDER BY since",
+                                     (now,))],
+        }
+
+admission = AdmissionController(ADMISSION_DB)
+
+def client_boot_class(client: Dict) -> str:
+    if client.get('type') == 'vhd':
+        return "iscsi" # HTTP SAN too: the master is read the same way, just over another port
+    stamp = iso_stamp(client['image'])
+    manifest = iso_boot.lookup(client['image'], stamp) if stamp is not None else None
+    return "kernel" if manifest and manifest.get("profile") else "memdisk"
+
+def admission_release_lines(client: Dict, server_ip: str) -> List[str]:
+    """Frees the client's slot as soon as its ISO or wimboot files are downloaded, not when the lease ends."""
+    if not get_config_snapshot().config.get("admission_control"):
+        return []
+    url = f"http://{server_ip}:8000/boot/release?mac={normalize_mac(client['mac'])}"
+    return [f"imgfetch --name released {url} && imgfree released || echo Could not release boot slot"]
+
+def admission_backoff(config: Dict, position: int, budget: int) -> int:
+    # Later waves sleep longer, and jitter keeps one wave from re-chaining in lockstep
+    base = int(config.get("admission_backoff", 5)) * min(8, 1 + (position - 1) // budget)
+    return max(1, min(AdmissionController.MAX_BACKOFF, round(base * random.uniform(0.5, 1.5))))
+
+def admission_wait_script(client: Dict, boot_class: str, config: Dict, position: int, delay: int) -> str:
+    return "\n".join([
+        "#!ipxe",
+        f"echo Boot queue ({boot_class}): position {position}, retrying in {delay}s",
+        f"sleep {delay}",
+        f"chain {brain_boot_url(config)}?mac={normalize_mac(client['mac'])}", # Past nginx, back into the queue
+    ])
+
+@app.get("/boot/release", response_class=PlainTextResponse)
+@off_loop
+def release_boot_slot(mac: str):
+    admission.release(normalize_mac(mac))
+    return PlainTextResponse("#!ipxe\n") # Fetched as an image and freed straight away
+
+@app.get("/api/admission")
+@off_loop
+def get_admission(username: str = Depends(get_current_username)):
+    return admission.report(get_config_snapshot().config)
+
+def menu_dirs(type: str) -> List[Path]:
+    return ([ISO_DIR] if type in ("root", "iso") else []) + ([VHD_DIR] if type in ("root", "vhd") else [])
+
+def menu_key(snapshot: ConfigSnapshot, path: str, type: str, versions: tuple) -> tuple:
+    return ("menu", path, type, snapshot.settings_version) + versions
+
+def menu_response(request: Request, script: str, etag: str, path: str, type: str, mac: Optional[str]) -> Response:
+    response = script_response(request, script, etag)
+    outcome = "not_modified" if response.status_code == 304 else "unknown_mac" if mac else "served"
+    BOOTS.inc("menu", type if type in ("root", "iso", "vhd") else "other", outcome)
+    events.emit("menu", path=path[:256], kind=type[:16], mac=mac and mac[:32], outcome=outcome) # Unauthenticated input
+    return response
+
+def cached_menu_response(request: Request, path: str, type: str, mac: Optional[str]) -> Optional[Response]:
+    """Answers a menu from memory alone, or returns None if that needs I/O: a known
+    client (admission, overlays), an unwatched or missing listing, or a cold script."""
+    snapshot = get_config_snapshot()
+    if mac and snapshot.find_client(mac):
+        return None
+    versions = (ASSET_INDEX.version, iso_boot.version)
+    if any(ASSET_INDEX.cached(d, path) is None for d in menu_dirs(type)):
+        return None
+    hit = peek_script(menu_key(snapshot, path, type, versions))
+    if hit is None:
+        return None
+    return menu_response(request, *hit, path, type, mac)
+
+@app.get("/boot.ipxe", response_class=PlainTextResponse)
+async def get_menu(request: Request, path: str = "", type: str = "root", mac: Optional[str] = None):
+    # Boot storms are mostly repeat menu hits; those skip the disk pool entirely
+    response = cached_menu_response(request, path, type, mac)
+    if response is None:
+        response = await run_disk(boot_response, request, path, type, mac)
+    return response
+
+def boot_response(request: Request, path: str, type: str, mac: Optional[str]) -> Response:
+    snapshot = get_config_snapshot()
+    config = snapshot.config
     server_ip = config.get("server_ip", "127.0.0.1")
-    timeout = config.get("boot_timeout", 10) * 1000 
-    title = config.get("menu_title", "Super PXE Server")
 
     # 1. Client-Specific Auto-Boot
     if mac:
-        mac_norm = mac.lower().replace("-", ":")
-        for client in config.get("clients", []):
-            if client['mac'].lower() == mac_norm:
-                return generate_client_boot_script(client, server_ip)
+        client = snapshot.find_client(mac)
+        if client:
+            overlay_state = ensure_client_overlay(client) # Side effects here, never inside a cached render
+            if config.get("admission_control") and overlay_state in (None, OVERLAY_READY):
+                boot_class = client_boot_class(client)
+                queued = admission.admit(normalize_mac(client['mac']), boot_class, config)
+                if queued is not None:
+                    BOOTS.inc("client", client.get('type'), "queued")
+                    events.emit("boot", mac=client['mac'], hostname=client.get('hostname'), image=client['image'],
+                                kind=client.get('type'), boot_class=boot_class, outcome="queued", position=queued[0])
+                    return PlainTextResponse(admission_wait_script(client, boot_class, config, *queued))
+            script, etag = cached_script(
+                ("client", normalize_mac(client['mac'])) + client_script_key(snapshot, client, overlay_state),
+                lambda: generate_client_boot_script(client, server_ip))
+            response = script_response(request, script, etag)
+            if response.status_code == 304:
+                outcome = "not_modified"
+            elif overlay_state not in (None, OVERLAY_READY):
+                outcome = "overlay_wait"
+            else:
+                outcome = "served"
+            BOOTS.inc("client", client.get('type'), outcome)
+            events.emit("boot", mac=client['mac'], hostname=client.get('hostname'), image=client['image'],
+                        kind=client.get('type'), outcome=outcome, overlay=overlay_state)
+            return response
 
     # 2. Standard Menu
-    script = ["#!ipxe", f"set timeout {timeout}", f"menu {title} - {path if path else 'Root'}"]
-    if path:
-        script.append(f"item --key 0 back .. Back to Previous")
-
+    versions = (ASSET_INDEX.version, iso_boot.version)
     iso_files, iso_dirs = [], []
     vhd_files, vhd_dirs = [], []
     
@@ -403,23 +4408,70 @@ async def get_menu(request: Request, path: str = "", type: str = "root", mac: Op
     if type == "root" or type == "vhd":
         vhd_files, vhd_dirs = get_directory_contents(VHD_DIR, path)
 
+    # If anything moved while listing (a rescan here, or an invalidation racing a
+    # cached read), the listing may predate the version: render it, cache nothing
+    key = None
+    if (ASSET_INDEX.version, iso_boot.version) == versions:
+        key = menu_key(snapshot, path, type, versions)
+    script, etag = cached_script(
+        key, lambda: render_menu(config, path, type, iso_files, iso_dirs, vhd_files, vhd_dirs))
+    return menu_response(request, script, etag, path, type, mac)
+
+@app.get("/boot/iso.ipxe", response_class=PlainTextResponse)
+@off_loop
+def boot_menu_iso(request: Request, path: str):
+    """A menu entry for an ISO not analysed yet: boots memdisk now, queues extraction for next time."""
+    stamp = iso_stamp(path) if path.endswith(ISO_EXTENSIONS) else None
+    if stamp is None:
+        raise HTTPException(status_code=404, detail="Unknown ISO")
+    snapshot = get_config_snapshot()
+    server_ip = snapshot.config.get("server_ip", "127.0.0.1")
+    script, etag = cached_script(
+        ("iso", path, snapshot.settings_version, iso_boot.version, stamp),
+        lambda: "\n".join(["#!ipxe", f"echo Booting {path}..."] + iso_boot_lines(server_ip, path, stamp, "iso")))
+    response = script_response(request, script, etag)
+    outcome = "not_modified" if response.status_code == 304 else "served"
+    BOOTS.inc("menu", "iso", outcome)
+    events.emit("boot", mac=None, hostname=None, image=path, kind="iso", outcome=outcome)
+    return response
+
+def boot_url(config: Dict) -> str:
+    """Menus chain through nginx when it can answer from the static export."""
+    if config.get("static_boot_export"):
+        return f"http://{config.get('server_ip', '127.0.0.1')}/boot.ipxe"
+    return brain_boot_url(config)
+
+def brain_boot_url(config: Dict) -> str:
+    """The Brain itself, for boots that must never be answered from static files."""
+    return f"http://{config.get('server_ip', '127.0.0.1')}:8000/boot.ipxe"
+
+def render_menu(config: Dict, path: str, type: str, iso_files, iso_dirs, vhd_files, vhd_dirs) -> str:
+    server_ip = config.get("server_ip", "127.0.0.1")
+    menu_url = boot_url(config)
+    timeout = config.get("boot_timeout", 10) * 1000 
+    title = config.get("menu_title", "Super PXE Server")
+
+    script = ["#!ipxe", f"set timeout {timeout}", f"menu {title} - {path if path else 'Root'}"]
+    if path:
+        script.append(f"item --key 0 back .. Back to Previous")
+
     # Directories
     if iso_dirs or vhd_dirs:
         script.append("item --gap -- Directories")
-        for d in iso_dirs: script.append(f"item dir_iso_{hash(d['path'])} [DIR] {d['name']}")
-        for d in vhd_dirs: script.append(f"item dir_vhd_{hash(d['path'])} [DIR] {d['name']}")
+        for d in iso_dirs: script.append(f"item dir_iso_{menu_item_id(d['path'])} [DIR] {d['name']}")
+        for d in vhd_dirs: script.append(f"item dir_vhd_{menu_item_id(d['path'])} [DIR] {d['name']}")
 
     # Files
     if iso_files:
         script.append("item --gap -- ISO Images")
         for f in iso_files:
-            if f['name'].endswith(".iso"): script.append(f"item iso_{hash(f['path'])} {f['name']}")
+            if f['name'].endswith(ISO_EXTENSIONS): script.append(f"item iso_{menu_item_id(f['path'])} {f['name']}")
 
     if vhd_files:
         script.append("item --gap -- VHD Images")
         for f in vhd_files:
-            if any(f['name'].endswith(ext) for ext in [".vhd", ".qcow2", ".img"]):
-                script.append(f"item vhd_{hash(f['path'])} {f['name']}")
+            if f['name'].endswith(VHD_EXTENSIONS):
+                script.append(f"item vhd_{menu_item_id(f['path'])} {f['name']}")
 
     script.append("choose target && goto ${target}")
 
@@ -427,71 +4479,263 @@ async def get_menu(request: Request, path: str = "", type: str = "root", mac: Op
     if path:
         parent_path = os.path.dirname(path)
         script.append(f":back")
-        script.append(f"chain http://{server_ip}:8000/boot.ipxe?path={parent_path}&type={type}")
+        script.append(f"chain {menu_url}?path={parent_path}&type={type}")
     
     for d in iso_dirs:
-        script.append(f":dir_iso_{hash(d['path'])}")
-        script.append(f"chain http://{server_ip}:8000/boot.ipxe?path={d['path']}&type=iso")
+        script.append(f":dir_iso_{menu_item_id(d['path'])}")
+        script.append(f"chain {menu_url}?path={d['path']}&type=iso")
     for d in vhd_dirs:
-        script.append(f":dir_vhd_{hash(d['path'])}")
-        script.append(f"chain http://{server_ip}:8000/boot.ipxe?path={d['path']}&type=vhd")
+        script.append(f":dir_vhd_{menu_item_id(d['path'])}")
+        script.append(f"chain {menu_url}?path={d['path']}&type=vhd")
         
     for f in iso_files:
-        if f['name'].endswith(".iso"):
-            script.append(f":iso_{hash(f['path'])}")
-            script.append(f"initrd http://{server_ip}/storage/isos/{f['path']}")
-            script.append(f"chain http://{server_ip}/tftpboot/memdisk iso raw")
+        if f['name'].endswith(ISO_EXTENSIONS):
+            label = f"iso_{menu_item_id(f['path'])}"
+            script.append(f":{label}")
+            script.extend(iso_boot_lines(server_ip, f['path'], (f['size'], f['mtime']), label, analyse=False))
             
     for f in vhd_files:
-        if any(f['name'].endswith(ext) for ext in [".vhd", ".qcow2", ".img"]):
-            safe_name = f['path'].lower().replace("/", "-").replace("\\", "-").replace("_", "-").replace(".", "-")
-            iqn = f"iqn.2024-01.com.pxeserver:{safe_name}"
-            script.append(f":vhd_{hash(f['path'])}")
+        if f['name'].endswith(VHD_EXTENSIONS):
+            iqn = master_iqn(f['path'])
+            script.append(f":vhd_{menu_item_id(f['path'])}")
             script.append(f"sanboot iscsi:{server_ip}::::{iqn}")
             
     return "\n".join(script)
 
+def client_script_key(snapshot: ConfigSnapshot, client: Dict, overlay_state: Optional[str]) -> tuple:
+    """Everything a client's boot script depends on; other clients' edits leave it alone."""
+    mac = normalize_mac(client['mac'])
+    # An ISO uploaded or replaced after the client was configured must reach lookup() again
+    image = iso_stamp(client['image']) if client.get('type') == 'iso' else None
+    return (snapshot.settings_version, snapshot.client_revisions.get(mac), overlay_state, iso_boot.version, image)
+
+def client_overlay_state(client: Dict) -> Optional[str]:
+    if client.get('type') == 'vhd' and client.get('overlay'):
+        status = overlays.status(client['image'], client['mac'])
+        if status["state"] == OVERLAY_READY and not status.get("exported", True):
+            return OVERLAY_EXPORTING # A sanboot now would hit a target tgtd does not have yet
+        return status["state"]
+    return None
+
+def ensure_client_overlay(client: Dict) -> Optional[str]:
+    """Queues a missing or failed overlay, then returns the boot path's view of it."""
+    state = client_overlay_state(client)
+    if state in (None, OVERLAY_FAILED) and client.get('type') == 'vhd' and client.get('overlay'):
+        overlays.submit(client['image'], client['mac']) # Honours the failure backoff
+        state = client_overlay_state(client)
+    return state
+
+def overlay_wait_script(client: Dict, state: str) -> List[str]:
+    retry_url = f"{boot_url(get_config_snapshot().config)}?mac={normalize_mac(client['mac'])}"
+    if state == OVERLAY_FAILED:
+        status = overlays.status(client['image'], client['mac'])
+        return [f"echo Overlay creation failed: {status['error']}",
+                "echo Retrying in 30 seconds...", "sleep 30", f"chain {retry_url}"]
+    return ["echo Preparing persistent overlay, please wait...", "sleep 5", f"chain {retry_url}"]
+
 def generate_client_boot_script(client: Dict, server_ip: str) -> str:
     script = ["#!ipxe", f"echo Auto-booting client {client['mac']}..."]
     
     if client['type'] == 'iso':
         # Advanced ISO Injection Logic
         script.append(f"echo Loading ISO: {client['image']}")
-        script.append(f"initrd http://{server_ip}/storage/isos/{client['image']}")
         
         # Inject Kernel Args if present
-        kernel_args = client.get('kernel_args', '')
+        kernel_args = client.get('kernel_args') or ''
+        unattend_url = None
         
         # Inject Injection File if present (append to kernel args or as initrd?)
         # For simplicity, we assume standard 'inst.ks' or 'autoinstall' patterns for now.
         if client.get('injection_file'):
-            injection_url = f"http://{server_ip}/injections/{client['injection_file']}"
+            injection_name, injection_url = client_injection_url(client, server_ip)
             script.append(f"echo Injections: {client['injection_file']}")
             # Heuristic: If it looks like a kickstart, append inst.ks
-            if client['injection_file'].endswith(".cfg") or client['injection_file'].endswith(".ks"):
+            if injection_name.endswith(".cfg") or injection_name.endswith(".ks"):
                 kernel_args += f" inst.ks={injection_url}"
             # Heuristic: If it looks like user-data, append ds=nocloud-net...
-            elif "user-data" in client['injection_file']:
+            elif "user-data" in injection_name:
                  kernel_args += f" ds=nocloud-net;s={injection_url.replace('user-data', '')}"
+            # Heuristic: Windows answer files are handed to wimboot as unattend.xml
+            elif injection_name.lower().endswith(".xml"):
+                unattend_url = injection_url
 
-        if kernel_args:
-             script.append(f"imgargs memdisk iso raw {kernel_args}")
-        
-        script.append(f"chain http://{server_ip}/tftpboot/memdisk iso raw")
+        # Kernel args only take effect on the direct kernel path; memdisk ignores them
+        script.extend(iso_boot_lines(server_ip, client['image'], iso_stamp(client['image']), "client",
+                                     kernel_args, unattend_url, admission_release_lines(client, server_ip)))
 
     elif client['type'] == 'vhd':
-        safe_name = client['image'].lower().replace("/", "-").replace("\\", "-").replace("_", "-").replace(".", "-")
-        
+        if client.get('san_protocol') == 'http':
+            if not client.get('overlay') and http_san_capable(VHD_DIR / client['image']):
+                script.append(f"sanboot {san_http_url(get_config_snapshot().config, client['image'])}")
+                return "\n".join(script)
+            # iPXE's HTTP SAN is read-only and raw-only: overlays, qcow2 and dynamic VHDs stay on iSCSI
+            script.append("echo HTTP SAN needs a raw image without overlay, using iSCSI")
         if client.get('overlay'):
+            state = client_overlay_state(client)
+            if state != OVERLAY_READY:
+                # Hold the client until its private disk exists rather than booting the master
+                return "\n".join(script + overlay_wait_script(client, state))
             # Use the specific client target
-            safe_mac = client['mac'].replace(":", "").lower()
-            safe_image = client['image'].lower().replace("/", "-").replace(".", "-")
-            iqn = f"iqn.2024-01.com.pxeserver:{safe_mac}:{safe_image}"
+            iqn = overlay_iqn(client['mac'], client['image'])
             script.append(f"echo Booting with Persistent Overlay...")
         else:
             # Use the generic target
-            iqn = f"iqn.2024-01.com.pxeserver:{safe_name}"
+            iqn = master_iqn(client['image'])
             
         script.append(f"sanboot iscsi:{server_ip}::::{iqn}")
         
-    return "\n".join(script)
\ No newline at end of file
+    return "\n".join(script)
+
+# --- Static Boot Export ---
+# With static_boot_export enabled, the root menu, every directory menu and one
+# script per configured client are pre-rendered under GENERATED_DIR/boot so
+# nginx can answer /boot.ipxe itself and only fall back to the brain on a miss:
+#   boot/clients/<mac>.ipxe          (mac in lowercase colon form)
+#   boot/menu/<type>/<path>/menu.ipxe
+
+STATIC_BOOT_DIR = GENERATED_DIR / "boot"
+
+def write_file_atomic(path: Path, content: str) -> bool:
+    """Writes content via temp file + rename. Returns False if it was already current."""
+    try:
+        if path.read_text() == content:
+            return False
+    except OSError:
+        pass
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    with open(tmp_path, "w") as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+    return True
+
+def render_static_boot_scripts(snapshot: ConfigSnapshot) -> Dict[str, str]:
+    """Returns {relative file path: script} for the whole menu tree and all clients."""
+    config = snapshot.config
+    scripts = {}
+
+    root_listings = get_directory_contents(ISO_DIR) + get_directory_contents(VHD_DIR)
+    root_menu = render_menu(config, "", "root", *root_listings)
+    scripts["menu/menu.ipxe"] = root_menu
+    scripts["menu/root/menu.ipxe"] = root_menu
+
+    for type, base_dir in (("iso", ISO_DIR), ("vhd", VHD_DIR)):
+        pending = [""]
+        while pending:
+            path = pending.pop()
+            files, dirs = get_directory_contents(base_dir, path)
+            if type == "iso":
+                menu = render_menu(config, path, type, files, dirs, [], [])
+            else:
+                menu = render_menu(config, path, type, [], [], files, dirs)
+            scripts[os.path.join("menu", type, path, "menu.ipxe")] = menu
+            pending.extend(d['path'] for d in dirs)
+
+    scripts.update(render_client_boot_scripts(snapshot, snapshot.clients_by_mac))
+    return scripts
+
+def render_client_boot_scripts(snapshot: ConfigSnapshot, macs) -> Dict[str, str]:
+    if snapshot.config.get("admission_control"):
+        # Known clients must pass admission, and a missing file would make nginx answer
+        # with the static menu: export a stub that hands the boot to the Brain
+        url = brain_boot_url(snapshot.config)
+        return {f"clients/{mac}.ipxe": f"#!ipxe\nchain {url}?mac={mac}\n" for mac in macs}
+    server_ip = snapshot.config.get("server_ip", "127.0.0.1")
+    return {f"clients/{mac}.ipxe": generate_client_boot_script(snapshot.clients_by_mac[mac], server_ip)
+            for mac in macs}
+
+def export_static_boot_scripts(snapshot: Optional[ConfigSnapshot] = None):
+    """Brings STATIC_BOOT_DIR in line with the current config and storage."""
+    snapshot = snapshot or get_config_snapshot()
+    if not snapshot.config.get("static_boot_export"):
+        # nginx must fall through to the brain again
+        shutil.rmtree(STATIC_BOOT_DIR, ignore_errors=True)
+        return 0
+    scripts = render_static_boot_scripts(snapshot)
+    written = sum(write_file_atomic(STATIC_BOOT_DIR / rel, content) for rel, content in scripts.items())
+
+    # Remove scripts for deleted clients and directories
+    for root, _, names in os.walk(STATIC_BOOT_DIR, topdown=False):
+        for name in names:
+            rel = os.path.relpath(os.path.join(root, name), STATIC_BOOT_DIR)
+            if rel not in scripts:
+                os.unlink(os.path.join(root, name))
+        if root != str(STATIC_BOOT_DIR) and not os.listdir(root):
+            os.rmdir(root)
+    if written:
+        logger.info(f"Static boot export: {written} of {len(scripts)} scripts updated")
+    return written
+
+def export_client_boot_scripts(snapshot: ConfigSnapshot, macs: List[str], removed: List[str] = ()) -> int:
+    """Rewrites only the given clients' scripts and drops those of removed clients."""
+    scripts = render_client_boot_scripts(snapshot, macs)
+    written = sum(write_file_atomic(STATIC_BOOT_DIR / rel, content) for rel, content in scripts.items())
+    for mac in removed:
+        (STATIC_BOOT_DIR / "clients" / f"{mac}.ipxe").unlink(missing_ok=True)
+    if written or removed:
+        logger.info(f"Static boot export: {written} client scripts updated, {len(removed)} removed")
+    return written
+
+class StaticBootExporter:
+    """Re-exports whenever the config or asset index version moves. When only
+    clients changed, just their scripts are rendered."""
+    INTERVAL = 2.0
+
+    def __init__(self):
+        self.stop_event = threading.Event()
+        self.wake_event = threading.Event()
+        self.thread = None
+        self.exported = None
+        self.exported_clients: Dict[str, tuple] = {}
+
+    def start(self):
+        if self.thread:
+            return
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._run, name="static-export", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.wake_event.set()
+        if self.thread:
+            self.thread.join(timeout=5)
+        self.thread = None
+
+    def schedule(self):
+        self.wake_event.set()
+
+    def _run(self):
+        while not self.stop_event.is_set():
+            try:
+                snapshot = get_config_snapshot()
+                # Listing the roots revalidates them before reading the version
+                get_directory_contents(ISO_DIR)
+                get_directory_contents(VHD_DIR)
+                current = (snapshot.settings_version, ASSET_INDEX.version, iso_boot.version)
+                clients = {mac: client_script_key(snapshot, client, client_overlay_state(client))
+                           for mac, client in snapshot.clients_by_mac.items()}
+                if current != self.exported:
+                    export_static_boot_scripts(snapshot)
+                elif snapshot.config.get("static_boot_export") and clients != self.exported_clients:
+                    export_client_boot_scripts(
+                        snapshot, [m for m, key in clients.items() if self.exported_clients.get(m) != key],
+                        [m for m in self.exported_clients if m not in clients])
+                self.exported = current
+                self.exported_clients = clients
+            except Exception as e:
+                logger.error(f"Static boot export failed: {e}")
+            self.wake_event.wait(self.INTERVAL)
+            self.wake_event.clear()
+
+static_exporter = StaticBootExporter()
+
+if __name__ == "__main__":
+    # Maintenance entry point for deployment scripts; the server itself runs under uvicorn
+    parser = argparse.ArgumentParser(description="Super PXE brain maintenance")
+    parser.add_argument("--server-ip", help="replace the 127.0.0.1 placeholder in the stored settings")
+    args = parser.parse_args()
+    if args.server_ip:
+        changed = apply_server_ip(args.server_ip)
+        print(f"Set {', '.join(changed)} to {args.server_ip} in the {CONFIG_STORE.name} store" if changed
+              else f"No placeholder settings left in the {CONFIG_STORE.name} store")
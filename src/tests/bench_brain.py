@@ -0,0 +1,272 @@
+"""
+Boot-storm benchmark for the Brain API.
+
+Builds a synthetic storage tree and client list in a scratch directory, then
+drives /boot.ipxe (menu and per-MAC), /api/assets and POST /api/config
+concurrently against the in-process app and reports throughput and
+p50/p95/p99 latency per operation. qemu-img and tgt are replaced by no-op
+stand-ins, so no network, root or real images are needed.
+
+    python src/tests/bench_brain.py                       # full run, saves results
+    python src/tests/bench_brain.py --baseline src/tests/bench_baseline.json
+
+With --baseline the run exits non-zero if any operation's p95 latency or
+throughput regresses by more than --tolerance.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import stat
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+TESTS_DIR = Path(__file__).resolve().parent
+BRAIN_DIR = TESTS_DIR.parent / "brain"
+RESULTS_DIR = TESTS_DIR / "bench_results"
+
+# name: (weight in the mixed workload, needs auth)
+OPERATIONS = {
+    "boot_menu": (40, False),
+    "boot_mac": (50, False),
+    "assets": (8, True),
+    "config_post": (2, True),
+}
+
+STAND_IN_TOOLS = {
+    # qemu-img create ... <overlay>: create an empty file at the last argument
+    "qemu-img": '#!/bin/sh\nif [ "$1" = "create" ]; then for last; do :; done; : > "$last"; fi\nexit 0\n',
+    "tgtadm": "#!/bin/sh\nexit 0\n",
+    "tgt-admin": "#!/bin/sh\nexit 0\n",
+}
+
+def install_stand_ins(root: Path):
+    bin_dir = root / "bin"
+    bin_dir.mkdir(parents=True, exist_ok=True)
+    for name, body in STAND_IN_TOOLS.items():
+        tool = bin_dir / name
+        tool.write_text(body)
+        tool.chmod(tool.stat().st_mode | stat.S_IEXEC)
+    os.environ["PATH"] = f"{bin_dir}{os.pathsep}{os.environ.get('PATH', '')}"
+
+def build_storage(runtime: Path, isos: int, vhds: int, fanout: int):
+    """Spreads images over <fanout> top-level dirs with one nested level each."""
+    def populate(base: Path, count: int, ext: str):
+        for i in range(count):
+            bucket = i % (fanout + 1)
+            if bucket == fanout:
+                folder = base # Some images live at the root
+            else:
+                folder = base / f"group{bucket:03d}" / f"sub{(i // fanout) % 4}"
+            folder.mkdir(parents=True, exist_ok=True)
+            with open(folder / f"image{i:05d}{ext}", "wb") as f:
+                f.truncate(1024 * 1024) # Sparse; size is all the brain looks at
+    populate(runtime / "storage" / "isos", isos, ".iso")
+    populate(runtime / "storage" / "vhds", vhds, ".img")
+
+def build_config(config_file: Path, runtime: Path, clients: int, overlay_ratio: float):
+    vhd_root = runtime / "storage" / "vhds"
+    vhd_images = sorted(str(p.relative_to(vhd_root)) for p in vhd_root.rglob("*.img"))[:50]
+    iso_root = runtime / "storage" / "isos"
+    iso_images = sorted(str(p.relative_to(iso_root)) for p in iso_root.rglob("*.iso"))[:50]
+    entries = []
+    for i in range(clients):
+        mac = ":".join(f"{b:02x}" for b in (0x52, 0x54, 0x00, (i >> 16) & 0xff, (i >> 8) & 0xff, i & 0xff))
+        if vhd_images and i % 2:
+            entries.append({"mac": mac, "image": vhd_images[i % len(vhd_images)], "type": "vhd",
+                            "overlay": random.random() < overlay_ratio, "hostname": f"lab-{i:05d}"})
+        else:
+            entries.append({"mac": mac, "image": iso_images[i % len(iso_images)], "type": "iso",
+                            "hostname": f"lab-{i:05d}"})
+    config_file.write_text(json.dumps({
+        "server_ip": "10.0.0.1",
+        "dhcp_next_server": "10.0.0.1",
+        "iscsi_allowed_initiators": "ALL",
+        "boot_timeout": 10,
+        "menu_title": "Benchmark",
+        "image_index_interval": 0, # Hashing 20k stand-ins would swamp the boot path and vary run to run
+        "admin_password": "admin",
+        "clients": entries,
+    }))
+    return entries
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+async def run_workload(app, args, macs, dirs, config_body):
+    import httpx
+
+    transport = httpx.ASGITransport(app=app)
+    auth = ("admin", "admin")
+    names = list(OPERATIONS)
+    weights = [OPERATIONS[n][0] for n in names]
+    if args.only:
+        weights = [w if n in args.only else 0 for n, w in zip(names, weights)]
+    samples = {name: [] for name in names}
+    errors = {name: 0 for name in names}
+    rng = random.Random(args.seed)
+
+    async def request(http, name):
+        if name == "boot_menu":
+            path, kind = rng.choice(dirs)
+            return await http.get("/boot.ipxe", params={"path": path, "type": kind})
+        if name == "boot_mac":
+            return await http.get("/boot.ipxe", params={"mac": rng.choice(macs)})
+        if name == "assets":
+            return await http.get("/api/assets", auth=auth)
+        return await http.post("/api/config", json=config_body, auth=auth)
+
+    async def worker(http, deadline):
+        while time.perf_counter() < deadline:
+            name = rng.choices(names, weights)[0]
+            started = time.perf_counter()
+            response = await request(http, name)
+            elapsed = time.perf_counter() - started
+            if response.status_code >= 400:
+                errors[name] += 1
+            samples[name].append(elapsed)
+
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as http:
+        # Warm-up pass so first-touch scans are not mistaken for steady state
+        for name in names:
+            await request(http, name)
+        started = time.perf_counter()
+        deadline = started + args.duration
+        await asyncio.gather(*(worker(http, deadline) for _ in range(args.concurrency)))
+        wall = time.perf_counter() - started
+
+    results = {}
+    for name in names:
+        values = sorted(samples[name])
+        if not values:
+            continue
+        results[name] = {
+            "requests": len(values),
+            "errors": errors[name],
+            "throughput_rps": round(len(values) / wall, 2),
+            "p50_ms": round(percentile(values, 50) * 1000, 3),
+            "p95_ms": round(percentile(values, 95) * 1000, 3),
+            "p99_ms": round(percentile(values, 99) * 1000, 3),
+        }
+    total = sum(r["requests"] for r in results.values())
+    return {"wall_seconds": round(wall, 3), "total_rps": round(total / wall, 2), "operations": results}
+
+def compare(results, baseline, tolerance):
+    """Returns a list of human-readable regressions against baseline."""
+    regressions = []
+    for name, base in baseline.get("operations", {}).items():
+        current = results["operations"].get(name)
+        if not current:
+            continue
+        if current["p95_ms"] > base["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{name}: p95 {current['p95_ms']}ms vs baseline {base['p95_ms']}ms")
+        if current["throughput_rps"] < base["throughput_rps"] * (1 - tolerance):
+            regressions.append(f"{name}: {current['throughput_rps']} rps vs baseline {base['throughput_rps']} rps")
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--isos", type=int, default=10000)
+    parser.add_argument("--vhds", type=int, default=10000)
+    parser.add_argument("--fanout", type=int, default=50, help="top-level directories per storage root")
+    parser.add_argument("--clients", type=int, default=3000)
+    parser.add_argument("--overlay-ratio", type=float, default=0.2)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds of measured load")
+    parser.add_argument("--only", nargs="+", choices=list(OPERATIONS), help="restrict the mix")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", type=Path, help="results file (default: bench_results/<timestamp>.json)")
+    parser.add_argument("--no-save", action="store_true")
+    parser.add_argument("--baseline", type=Path, help="fail on regressions against this results file")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    args = parser.parse_args(argv)
+
+    random.seed(args.seed)
+    scratch = Path(tempfile.mkdtemp(prefix="super-pxe-bench-"))
+    try:
+        return run_bench(args, scratch)
+    finally:
+        for worker in multiprocessing.active_children(): # Spawned indexers import brain, recreating runtime dirs
+            worker.join(timeout=30)
+        shutil.rmtree(scratch, ignore_errors=True) # Tens of thousands of stand-in images
+
+def run_bench(args, scratch):
+    runtime = scratch / "runtime"
+    config_file = scratch / "config.json"
+    install_stand_ins(scratch)
+    os.environ["SUPER_PXE_RUNTIME_ROOT"] = str(runtime)
+    os.environ["SUPER_PXE_CONFIG_FILE"] = str(config_file)
+
+    setup_started = time.perf_counter()
+    build_storage(runtime, args.isos, args.vhds, args.fanout)
+    clients = build_config(config_file, runtime, args.clients, args.overlay_ratio)
+    setup_seconds = time.perf_counter() - setup_started
+    config_body = json.loads(config_file.read_text()) # Read before the brain migrates it into its store
+
+    sys.path.insert(0, str(BRAIN_DIR))
+    import brain
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    dirs = [("", "root")]
+    for kind, base in (("iso", brain.ISO_DIR), ("vhd", brain.VHD_DIR)):
+        dirs += [(str(p.relative_to(base)), kind) for p in base.rglob("*") if p.is_dir()]
+    macs = [c["mac"] for c in clients]
+
+    async def run():
+        startup_started = time.perf_counter()
+        await brain.startup_event()
+        startup_seconds = time.perf_counter() - startup_started
+        await asyncio.to_thread(brain.warmup.wait) # Measure steady state, not warm-up
+        ready_seconds = time.perf_counter() - startup_started
+        try:
+            return startup_seconds, ready_seconds, await run_workload(brain.app, args, macs, dirs, config_body)
+        finally:
+            await brain.shutdown_event()
+
+    startup_seconds, ready_seconds, results = asyncio.run(run())
+    results.update({
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "host": {"python": platform.python_version(), "machine": platform.machine(), "cpus": os.cpu_count()},
+        "params": {k: v for k, v in vars(args).items() if k in
+                   ("isos", "vhds", "fanout", "clients", "overlay_ratio", "concurrency", "duration", "only", "seed")},
+        "setup_seconds": round(setup_seconds, 3),
+        "startup_seconds": round(startup_seconds, 3),
+        "ready_seconds": round(ready_seconds, 3),
+    })
+
+    print(f"{'operation':<12} {'requests':>9} {'errors':>7} {'rps':>10} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for name, r in results["operations"].items():
+        print(f"{name:<12} {r['requests']:>9} {r['errors']:>7} {r['throughput_rps']:>10} "
+              f"{r['p50_ms']:>9} {r['p95_ms']:>9} {r['p99_ms']:>9}")
+    print(f"total {results['total_rps']} rps over {results['wall_seconds']}s, startup {results['startup_seconds']}s, "
+          f"ready {results['ready_seconds']}s")
+
+    if not args.no_save:
+        output = args.output or RESULTS_DIR / f"{time.strftime('%Y%m%d-%H%M%S')}.json"
+        output.parent.mkdir(parents=True, exist_ok=True)
+        output.write_text(json.dumps(results, indent=4))
+        print(f"Results saved to {output}")
+
+    if any(r["errors"] for r in results["operations"].values()):
+        print("FAIL: requests returned errors")
+        return 1
+    if args.baseline:
+        regressions = compare(results, json.loads(args.baseline.read_text()), args.tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        if regressions:
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,6 +1,21 @@
 import sys
 import os
+import io
+import json
+import time
+import shutil
+import struct
+import hashlib
+import sqlite3
+import asyncio
+import threading
+import mmap
+import concurrent.futures
+import fcntl
+import subprocess
+import tempfile
 from pathlib import Path
+import pytest
 from fastapi.testclient import TestClient
 
 # Add the 'brain' directory to sys.path
@@ -9,10 +24,21 @@ current_dir = Path(__file__).resolve().parent
 brain_dir = current_dir.parent / "brain"
 sys.path.append(str(brain_dir))
 
+# Keep test runs away from the checked-in config and the real runtime tree
+TEST_ROOT = Path(tempfile.mkdtemp(prefix="super-pxe-test-"))
+os.environ["SUPER_PXE_RUNTIME_ROOT"] = str(TEST_ROOT / "runtime")
+os.environ["SUPER_PXE_CONFIG_FILE"] = str(TEST_ROOT / "config.json")
+
+import brain
 from brain import app
 
 client = TestClient(app)
 
+@pytest.fixture(scope="module", autouse=True)
+def remove_test_root():
+    yield
+    shutil.rmtree(TEST_ROOT, ignore_errors=True)
+
 def test_read_root_unauthorized():
     """Test that the root endpoint requires authentication."""
     response = client.get("/")
@@ -59,3 +85,1185 @@ def test_api_assets_protected():
     data = response.json()
     assert "isos" in data
     assert "vhds" in data
+
+def test_boot_ipxe_client_lookup_by_mac():
+    """Test that a configured client is found regardless of MAC formatting."""
+    config = brain.load_config()
+    config["clients"] = [{"mac": "AA:BB:CC:DD:EE:01", "image": "tools/rescue.iso", "type": "iso"}]
+    brain.save_config(config)
+
+    for mac in ["aa:bb:cc:dd:ee:01", "AA-BB-CC-DD-EE-01", "aabbccddee01"]:
+        response = client.get("/boot.ipxe", params={"mac": mac})
+        assert response.status_code == 200
+        assert "Auto-booting client AA:BB:CC:DD:EE:01" in response.text
+
+    response = client.get("/boot.ipxe", params={"mac": "aa:bb:cc:dd:ee:02"})
+    assert "Auto-booting" not in response.text
+
+def test_config_snapshot_reloads_on_external_edit():
+    """Test that the cached config picks up edits made outside save_config()."""
+    before = brain.get_config_snapshot()
+    assert brain.get_config_snapshot() is before
+
+    if brain.CONFIG_STORE.name == "json":
+        data = json.loads(brain.CONFIG_FILE.read_text())
+        data["menu_title"] = "Edited Outside The Brain"
+        brain.CONFIG_FILE.write_text(json.dumps(data) + "\n" * 8)
+    else:
+        # e.g. another worker or the sqlite3 shell
+        with sqlite3.connect(brain.CONFIG_DB) as conn:
+            conn.execute("INSERT OR REPLACE INTO settings VALUES ('menu_title', ?)",
+                         (json.dumps("Edited Outside The Brain"),))
+
+    after = brain.get_config_snapshot()
+    assert after.version > before.version
+    assert "Edited Outside The Brain" in client.get("/boot.ipxe").text
+
+def test_sqlite_store_migrates_legacy_json(tmp_path):
+    """Test the one-time config.json import and that saves only touch changed rows."""
+    legacy = tmp_path / "config.json"
+    clients = [{"mac": "AA-BB-CC-00-00-0%d" % i, "image": "w.img", "type": "vhd", "overlay": i < 2}
+               for i in range(4)]
+    legacy.write_text(json.dumps({"menu_title": "Old", "clients": clients}))
+
+    store = brain.SqliteConfigStore(tmp_path / "config.db", legacy_json=legacy)
+    assert legacy.exists() # Left in place for a rollback
+    with sqlite3.connect(tmp_path / "config.db") as conn:
+        assert conn.execute("SELECT value FROM meta WHERE key = 'migrated_from_json'").fetchone()
+    config = store.load()
+    assert config["menu_title"] == "Old" and config["clients"] == clients
+    assert store.get_client("aabbcc000003")["mac"] == "AA-BB-CC-00-00-03"
+    assert store.overlay_count() == 2 and store.overlay_count(exclude_macs=["aa:bb:cc:00:00:00"]) == 1
+
+    stamp = store.stamp()
+    config["clients"][3]["overlay"] = True
+    assert store.save(config) == stamp + 1 # One row rewritten
+    assert store.save(config) == stamp + 1 # Nothing changed, nothing written
+    assert store.overlay_count() == 3
+
+    # Reopening does not import again
+    legacy.write_text(json.dumps({"menu_title": "Stale"}))
+    assert brain.SqliteConfigStore(tmp_path / "config.db", legacy_json=legacy).load()["menu_title"] == "Old"
+
+def test_sqlite_store_avoids_wal_on_network_filesystems(tmp_path, monkeypatch, caplog):
+    """Test that a store on shared storage uses a rollback journal, since WAL only works on one host."""
+    assert brain.filesystem_type(tmp_path) is not None
+    assert brain.SqliteConfigStore(tmp_path / "local.db")._conn().execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+
+    monkeypatch.setattr(brain, "filesystem_type", lambda path: "nfs4")
+    store = brain.SqliteConfigStore(tmp_path / "shared.db")
+    assert store._conn().execute("PRAGMA journal_mode").fetchone()[0] == "delete"
+    assert "WAL does not work across hosts" in caplog.text
+    store.save({"menu_title": "Shared"})
+    assert store.load()["menu_title"] == "Shared"
+
+def test_apply_server_ip_replaces_placeholder():
+    """Test the entrypoint's SERVER_IP hook against whichever store is active."""
+    original = brain.load_config()
+    try:
+        brain.save_config({**original, "server_ip": "127.0.0.1", "dhcp_next_server": "10.0.0.9",
+                           "san_http_url": "http://127.0.0.1:8000/san"})
+        assert sorted(brain.apply_server_ip("10.0.0.5")) == ["san_http_url", "server_ip"]
+        config = brain.load_config()
+        assert config["server_ip"] == "10.0.0.5" and config["dhcp_next_server"] == "10.0.0.9"
+        assert config["san_http_url"] == "http://10.0.0.5:8000/san"
+        assert brain.apply_server_ip("10.0.0.6") == [] # Only the placeholder is replaced
+    finally:
+        brain.save_config(original)
+
+def test_asset_index_tracks_storage_changes():
+    """Test that cached listings notice added files, with and without a watcher."""
+    (brain.ISO_DIR / "first.iso").write_bytes(b"\0" * 16)
+    names = [f["name"] for f in brain.ISO_CACHE]
+    assert "first.iso" in names
+
+    (brain.ISO_DIR / "second.iso").write_bytes(b"\0" * 16)
+    assert "second.iso" in [f["name"] for f in brain.ISO_CACHE]
+
+    brain.ASSET_INDEX.start_watcher("auto")
+    try:
+        files, _ = brain.get_directory_contents(brain.ISO_DIR)
+        version = brain.ASSET_INDEX.version
+        (brain.ISO_DIR / "third.iso").write_bytes(b"\0" * 16)
+        for _ in range(50):
+            if brain.ASSET_INDEX.version != version:
+                break
+            time.sleep(0.1)
+        assert "third.iso" in [f["name"] for f in brain.ISO_CACHE]
+    finally:
+        brain.ASSET_INDEX.stop_watcher()
+        for name in ["first.iso", "second.iso", "third.iso"]:
+            (brain.ISO_DIR / name).unlink()
+
+def test_boot_ipxe_etag_and_stable_ids():
+    """Test that menus carry stable item IDs and honour If-None-Match."""
+    (brain.ISO_DIR / "stable.iso").write_bytes(b"\0" * 16)
+    try:
+        response = client.get("/boot.ipxe")
+        assert response.status_code == 200
+        assert f"item iso_{brain.menu_item_id('stable.iso')} stable.iso" in response.text
+        etag = response.headers["etag"]
+
+        cached = client.get("/boot.ipxe", headers={"If-None-Match": etag})
+        assert cached.status_code == 304
+        assert cached.headers["etag"] == etag
+
+        (brain.ISO_DIR / "another.iso").write_bytes(b"\0" * 16)
+        changed = client.get("/boot.ipxe", headers={"If-None-Match": etag})
+        assert changed.status_code == 200
+        assert changed.headers["etag"] != etag
+    finally:
+        (brain.ISO_DIR / "stable.iso").unlink()
+        (brain.ISO_DIR / "another.iso").unlink(missing_ok=True)
+
+def test_menu_cache_hits_stay_on_event_loop(monkeypatch):
+    """Test that a warm menu is answered without the disk pool, and a cold one still works."""
+    brain.ASSET_INDEX.start_watcher("auto")
+    try:
+        client.get("/boot.ipxe") # Scans under the watcher, which bumps the version mid-render
+        first = client.get("/boot.ipxe").text
+        async def no_pool(func, *args, **kwargs):
+            raise AssertionError(f"{func.__name__} went to the disk pool")
+        with monkeypatch.context() as m:
+            m.setattr(brain, "run_disk", no_pool)
+            assert client.get("/boot.ipxe").text == first
+            # A cold script is not served from memory...
+            with pytest.raises(AssertionError, match="boot_response"):
+                client.get("/boot.ipxe", params={"type": "vhd", "path": "nowhere"})
+        # ...but renders normally on the pool
+        assert client.get("/boot.ipxe", params={"type": "vhd", "path": "nowhere"}).status_code == 200
+    finally:
+        brain.ASSET_INDEX.stop_watcher()
+
+def test_menu_cache_survives_invalidation_during_listing(monkeypatch):
+    """Test that a listing invalidated while the menu renders is not cached under the new version."""
+    client.get("/boot.ipxe", params={"type": "iso"})
+    stale = brain.get_directory_contents(brain.ISO_DIR)
+    (brain.ISO_DIR / "race.iso").write_bytes(b"\0" * 16)
+    try:
+        def racing_listing(base_dir, sub_path=""):
+            # We read the old listing, then the watcher fires and another request rescans
+            brain.ASSET_INDEX.invalidate_all()
+            brain.ASSET_INDEX.listing(base_dir, sub_path)
+            return stale
+        monkeypatch.setattr(brain, "get_directory_contents", racing_listing)
+        assert "race.iso" not in client.get("/boot.ipxe", params={"type": "iso"}).text
+        monkeypatch.undo()
+        assert "race.iso" in client.get("/boot.ipxe", params={"type": "iso"}).text
+    finally:
+        (brain.ISO_DIR / "race.iso").unlink()
+
+def test_static_boot_export():
+    """Test that the exported tree mirrors the dynamic scripts and tracks removals."""
+    (brain.ISO_DIR / "nested").mkdir()
+    (brain.ISO_DIR / "nested" / "deep.iso").write_bytes(b"\0" * 16)
+    config = brain.load_config()
+    config["static_boot_export"] = True
+    config["clients"] = [{"mac": "AA:BB:CC:DD:EE:03", "image": "nested/deep.iso", "type": "iso"}]
+    brain.save_config(config)
+    try:
+        brain.export_static_boot_scripts() # The client script queues analysis of its ISO
+        assert wait_for(lambda: not brain.iso_boot.pending)
+        brain.export_static_boot_scripts()
+        boot_dir = brain.STATIC_BOOT_DIR
+        assert (boot_dir / "menu" / "menu.ipxe").read_text() == client.get("/boot.ipxe").text
+        nested = client.get("/boot.ipxe", params={"path": "nested", "type": "iso"}).text
+        assert (boot_dir / "menu" / "iso" / "nested" / "menu.ipxe").read_text() == nested
+        assert "chain http://127.0.0.1/boot.ipxe?" in nested
+        assert "nested/deep.iso" in (boot_dir / "clients" / "aa:bb:cc:dd:ee:03.ipxe").read_text()
+
+        config["clients"] = []
+        brain.save_config(config)
+        brain.export_static_boot_scripts()
+        assert not (boot_dir / "clients").exists()
+
+        config["static_boot_export"] = False
+        brain.save_config(config)
+        brain.export_static_boot_scripts()
+        assert not boot_dir.exists()
+    finally:
+        brain.save_config(brain.DEFAULT_CONFIG.copy())
+        shutil.rmtree(brain.ISO_DIR / "nested")
+
+def test_benchmark_harness_smoke():
+    """Test that the boot-storm benchmark still runs end to end at a tiny scale."""
+    result = subprocess.run(
+        [sys.executable, str(current_dir / "bench_brain.py"), "--isos", "20", "--vhds", "20",
+         "--fanout", "3", "--clients", "10", "--duration", "0.5", "--concurrency", "4", "--no-save"],
+        capture_output=True, text=True, timeout=120,
+    )
+    assert result.returncode == 0, result.stdout + result.stderr
+    assert "boot_mac" in result.stdout
+
+def wait_for(predicate, timeout=5.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.05)
+    return predicate()
+
+def test_overlay_provisioned_in_background(monkeypatch):
+    """Test that overlay clients are held back until their overlay exists, then booted from it."""
+    bin_dir = TEST_ROOT / "bin"
+    bin_dir.mkdir(exist_ok=True)
+    qemu_img = bin_dir / "qemu-img"
+    qemu_img.write_text('#!/bin/sh\nsleep 0.3\nfor last; do :; done\n: > "$last"\n')
+    qemu_img.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+
+    (brain.VHD_DIR / "golden.img").write_bytes(b"\0" * 16)
+    mac = "aa:bb:cc:dd:ee:06"
+    body = brain.load_config()
+    body["clients"] = [{"mac": mac, "image": "golden.img", "type": "vhd", "overlay": True}]
+    try:
+        response = client.post("/api/config", json=body, auth=("admin", "admin"))
+        assert response.status_code == 200
+
+        waiting = client.get("/boot.ipxe", params={"mac": mac}).text
+        assert "sanboot" not in waiting
+        assert f"chain http://127.0.0.1:8000/boot.ipxe?mac={mac}" in waiting
+
+        assert wait_for(lambda: client.get("/api/overlays", auth=("admin", "admin")).json()[0]["state"] == "ready")
+        assert wait_for(lambda: "sanboot" in client.get("/boot.ipxe", params={"mac": mac}).text)
+        booting = client.get("/boot.ipxe", params={"mac": mac}).text
+        assert "sanboot iscsi:127.0.0.1::::iqn.2024-01.com.pxeserver:aabbccddee06:golden-img" in booting
+        assert "aabbccddee06" in (brain.GENERATED_DIR / "targets.conf").read_text() # Exported before booted
+
+        # Ready on disk is not enough: the boot waits until a targets sync has applied the IQN
+        monkeypatch.setattr(brain.overlays, "on_ready", [])
+        overlay = brain.overlay_path_for("golden.img", mac)
+        brain.overlays.jobs.pop(overlay.name)
+        overlay.unlink()
+        client.get("/boot.ipxe", params={"mac": mac}) # Queues it again
+        assert wait_for(lambda: brain.overlays.status("golden.img", mac)["state"] == "ready")
+        assert brain.client_overlay_state(body["clients"][0]) == brain.OVERLAY_EXPORTING
+        assert "sanboot" not in client.get("/boot.ipxe", params={"mac": mac}).text
+        brain.request_targets_refresh()
+        assert "sanboot" in client.get("/boot.ipxe", params={"mac": mac}).text
+    finally:
+        brain.save_config(brain.DEFAULT_CONFIG.copy())
+        (brain.VHD_DIR / "golden.img").unlink()
+        for overlay in brain.OVERLAY_DIR.glob("*"):
+            overlay.unlink()
+
+def test_overlay_failure_never_falls_back_to_master():
+    """Test that a failed overlay keeps the client off the shared master."""
+    mac = "aa:bb:cc:dd:ee:07"
+    config = brain.load_config()
+    config["clients"] = [{"mac": mac, "image": "missing.img", "type": "vhd", "overlay": True}]
+    brain.save_config(config)
+    try:
+        client.get("/boot.ipxe", params={"mac": mac})
+        assert wait_for(lambda: brain.overlays.status("missing.img", mac)["state"] == "failed")
+        script = client.get("/boot.ipxe", params={"mac": mac}).text
+        assert "Overlay creation failed" in script
+        assert "sanboot" not in script
+    finally:
+        brain.save_config(brain.DEFAULT_CONFIG.copy())
+
+def test_targets_applied_incrementally(monkeypatch):
+    """Test that only changed targets reach tgtd and targets.conf is rewritten in full."""
+    bin_dir = TEST_ROOT / "bin"
+    bin_dir.mkdir(exist_ok=True)
+    calls = TEST_ROOT / "tgtadm.log"
+    tgtadm = bin_dir / "tgtadm"
+    tgtadm.write_text(f'#!/bin/sh\necho "$*" >> {calls}\n')
+    tgtadm.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+    monkeypatch.setattr(brain.targets, "live", None)
+
+    vhds = [{"path": "a.img", "full_path": "/srv/a.img"}]
+    diff = brain.generate_iscsi_config_full(vhds, [])
+    assert diff["added"] == [brain.master_iqn("a.img")]
+    calls.write_text("")
+
+    vhds.append({"path": "b.img", "full_path": "/srv/b.img"})
+    diff = brain.generate_iscsi_config_full(vhds, [])
+    assert diff == {"added": [brain.master_iqn("b.img")], "removed": [], "changed": []}
+    ops = calls.read_text().splitlines()
+    assert len(ops) == 3 # new target, new LUN, bind ACL
+    assert all("--tid 2" in op for op in ops)
+
+    calls.write_text("")
+    diff = brain.generate_iscsi_config_full(vhds[1:], [], "10.0.0.5")
+    assert diff["removed"] == [brain.master_iqn("a.img")]
+    assert diff["changed"] == [brain.master_iqn("b.img")]
+    ops = calls.read_text()
+    assert "--op delete --tid 1" in ops
+    assert "--op unbind --tid 2 -I ALL" in ops and "--op bind --tid 2 -I 10.0.0.5" in ops
+    conf = (brain.GENERATED_DIR / "targets.conf").read_text()
+    assert "a.img" not in conf and "initiator-address 10.0.0.5" in conf
+
+def make_iso(path: Path, files: dict):
+    """Writes a plain ISO9660 image (uppercase 8.3 names, no extensions) holding files."""
+    sector = 2048
+    tree = {"": {}}
+    for rel in files:
+        parts = rel.split("/")
+        for i in range(1, len(parts)):
+            tree.setdefault("/".join(parts[:i]), {})
+        tree["/".join(parts[:-1])][parts[-1]] = rel
+    for d in tree:
+        if d:
+            tree[os.path.dirname(d)][os.path.basename(d)] = None
+    dir_sector = {d: 18 + i for i, d in enumerate(sorted(tree))}
+    file_sector, next_free = {}, 18 + len(tree)
+    for rel, data in files.items():
+        file_sector[rel] = next_free
+        next_free += max(1, -(-len(data) // sector))
+
+    def record(name: bytes, extent: int, size: int, is_dir: bool) -> bytes:
+        rec = bytearray(33 + len(name) + (1 - len(name) % 2))
+        rec[0] = len(rec)
+        struct.pack_into("<I", rec, 2, extent)
+        struct.pack_into(">I", rec, 6, extent)
+        struct.pack_into("<I", rec, 10, size)
+        struct.pack_into(">I", rec, 14, size)
+        rec[25] = 2 if is_dir else 0
+        rec[32] = len(name)
+        rec[33:33 + len(name)] = name
+        return bytes(rec)
+
+    image = bytearray(next_free * sector)
+    pvd = bytearray(sector)
+    pvd[0:6] = b"\x01CD001"
+    pvd[40:72] = b"TESTISO".ljust(32)
+    pvd[156:190] = record(b"\x00", dir_sector[""], sector, True)
+    image[16 * sector:17 * sector] = pvd
+    image[17 * sector:17 * sector + 6] = b"\xffCD001"
+    for d, children in tree.items():
+        body = record(b"\x00", dir_sector[d], sector, True) + record(b"\x01", dir_sector[d], sector, True)
+        for name, rel in sorted(children.items()):
+            if rel is None:
+                body += record(name.upper().encode(), dir_sector[os.path.join(d, name) if d else name], sector, True)
+            else:
+                body += record(name.upper().encode() + b".;1", file_sector[rel], len(files[rel]), False)
+        image[dir_sector[d] * sector:dir_sector[d] * sector + len(body)] = body
+    for rel, data in files.items():
+        image[file_sector[rel] * sector:file_sector[rel] * sector + len(data)] = data
+    path.write_bytes(bytes(image))
+
+def test_linux_iso_boots_extracted_kernel():
+    """Test that a recognised Linux ISO is booted via its extracted kernel and initrd."""
+    kernel, initrd = os.urandom(5000), os.urandom(9000)
+    make_iso(brain.ISO_DIR / "ubuntu.iso", {"casper/vmlinuz": kernel, "casper/initrd": initrd, "readme": b"hi"})
+    config = brain.load_config()
+    config["clients"] = [{"mac": "aa:bb:cc:dd:ee:08", "image": "ubuntu.iso", "type": "iso", "kernel_args": "quiet"}]
+    brain.save_config(config)
+    try:
+        # Listing the ISO in a menu does not analyse it; choosing it does
+        first = client.get("/boot.ipxe").text
+        assert "chain http://127.0.0.1:8000/boot/iso.ipxe?path=ubuntu.iso" in first
+        time.sleep(0.2)
+        assert not [k for k in (*brain.iso_boot.manifests, *brain.iso_boot.pending) if k[0] == "ubuntu.iso"]
+        assert "memdisk" in client.get("/boot/iso.ipxe", params={"path": "ubuntu.iso"}).text
+        assert wait_for(lambda: "kernel http://127.0.0.1/storage/cache/iso/" in client.get("/boot.ipxe").text)
+
+        stamp = brain.iso_stamp("ubuntu.iso")
+        manifest = brain.iso_boot.lookup("ubuntu.iso", stamp)
+        assert manifest["profile"] == "ubuntu-casper"
+        cache_dir = brain.ISO_CACHE_DIR / manifest["fingerprint"]
+        assert (cache_dir / "casper" / "vmlinuz").read_bytes() == kernel
+        assert (cache_dir / "casper" / "initrd").read_bytes() == initrd
+
+        script = client.get("/boot.ipxe", params={"mac": "aa:bb:cc:dd:ee:08"}).text
+        assert "url=http://127.0.0.1/storage/isos/ubuntu.iso quiet" in script
+        assert "initrd --name initrd" in script
+        assert "chain http://127.0.0.1/tftpboot/memdisk iso raw" in script # Fallback stays
+
+        # Turning the feature off applies to ISOs already analysed, without a restart
+        config = brain.load_config()
+        config["iso_kernel_boot"] = False
+        brain.save_config(config)
+        script = client.get("/boot.ipxe", params={"mac": "aa:bb:cc:dd:ee:08"}).text
+        assert "kernel " not in script and "memdisk" in script
+
+        # The same path and size with a new mtime is a different ISO
+        assert brain.iso_boot.lookup("ubuntu.iso", (stamp[0], stamp[1] + 1), analyse=False) is None
+    finally:
+        brain.save_config(brain.DEFAULT_CONFIG.copy())
+        (brain.ISO_DIR / "ubuntu.iso").unlink()
+
+def test_client_iso_uploaded_or_replaced_after_configuration():
+    """Test that a client's cached script follows its ISO appearing and being replaced."""
+    iso = brain.ISO_DIR / "late.iso"
+    config = brain.load_config()
+    config["clients"] = [{"mac": "aa:bb:cc:dd:ee:18", "image": "late.iso", "type": "iso"}]
+    brain.save_config(config)
+    boot = lambda: client.get("/boot.ipxe", params={"mac": "aa:bb:cc:dd:ee:18"}).text
+    try:
+        assert "memdisk" in boot() and "kernel http" not in boot()
+        make_iso(iso, {"casper/vmlinuz": os.urandom(3000), "casper/initrd": os.urandom(3000)})
+        assert wait_for(lambda: "kernel http" in boot())
+        first = brain.iso_fingerprint(iso)
+        assert f"/storage/cache/iso/{first}/" in boot()
+
+        # Replaced atomically, as an upload does: the new fingerprint is served
+        make_iso(brain.ISO_DIR / ".late.iso.tmp", {"casper/vmlinuz": os.urandom(4000), "casper/initrd": os.urandom(4000)})
+        os.replace(brain.ISO_DIR / ".late.iso.tmp", iso)
+        second = brain.iso_fingerprint(iso)
+        assert second != first
+        assert wait_for(lambda: f"/storage/cache/iso/{second}/" in boot())
+    finally:
+        brain.save_config(brain.DEFAULT_CONFIG.copy())
+        iso.unlink(missing_ok=True)
+
+def test_iso_extraction_waits_for_other_extractor():
+    """Test that a second worker or node waits on the per-ISO lock and reuses the first one's result."""
+    iso = brain.ISO_DIR / "shared.iso"
+    make_iso(iso, {"casper/vmlinuz": os.urandom(3000), "casper/initrd": os.urandom(3000)})
+    fingerprint = brain.iso_fingerprint(iso)
+    cache_dir = brain.ISO_CACHE_DIR / fingerprint
+    brain.ISO_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    result = {}
+    try:
+        with open(brain.ISO_CACHE_DIR / f".{fingerprint}.lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX) # Another node is extracting
+            worker = threading.Thread(target=lambda: result.update(brain.iso_boot._load_or_extract(iso)))
+            worker.start()
+            time.sleep(0.3)
+            assert worker.is_alive() and not cache_dir.exists()
+            cache_dir.mkdir()
+            (cache_dir / "manifest.json").write_text(json.dumps({"fingerprint": fingerprint, "profile": "other"}))
+        worker.join(5)
+        assert result["profile"] == "other" # Read, not extracted again
+        assert not (cache_dir / "casper").exists()
+    finally:
+        iso.unlink()
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+def test_windows_iso_boots_with_wimboot():
+    """Test that Windows media are booted via wimboot from files extracted out of UDF."""
+    pycdlib = pytest.importorskip("pycdlib")
+    iso = pycdlib.PyCdlib()
+    iso.new(udf="2.60", interchange_level=3)
+    files = {"/bootmgr": b"B" * 4000, "/boot/bcd": b"C" * 3000, "/boot/boot.sdi": b"S" * 2500,
+             "/sources/boot.wim": os.urandom(70000)}
+    iso.add_directory("/BOOT", udf_path="/boot")
+    iso.add_directory("/SOURCES", udf_path="/sources")
+    for i, (udf_path, data) in enumerate(files.items()):
+        iso.add_fp(io.BytesIO(data), len(data), f"/F{i}.;1", udf_path=udf_path)
+    iso.write(str(brain.ISO_DIR / "win11.iso"))
+    iso.close()
+
+    config = brain.load_config()
+    config["clients"] = [{"mac": "aa:bb:cc:dd:ee:09", "image": "win11.iso", "type": "iso",
+                          "injection_file": "unattend.xml"}]
+    brain.save_config(config)
+    try:
+        assert wait_for(lambda: "tftpboot/wimboot" in client.get("/boot.ipxe", params={"mac": "aa:bb:cc:dd:ee:09"}).text)
+        script = client.get("/boot.ipxe", params={"mac": "aa:bb:cc:dd:ee:09"}).text
+        manifest = brain.iso_boot.lookup("win11.iso", brain.iso_stamp("win11.iso"))
+        cache_url = f"http://127.0.0.1/storage/cache/iso/{manifest['fingerprint']}"
+        assert f"initrd -n boot.wim {cache_url}/sources/boot.wim" in script
+        assert f"initrd -n BCD {cache_url}/boot/bcd" in script
+        assert "initrd -n unattend.xml http://127.0.0.1/injections/unattend.xml" in script
+        cache_dir = brain.ISO_CACHE_DIR / manifest["fingerprint"]
+        assert (cache_dir / "sources" / "boot.wim").read_bytes() == files["/sources/boot.wim"]
+    finally:
+        brain.save_config(brain.DEFAULT_CONFIG.copy())
+        (brain.ISO_DIR / "win11.iso").unlink()
+
+def listed(base, rel):
+    """A file as directory listings describe it."""
+    st = (base / rel).stat()
+    return {"path": rel, "size": st.st_size, "mtime": st.st_mtime_ns, "inode": st.st_ino}
+
+def test_image_metadata_index():
+    """Test background checksumming, format detection, duplicates, truncation and rename carry-over."""
+    auth = ("admin", "admin")
+    disk = bytearray(os.urandom(256 * 1024))
+    disk[510:512] = b"\x55\xaa"
+    (brain.VHD_DIR / "meta").mkdir()
+    (brain.VHD_DIR / "meta" / "disk.img").write_bytes(disk)
+    (brain.VHD_DIR / "meta" / "copy.img").write_bytes(disk)
+    qcow2 = bytearray(4096)
+    struct.pack_into(">4sIQIIQ", qcow2, 0, b"QFI\xfb", 3, 0, 0, 16, 10 * 1024 ** 3)
+    (brain.VHD_DIR / "meta" / "thin.qcow2").write_bytes(qcow2)
+    make_iso(brain.ISO_DIR / "meta.iso", {"casper/vmlinuz": b"k", "casper/initrd": b"i"})
+    broken = bytearray((brain.ISO_DIR / "meta.iso").read_bytes())
+    struct.pack_into("<I", broken, 16 * 2048 + 80, len(broken) // 2048 + 100) # Claims more sectors than exist
+    (brain.ISO_DIR / "broken.iso").write_bytes(broken)
+    try:
+        assert brain.image_index.sync() == 5
+        assert wait_for(lambda: not brain.image_index.pending, timeout=60)
+        assert brain.image_index.sync() == 0 # Unchanged files are never re-read
+
+        vhds = {f["name"]: f["meta"] for f in client.get("/api/assets", auth=auth,
+                                                         params={"type": "vhd", "path": "meta"}).json()["vhds"]}
+        assert vhds["disk.img"]["sha256"] == hashlib.sha256(disk).hexdigest()
+        assert vhds["disk.img"]["layout"] == "mbr"
+        assert vhds["disk.img"]["duplicates"] == ["vhd/meta/copy.img"]
+        assert vhds["thin.qcow2"]["format"] == "qcow2" and vhds["thin.qcow2"]["virtual_size"] == 10 * 1024 ** 3
+
+        isos = {f["name"]: f["meta"] for f in client.get("/api/assets", auth=auth, params={"type": "iso"}).json()["isos"]}
+        assert isos["meta.iso"]["format"] == "iso9660" and isos["meta.iso"]["os"] == "ubuntu-casper"
+        assert isos["meta.iso"]["volume_id"] == "TESTISO" and isos["meta.iso"]["error"] is None
+        assert isos["broken.iso"]["error"].startswith("Truncated")
+
+        summary = client.get("/api/images", auth=auth).json()
+        assert summary["images"] == 5 and summary["pending"] == 0
+        assert summary["duplicates"][0]["paths"] == ["vhd/meta/copy.img", "vhd/meta/disk.img"]
+        assert summary["errors"] == [{"path": "iso/broken.iso", "error": isos["broken.iso"]["error"]}]
+
+        # A rename keeps inode, size and mtime, so the row follows without re-hashing
+        os.rename(brain.VHD_DIR / "meta" / "copy.img", brain.VHD_DIR / "meta" / "moved.img")
+        assert brain.image_index.sync() == 0
+        assert brain.image_index.lookup("vhd", [listed(brain.VHD_DIR, "meta/moved.img")])["meta/moved.img"]
+
+        # Written in place at the same size (qemu-img commit, a SAN-booted master): stale until re-indexed
+        with open(brain.VHD_DIR / "meta" / "disk.img", "r+b") as f:
+            f.write(b"\xff" * 4096)
+        os.utime(brain.VHD_DIR / "meta" / "disk.img", ns=(time.time_ns(), time.time_ns() + 10 ** 9))
+        assert not brain.image_index.lookup("vhd", [listed(brain.VHD_DIR, "meta/disk.img")])
+        brain.ASSET_INDEX.invalidate_all()
+        vhds = {f["name"]: f["meta"] for f in client.get("/api/assets", auth=auth,
+                                                         params={"type": "vhd", "path": "meta"}).json()["vhds"]}
+        assert vhds["disk.img"] is None and vhds["moved.img"]["sha256"] == hashlib.sha256(disk).hexdigest()
+        assert brain.image_index.sync() == 1
+        assert wait_for(lambda: not brain.image_index.pending, timeout=60)
+        meta = brain.image_index.lookup("vhd", [listed(brain.VHD_DIR, "meta/disk.img")])["meta/disk.img"]
+        assert meta["sha256"] == hashlib.sha256(b"\xff" * 4096 + disk[4096:]).hexdigest()
+        (brain.ISO_DIR / "broken.iso").unlink()
+        brain.image_index.sync()
+        assert client.get("/api/images", auth=auth).json()["errors"] == []
+    finally:
+        brain.image_index.stop()
+        shutil.rmtree(brain.VHD_DIR / "meta")
+        for name in ("meta.iso", "broken.iso"):
+            (brain.ISO_DIR / name).unlink(missing_ok=True)
+        brain.image_index.sync()
+
+def test_image_index_reads_around_page_cache_and_backs_off(monkeypatch):
+    """Test chunked reads with and without O_DIRECT, and that a failed image is not re-read on every walk."""
+    data = os.urandom(3 * 4096 + 100)
+    path = TEST_ROOT / "chunks.img"
+    path.write_bytes(data)
+    for direct in (True, False):
+        with monkeypatch.context() as m:
+            if not direct:
+                m.delattr(os, "O_DIRECT", raising=False) # As on tmpfs: buffered, probed with RWF_NOWAIT
+            buffer = mmap.mmap(-1, 4096)
+            assert b"".join(bytes(c) for c in brain._read_image_chunks(str(path), buffer)) == data
+    path.unlink()
+
+    flaky = brain.VHD_DIR / "flaky.img"
+    flaky.write_bytes(b"\0" * 4096)
+    key, st = ("vhd", "flaky.img"), flaky.stat()
+    stamp = (st.st_ino, st.st_size, st.st_mtime_ns)
+    try:
+        failed = concurrent.futures.Future()
+        failed.set_exception(RuntimeError("Image changed while it was read"))
+        brain.image_index.pending[key] = stamp
+        brain.image_index._record(key, stamp, failed)
+        assert brain.image_index.failures[key][0] == 1
+        brain.image_index.sync()
+        assert key not in brain.image_index.pending # Backing off
+
+        brain.image_index.failures[key] = (1, 0) # Backoff over
+        brain.image_index.sync()
+        assert wait_for(lambda: not brain.image_index.pending, timeout=60)
+        assert key not in brain.image_index.failures
+        assert brain.image_index.lookup("vhd", [listed(brain.VHD_DIR, "flaky.img")])["flaky.img"]["sha256"]
+    finally:
+        brain.image_index.stop()
+        flaky.unlink()
+        brain.image_index.sync()
+
+def test_linux_kernel_boots_hold_admission_slot_until_lease(monkeypatch):
+    """Test that release lines are only emitted where nothing is fetched after 'boot'."""
+    manifest = {"profile": "fedora-live", "fingerprint": "f00d", "kernel": "vmlinuz", "initrd": "initrd.img",
+                "args": "rd.live.image root=live:{cache_url}/LiveOS/squashfs.img"}
+    monkeypatch.setattr(brain.iso_boot, "lookup", lambda *args, **kwargs: manifest)
+    lines = brain.iso_boot_lines("10.0.0.1", "live.iso", (1, 2), "c", release=["RELEASE"])
+    assert lines.index("RELEASE") > lines.index(":c_memdisk") # Only on the memdisk fallback
+
+    manifest = {"profile": "windows", "fingerprint": "f00d", "wimboot_files": [["boot.wim", "sources/boot.wim"]]}
+    lines = brain.iso_boot_lines("10.0.0.1", "win.iso", (1, 2), "c", release=["RELEASE"])
+    assert lines.index("RELEASE") < lines.index("boot || goto c_memdisk") # wimboot has it all in RAM
+
+def test_boot_admission_control():
+    """Test per-type budgets: queued clients sleep and re-chain, release frees the slot in order."""
+    auth = ("admin", "admin")
+    (brain.ISO_DIR / "storm.iso").write_bytes(b"\0" * 4096)
+    config = brain.load_config()
+    config.update(admission_control=True, admission_budgets={"memdisk": 1, "kernel": 0, "iscsi": 0},
+                  static_boot_export=True)
+    config["clients"] = [{"mac": f"aa:bb:cc:00:00:0{i}", "image": "storm.iso", "type": "iso"} for i in range(3)]
+    brain.save_config(config)
+    try:
+        first = client.get("/boot.ipxe", params={"mac": "aa:bb:cc:00:00:00"}).text
+        release = "imgfetch --name released http://127.0.0.1:8000/boot/release?mac=aa:bb:cc:00:00:00"
+        assert release in first
+        assert first.index(release) < first.index("memdisk iso raw") # Freed once the ISO is loaded
+
+        second = client.get("/boot.ipxe", params={"mac": "aa-bb-cc-00-00-01"}).text
+        assert "Boot queue (memdisk): position 1" in second
+        # The queue entry outlives the backoff the client was given by 2x, then counts as abandoned
+        delay = int(second.split("retrying in ")[1].split("s")[0])
+        expires = brain.admission._conn().execute(
+            "SELECT expires - since FROM waiting WHERE mac = 'aa:bb:cc:00:00:01'").fetchone()[0]
+        assert abs(expires - 2 * delay) < 1
+        # Straight back to the Brain: through nginx it could land in the static menu
+        assert "sleep " in second and "chain http://127.0.0.1:8000/boot.ipxe?mac=aa:bb:cc:00:00:01" in second
+        third = client.get("/boot.ipxe", params={"mac": "aa:bb:cc:00:00:02"}).text
+        assert "position 2" in third
+
+        report = client.get("/api/admission", auth=auth).json()
+        assert report["enabled"] and report["classes"]["memdisk"] == {"active": 1, "waiting": 2, "budget": 1}
+        assert [w["mac"] for w in report["waiting"]] == ["aa:bb:cc:00:00:01", "aa:bb:cc:00:00:02"]
+
+        assert client.get("/boot/release", params={"mac": "aa:bb:cc:00:00:00"}).text.startswith("#!ipxe")
+        # The slot goes to the earliest waiter even if a later one asks first
+        assert "Boot queue" in client.get("/boot.ipxe", params={"mac": "aa:bb:cc:00:00:02"}).text
+        assert "memdisk iso raw" in client.get("/boot.ipxe", params={"mac": "aa:bb:cc:00:00:01"}).text
+        assert 'pxe_admission_wait_seconds_count{class="memdisk"} 2' in client.get("/metrics").text
+
+        # With the static export on too, nginx finds a stub for every known client that hands
+        # the boot to the Brain, rather than no file and a fall through to the static menu
+        brain.export_static_boot_scripts()
+        stub = (brain.STATIC_BOOT_DIR / "clients" / "aa:bb:cc:00:00:01.ipxe").read_text()
+        assert stub == "#!ipxe\nchain http://127.0.0.1:8000/boot.ipxe?mac=aa:bb:cc:00:00:01\n"
+        assert (brain.STATIC_BOOT_DIR / "menu" / "menu.ipxe").exists() # Unknown MACs still get it
+    finally:
+        for i in range(3):
+            brain.admission.release(f"aa:bb:cc:00:00:0{i}")
+        brain.admission._conn().execute("DELETE FROM waiting")
+        brain.save_config(brain.DEFAULT_CONFIG.copy())
+        brain.export_static_boot_scripts()
+        (brain.ISO_DIR / "storm.iso").unlink()
+
+def test_injection_templates_render_per_client():
+    """Test .j2 injections: per-client rendering, cache hits and invalidation on template or client edits."""
+    auth = ("admin", "admin")
+    template = brain.INJECTION_DIR / "ks.cfg.j2"
+    template.write_text("network --hostname={{ hostname }}\npart / --size={{ vars.disk }}\n")
+    (brain.INJECTION_DIR / "static.cfg").write_text("plain\n")
+    client.put("/api/clients/aa:bb:cc:dd:ee:21", auth=auth, json={
+        "image": "ks.iso", "type": "iso", "hostname": "web-1", "injection_file": "ks.cfg.j2", "vars": {"disk": 40}})
+    url = "/injections/render/aa:bb:cc:dd:ee:21/ks.cfg"
+    try:
+        assert brain.client_injection_url(brain.get_config_snapshot().find_client("aa:bb:cc:dd:ee:21"), "10.0.0.1") \
+            == ("ks.cfg", "http://10.0.0.1:8000/injections/render/aa:bb:cc:dd:ee:21/ks.cfg")
+
+        response = client.get(url)
+        assert response.text == "network --hostname=web-1\npart / --size=40\n"
+        assert client.get(url, headers={"If-None-Match": response.headers["etag"]}).status_code == 304
+        assert 'pxe_injection_renders_total{result="hit"}' in client.get("/metrics").text
+
+        client.patch("/api/clients/aa:bb:cc:dd:ee:21", auth=auth, json={"vars": {"disk": 80}})
+        assert "--size=80" in client.get(url).text
+        template.write_text("# v2 {{ mac }}\n")
+        assert client.get(url).text == "# v2 aa:bb:cc:dd:ee:21\n"
+
+        template.write_text("{{ vars.missing }}")
+        assert client.get(url).status_code == 422 # Better than installing with a blank value
+        assert "local-hostname: web-1" in client.get("/injections/render/aa:bb:cc:dd:ee:21/meta-data").text
+        assert client.get("/injections/render/aa:bb:cc:dd:ee:21/static.cfg").text == "plain\n"
+        assert client.get("/injections/static.cfg").text == "plain\n" # Static mount still works
+        assert client.get("/injections/render/aa:bb:cc:dd:ee:99/ks.cfg").status_code == 404
+
+        rows = brain.parse_client_rows(b"mac,image,type,vars.disk,vars.role\n11:22:33:44:55:66,a.iso,iso,20,db\n", "text/csv")
+        assert rows[0]["vars"] == {"disk": "20", "role": "db"}
+    finally:
+        client.delete("/api/clients/aa:bb:cc:dd:ee:21", auth=auth)
+        template.unlink()
+        (brain.INJECTION_DIR / "static.cfg").unlink()
+
+def test_upload_injection_streams_with_limits(monkeypatch):
+    """Test multi-file uploads: hashing, duplicate detection, name sanitising and the size cap."""
+    auth = ("admin", "admin")
+    body = b"#cloud-config\nhostname: lab\n"
+    staged = []
+    commit = brain._commit_upload
+    def spy(part):
+        staged.append(part.tmp_path)
+        assert client.get(f"/injections/{part.tmp_path.name}").status_code == 404
+        return commit(part)
+    monkeypatch.setattr(brain, "_commit_upload", spy)
+    try:
+        response = client.post("/api/upload_injection", auth=auth, files=[
+            ("files", ("../../user-data", body)),
+            ("files", ("copy-of-user-data", body)),
+        ])
+        assert response.status_code == 200
+        result = response.json()
+        assert result["status"] == "success" and result["filename"] == "user-data"
+        first, second = result["files"]
+        assert first["sha256"] == hashlib.sha256(body).hexdigest() and first["size"] == len(body)
+        assert second["duplicate_of"] == "user-data"
+        assert (brain.INJECTION_DIR / "user-data").read_bytes() == body
+        # Partial files are staged where nothing serves them
+        assert staged and all(p.parent == brain.UPLOAD_DIR and not p.exists() for p in staged)
+
+        # Re-uploading identical content leaves the file alone
+        response = client.post("/api/upload_injection", auth=auth, files={"file": ("user-data", body)})
+        assert response.json()["files"][0].get("unchanged") is True
+
+        # A replaced file takes over its hash entry; across filesystems the rename is still atomic
+        replace = os.replace
+        def cross_device(src, dst):
+            if Path(src).parent == brain.UPLOAD_DIR:
+                raise OSError(brain.errno.EXDEV, "Invalid cross-device link")
+            replace(src, dst)
+        monkeypatch.setattr(brain.os, "replace", cross_device)
+        response = client.post("/api/upload_injection", auth=auth, files={"file": ("user-data", body + b"v2\n")})
+        monkeypatch.setattr(brain.os, "replace", replace)
+        assert response.json()["status"] == "success"
+        assert (brain.INJECTION_DIR / "user-data").read_bytes() == body + b"v2\n"
+        assert brain.injection_sha256(brain.INJECTION_DIR / "user-data") == hashlib.sha256(body + b"v2\n").hexdigest()
+        assert list(brain._INJECTION_HASHES).count("user-data") == 1
+        assert not list(brain.INJECTION_DIR.glob(".upload-*")) and not list(brain.UPLOAD_DIR.iterdir())
+
+        config = brain.DEFAULT_CONFIG.copy()
+        config["max_injection_upload_mb"] = 1
+        brain.save_config(config)
+        response = client.post("/api/upload_injection", auth=auth,
+                               files={"file": ("big.iso", b"\0" * (1024 * 1024 + 1))})
+        assert response.status_code == 413
+        assert not (brain.INJECTION_DIR / "big.iso").exists()
+        assert not list(brain.INJECTION_DIR.glob(".upload-*"))
+
+        response = client.post("/api/upload_injection", auth=auth, files={"file": (".hidden", body)})
+        assert response.status_code == 400
+    finally:
+        brain.save_config(brain.DEFAULT_CONFIG.copy())
+        for name in ("user-data", "copy-of-user-data"):
+            (brain.INJECTION_DIR / name).unlink(missing_ok=True)
+
+def test_metrics_endpoint():
+    """Test that /metrics exposes route latency, boot outcomes and scan timings."""
+    (brain.ISO_DIR / "metrics.iso").write_bytes(b"")
+    try:
+        client.get("/boot.ipxe")
+        client.get("/boot.ipxe", params={"mac": "00:11:22:33:44:99"})
+        response = client.get("/metrics")
+        assert response.status_code == 200
+        body = response.text
+        assert 'pxe_http_request_duration_seconds_count{route="/boot.ipxe",method="GET"}' in body
+        assert 'pxe_http_requests_total{route="/boot.ipxe",method="GET",status="200"}' in body
+        assert 'pxe_boots_total{mode="menu",boot_type="root",outcome="served"}' in body
+        assert 'pxe_boots_total{mode="menu",boot_type="root",outcome="unknown_mac"}' in body
+        assert 'pxe_asset_scan_duration_seconds_bucket{root="isos",le="+Inf"}' in body
+        assert "pxe_config_version " in body
+        assert "# TYPE pxe_targets_sync_duration_seconds histogram" in body
+    finally:
+        (brain.ISO_DIR / "metrics.iso").unlink()
+
+def test_blocking_work_stays_off_event_loop():
+    """Test that blocking handlers run on the disk pool and the lag monitor reports stalls."""
+
+    @brain.off_loop
+    def slow(delay):
+        time.sleep(delay)
+        return threading.current_thread().name
+
+    async def run():
+        ticks = 0
+        async def ticker():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+        task = asyncio.ensure_future(ticker())
+        name = await slow(0.3)
+        task.cancel()
+        monitor = asyncio.ensure_future(brain.monitor_event_loop_lag())
+        await asyncio.sleep(0.01)
+        time.sleep(brain.LOOP_LAG_INTERVAL + brain.LOOP_LAG_THRESHOLD * 2) # Deliberately block the loop
+        await asyncio.sleep(brain.LOOP_LAG_INTERVAL * 2)
+        monitor.cancel()
+        return name, ticks
+
+    stalls = brain.LOOP_STALLS.values.get((), 0)
+    name, ticks = asyncio.run(run())
+    assert name.startswith("disk")
+    assert ticks > 10
+    assert brain.LOOP_STALLS.values.get((), 0) > stalls
+    assert "pxe_event_loop_lag_seconds_count" in client.get("/metrics").text
+
+def test_cluster_leader_and_followers(tmp_path, monkeypatch):
+    """Test that one process wins the leader lock and followers act on its published state."""
+    leader, follower = brain.Cluster(tmp_path), brain.Cluster(tmp_path)
+    monkeypatch.setattr(brain, "cluster", follower)
+    leader.commands_dir.mkdir(parents=True)
+    assert leader.try_lead()
+    assert not follower.try_lead() # flock is per open file, so this holds within one process too
+    assert follower.leader() == leader.node
+
+    key = brain.overlay_path_for("cluster.vhd", "00:11:22:33:44:c1").name
+    try:
+        with brain.overlays.lock:
+            job = brain.overlays.job("cluster.vhd", "00:11:22:33:44:c1")
+            brain.overlays._set_state(job, brain.OVERLAY_FAILED, "boom")
+        leader.publish()
+        changes = brain.ASSET_INDEX.changes
+        follower.follow()
+        assert brain.ASSET_INDEX.changes > changes # First state seen drops local listings
+        assert follower.state["leader"] == leader.node
+
+        # As a follower this process reports the leader's jobs and never creates overlays
+        del brain.overlays.jobs[key]
+        assert brain.overlays.status("cluster.vhd", "00:11:22:33:44:c1")["error"] == "boom"
+        assert brain.overlays.submit("cluster.vhd", "00:11:22:33:44:d2") == brain.OVERLAY_PENDING
+        assert not brain.overlays.jobs
+        brain.overlays.submit("cluster.vhd", "00:11:22:33:44:c1", force=True)
+
+        follower.send("refresh")
+        commands = leader.take_commands()
+        assert [c["action"] for c in commands] == ["overlay_retry", "refresh"]
+        assert commands[0]["mac"] == "00:11:22:33:44:c1"
+        assert not leader.take_commands()
+
+        # Events reach followers as small files holding only what is new
+        monkeypatch.setattr(brain.EventBus, "SIZE", 4)
+        ours, theirs = brain.EventBus(), brain.EventBus()
+        def on(bus, step):
+            monkeypatch.setattr(brain, "events", bus)
+            step()
+        theirs.ingest([{"type": "menu", "n": n} for n in range(3)])
+        leader.reset_events()
+        on(theirs, leader.publish)
+        on(ours, follower.follow_events)
+        assert [e["id"] for e in ours.ring] == [1, 2, 3] and follower.events_leader == leader.node
+        theirs.ingest([{"type": "boot"}])
+        on(theirs, leader.publish)
+        assert [c[:2] for c in leader.event_chunks()] == [(1, 3), (4, 4)]
+        on(ours, follower.follow_events)
+        assert [e["id"] for e in ours.ring] == [1, 2, 3, 4] and ours.ring[-1]["type"] == "boot"
+        theirs.ingest([{"type": "boot"}] * 4)
+        on(theirs, leader.publish)
+        assert [c[:2] for c in leader.event_chunks()] == [(5, 8)] # Older files fell out of the ring
+
+        # A new leader numbers from its own ring; followers re-read what it published
+        leader.node = "other:1"
+        fresh = brain.EventBus()
+        fresh.ingest([{"type": "boot"}] * 5)
+        leader.reset_events()
+        on(fresh, leader.publish)
+        on(ours, follower.follow_events)
+        assert [e["id"] for e in ours.ring] == [2, 3, 4, 5] and follower.events_leader == "other:1"
+    finally:
+        brain.overlays.remote = None
+        brain.overlays.jobs.pop(key, None)
+        os.close(leader.lock_fd)
+
+TGTADM_SHOW_WITH_SESSIONS = """Target 1: iqn.2024-01.com.pxeserver:001122334455:lab-img
+    System information:
+        Driver: iscsi
+        State: ready
+    I_T nexus information:
+        I_T nexus: 3
+            Initiator: iqn.1991-05.com.microsoft:lab-01 alias: LAB-01
+            Connection: 0
+                IP Address: 10.0.0.51
+    LUN information:
+        LUN: 1
+            Backing store path: /srv/overlay.qcow2
+    ACL information:
+        ALL
+"""
+
+def test_live_event_stream(monkeypatch):
+    """Test that boots and sessions reach SSE consoles from one ring, resumable by Last-Event-ID."""
+    monkeypatch.setattr(brain.EventBus, "SIZE", 5)
+    bus = brain.EventBus()
+    monkeypatch.setattr(brain, "events", bus)
+    assert client.get("/api/events").status_code == 401
+
+    assert client.get("/boot.ipxe", params={"path": "", "type": "iso"}).status_code == 200
+    assert [e["type"] for e in bus.ring] == ["menu"]
+    assert bus.ring[0]["kind"] == "iso" and bus.ring[0]["id"] == 1
+
+    # One tgtadm poll feeds /api/sessions and session_start events
+    monkeypatch.setattr(brain.targets, "_tgtadm", lambda *args: TGTADM_SHOW_WITH_SESSIONS)
+    bus.set_sessions(brain.targets.sessions())
+    sessions = client.get("/api/sessions", auth=("admin", "admin")).json()
+    assert sessions == [{"type": "iscsi", "target": "iqn.2024-01.com.pxeserver:001122334455:lab-img",
+                         "initiator": "iqn.1991-05.com.microsoft:lab-01", "client": "10.0.0.51",
+                         "mac": None, "hostname": None}]
+    assert bus.ring[-1]["type"] == "session_start"
+    bus.set_sessions(list(sessions)) # Unchanged list: no event
+    assert bus.seq == 2
+
+    class Console:
+        async def is_disconnected(self):
+            return False
+
+    async def read(last_id, count, emit=None):
+        stream = brain.event_stream(Console(), last_id)
+        messages = []
+        try:
+            while len(messages) < count:
+                messages.append(await asyncio.wait_for(stream.__anext__(), 5))
+                if emit and len(messages) == count - 1:
+                    threading.Thread(target=emit).start() # Producers run off the loop
+        finally:
+            await stream.aclose()
+        return messages
+
+    messages = asyncio.run(read(1, 3))
+    assert messages[0].startswith("retry:")
+    assert messages[1].startswith("event: sessions\n") and "10.0.0.51" in messages[1]
+    assert messages[2].startswith("id: 2\nevent: session_start\n")
+
+    # A console idling at the head is woken by an event from another thread
+    messages = asyncio.run(read(2, 3, emit=lambda: bus.emit("targets", added=["iqn.x"], removed=[], changed=[])))
+    assert messages[2].startswith("id: 3\nevent: targets\n")
+    assert bus.streams == 0
+
+    for _ in range(5):
+        bus.emit("menu", path="", kind="root", mac=None, outcome="served")
+    messages = asyncio.run(read(1, 4))
+    assert json.loads(messages[2].split("data: ", 1)[1]) == {"missed": 2} # Ids 2 and 3 fell out of the ring
+    assert messages[3].startswith("id: 4\n")
+
+def test_startup_warms_up_in_background():
+    """Test that boots are served at once and /readyz reports warm-up phases until ready."""
+    assert client.get("/healthz").json() == {"status": "ok"}
+    with TestClient(app) as started:
+        assert started.get("/boot.ipxe").status_code == 200 # Does not wait for warm-up
+        deadline = time.time() + 10
+        while started.get("/readyz").status_code != 200 and time.time() < deadline:
+            time.sleep(0.05)
+        report = started.get("/readyz").json()
+        assert report["ready"] and report["error"] is None
+        for phase in ("import", "config", "asset_scan", "cluster", "leader.targets"):
+            assert report["phases"][phase]["state"] == "done"
+        assert started.get("/api/cluster", auth=("admin", "admin")).json()["role"] == "leader"
+        assert 'pxe_startup_phase_seconds{phase="asset_scan"}' in started.get("/metrics").text
+    assert not brain.cluster.joined
+
+def test_startup_follows_until_elected_and_retries_warm_up(monkeypatch):
+    """Test that a starting process leads nothing before the election, and a failed warm-up is retried."""
+    monkeypatch.setattr(brain.WarmUp, "RETRY_MIN", 0.1)
+    release, calls = threading.Event(), []
+    listing = brain.get_directory_contents
+
+    def flaky_listing(*args):
+        calls.append(args)
+        if len(calls) == 1:
+            release.wait(5)
+            raise OSError("storage not mounted yet")
+        return listing(*args)
+    monkeypatch.setattr(brain, "get_directory_contents", flaky_listing)
+    with TestClient(app) as started:
+        auth = ("admin", "admin")
+        assert started.get("/api/cluster", auth=auth).json()["role"] == "joining"
+        assert not brain.cluster.is_leader and brain.overlays.remote == {}
+        release.set()
+        assert wait_for(lambda: started.get("/readyz").status_code == 200)
+        report = started.get("/readyz").json()
+        assert report["attempts"] == 2 and report["error"] is None
+        assert started.get("/api/cluster", auth=auth).json()["role"] == "leader"
+    assert not brain.cluster.joined and brain.cluster.is_leader
+
+def test_client_crud_and_bulk_import():
+    """Test per-client endpoints and all-or-nothing bulk import."""
+    auth = ("admin", "admin")
+    try:
+        response = client.put("/api/clients/52-54-00-00-00-01", auth=auth, json={"image": "a.iso", "type": "iso"})
+        assert response.status_code == 200
+        assert client.get("/api/clients/525400000001", auth=auth).json()["image"] == "a.iso"
+        before = brain.get_config_snapshot()
+        rev = before.client_revisions["52:54:00:00:00:01"]
+
+        csv_body = ("mac,image,type,hostname,overlay\n"
+                    + "".join(f"52:54:00:00:01:{i:02x},b.iso,iso,lab-{i},no\n" for i in range(200)))
+        response = client.post("/api/clients/import", auth=auth, content=csv_body,
+                               headers={"Content-Type": "text/csv"})
+        assert response.json()["created"] == 200
+        after = brain.get_config_snapshot()
+        # Untouched clients keep their revision, so their cached boot scripts stay valid
+        assert after.client_revisions["52:54:00:00:00:01"] == rev
+        assert after.settings_version == before.settings_version
+        assert "Auto-booting" in client.get("/boot.ipxe", params={"mac": "52:54:00:00:01:0a"}).text
+        # The patched snapshot matches what a reload would produce
+        assert after.config["clients"] == brain.CONFIG_STORE.load()["clients"]
+
+        # One bad row rejects the whole batch
+        bad = [{"mac": "52:54:00:00:02:01", "image": "c.iso", "type": "iso"},
+               {"mac": "not-a-mac", "image": "c.iso", "type": "iso"},
+               {"mac": "52:54:00:00:02:02", "image": "c.iso", "type": "floppy"}]
+        response = client.post("/api/clients/import", auth=auth, json=bad)
+        assert response.status_code == 422
+        assert [e["row"] for e in response.json()["detail"]["errors"]] == [2, 3]
+        assert client.get("/api/clients/52:54:00:00:02:01", auth=auth).status_code == 404
+
+        response = client.patch("/api/clients/52:54:00:00:01:0a", auth=auth, json={"kernel_args": "quiet"})
+        assert response.json()["client"]["kernel_args"] == "quiet"
+        assert response.json()["client"]["image"] == "b.iso"
+
+        assert client.delete("/api/clients/52:54:00:00:01:0a", auth=auth).status_code == 200
+        assert client.get("/api/clients/52:54:00:00:01:0a", auth=auth).status_code == 404
+
+        response = client.post("/api/clients/import?mode=replace", auth=auth,
+                               json={"clients": [{"mac": "52:54:00:00:00:01", "image": "a.iso", "type": "iso"}]})
+        assert response.json() == {"status": "success", "imported": 1, "created": 0, "updated": 0,
+                                   "unchanged": 1, "removed": 199}
+        assert len(client.get("/api/clients", auth=auth).json()) == 1
+
+        # The whole-config endpoint stores MACs in the same form as the per-client API
+        body = brain.load_config()
+        body["clients"] = [{"mac": "52-54-00-00-00-01", "image": "a.iso", "type": "iso"}]
+        response = client.post("/api/config", auth=auth, json=body)
+        assert response.json()["config"]["clients"][0]["mac"] == "52:54:00:00:00:01"
+        assert brain.get_config_snapshot().config["clients"][0]["mac"] == "52:54:00:00:00:01"
+        body["clients"].append({"mac": "not-a-mac", "image": "a.iso", "type": "iso"})
+        assert client.post("/api/config", auth=auth, json=body).status_code == 422
+    finally:
+        brain.save_config(brain.DEFAULT_CONFIG.copy())
+
+FAKE_QEMU_IMG = '''#!{python}
+import struct, sys
+args = sys.argv[1:]
+with open({log!r}, "a") as log:
+    log.write(" ".join(args) + "\\n")
+if args[0] == "create":
+    backing = args[args.index("-b") + 1].encode()
+    size = len(open(backing, "rb").read())
+    header = struct.pack(">4sIQIIQ", b"QFI\\xfb", 3, 72, len(backing), 16, size)
+    with open(args[-1], "wb") as f:
+        f.write(header.ljust(72, b"\\0") + backing + b"\\0" * 4096)
+'''
+
+def test_overlay_lifecycle(monkeypatch):
+    """Test storage accounting, orphan GC, and background reset/rebase/commit."""
+    bin_dir = TEST_ROOT / "bin"
+    bin_dir.mkdir(exist_ok=True)
+    log = TEST_ROOT / "qemu-img.log"
+    log.write_text("")
+    qemu_img = bin_dir / "qemu-img"
+    qemu_img.write_text(FAKE_QEMU_IMG.format(python=sys.executable, log=str(log)))
+    qemu_img.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+    auth = ("admin", "admin")
+
+    master = brain.VHD_DIR / "lab.img"
+    master.write_bytes(b"\0" * 65536)
+    master_v2 = brain.VHD_DIR / "lab-v2.img"
+    macs = ["aa:bb:cc:dd:ee:20", "aa:bb:cc:dd:ee:21"]
+    config = brain.load_config()
+    config["clients"] = [{"mac": m, "image": "lab.img", "type": "vhd", "overlay": True} for m in macs]
+    brain.save_config(config)
+
+    def states():
+        return {o["mac"]: o["state"] for o in client.get("/api/overlays", auth=auth).json()}
+    try:
+        brain.request_targets_refresh()
+        assert wait_for(lambda: set(states().values()) == {"ready"})
+
+        storage = client.get("/api/overlays/storage", auth=auth).json()
+        assert storage["orphans"] == 0 and len(storage["overlays"]) == 2
+        first = storage["overlays"][0]
+        assert first["virtual_bytes"] == 65536 and first["allocated_bytes"] > 0
+        assert first["backing_file"] == str(master.resolve()) and first["stale"] is False
+
+        orphan = brain.OVERLAY_DIR / "deadbeef0000_old.img.qcow2"
+        orphan.write_bytes(b"\0" * 100)
+        fresh_orphan = brain.OVERLAY_DIR / "deadbeef0001_old.img.qcow2"
+        fresh_orphan.write_bytes(b"\0" * 100)
+        os.utime(orphan, (time.time() - 7200, time.time() - 7200))
+        assert client.post("/api/overlays/gc?dry_run=true", auth=auth).json()["removed"] == [orphan.name]
+        assert orphan.exists()
+        assert client.post("/api/overlays/gc", auth=auth).json()["removed"] == [orphan.name]
+        assert not orphan.exists() and fresh_orphan.exists() # Inside the grace period
+        fresh_orphan.unlink()
+
+        # Rewriting the master in place marks its overlays stale; only a reset fixes that
+        master.write_bytes(b"\1" * 65536)
+        assert all(o["stale"] for o in client.get("/api/overlays/storage", auth=auth).json()["overlays"])
+        response = client.post(f"/api/overlays/{macs[0]}/rebase", auth=auth)
+        assert response.status_code == 409 and "reset" in response.json()["detail"]
+
+        # Re-pointing the image at a new master file is what rebase is for
+        master.unlink()
+        master_v2.write_bytes(b"\2" * 65536)
+        master.symlink_to(master_v2.name)
+        assert client.post(f"/api/overlays/{macs[0]}/rebase", auth=auth).json()["state"] == "maintenance"
+        assert wait_for(lambda: states()[macs[0]] == "ready")
+        stale = {o["mac"]: o["stale"] for o in client.get("/api/overlays/storage", auth=auth).json()["overlays"]}
+        assert stale == {macs[0]: False, macs[1]: True}
+
+        client.post(f"/api/overlays/{macs[1]}/reset", auth=auth)
+        assert wait_for(lambda: states()[macs[1]] == "ready")
+        assert log.read_text().count("create") == 3
+
+        response = client.post(f"/api/overlays/{macs[0]}/commit", auth=auth).json()
+        assert sorted(response["affected"]) == macs
+        assert wait_for(lambda: set(states().values()) == {"ready"} and "commit" in log.read_text())
+        assert log.read_text().count("create") == 4 # The other client's overlay was recreated
+        assert client.post("/api/overlays/aa:bb:cc:dd:ee:99/reset", auth=auth).status_code == 404
+    finally:
+        brain.save_config(brain.DEFAULT_CONFIG.copy())
+        master.unlink()
+        master_v2.unlink(missing_ok=True)
+        for overlay in brain.OVERLAY_DIR.glob("*"):
+            overlay.unlink()
+
+def vhd_footer(disk_type: int) -> bytes:
+    return (b"conectix" + b"\0" * 52 + struct.pack(">I", disk_type)).ljust(512, b"\0")
+
+def test_http_san_range_requests(monkeypatch):
+    """Test the /san/ endpoint (HEAD, single and multiple ranges) and per-client protocol selection."""
+    data = bytes(range(256)) * 1024
+    (brain.VHD_DIR / "raw.img").write_bytes(data)
+    (brain.VHD_DIR / "fixed.vhd").write_bytes(data + vhd_footer(2))
+    (brain.VHD_DIR / "dynamic.vhd").write_bytes(vhd_footer(3) + data + vhd_footer(3))
+    try:
+        response = client.head("/san/raw.img")
+        assert response.status_code == 200 and response.content == b""
+        assert response.headers["content-length"] == str(len(data))
+        assert response.headers["accept-ranges"] == "bytes"
+
+        assert client.get("/san/raw.img").content == data
+        response = client.get("/san/raw.img", headers={"Range": "bytes=512-1023"})
+        assert response.status_code == 206 and response.content == data[512:1024]
+        assert response.headers["content-range"] == f"bytes 512-1023/{len(data)}"
+        assert client.get("/san/raw.img", headers={"Range": "bytes=-100"}).content == data[-100:]
+
+        response = client.get("/san/raw.img", headers={"Range": "bytes=0-9, 2000-2009"})
+        assert response.status_code == 206
+        assert response.headers["content-type"].startswith("multipart/byteranges; boundary=")
+        assert int(response.headers["content-length"]) == len(response.content)
+        assert data[0:10] in response.content and data[2000:2010] in response.content
+        assert f"Content-Range: bytes 2000-2009/{len(data)}".encode() in response.content
+
+        response = client.get("/san/raw.img", headers={"Range": f"bytes={len(data)}-"})
+        assert response.status_code == 416
+        assert client.get("/san/../../config.json").status_code == 404
+
+        # A fixed VHD is raw data plus a footer, which is not part of the disk
+        response = client.get("/san/fixed.vhd")
+        assert response.content == data and response.headers["content-length"] == str(len(data))
+        assert client.get("/san/dynamic.vhd").status_code == 415
+
+        # Mappings are bounded and dropped once idle
+        monkeypatch.setattr(brain, "SAN_MAX_IMAGES", 1)
+        client.head("/san/raw.img")
+        assert list(brain._SAN_IMAGES) == [str((brain.VHD_DIR / "raw.img").resolve())]
+        monkeypatch.setattr(brain, "SAN_IDLE_SECONDS", 0)
+        client.head("/san/fixed.vhd")
+        assert not brain._SAN_IMAGES
+
+        config = brain.load_config()
+        config["clients"] = [
+            {"mac": "aa:bb:cc:dd:ee:30", "image": "raw.img", "type": "vhd", "san_protocol": "http"},
+            {"mac": "aa:bb:cc:dd:ee:31", "image": "raw.img", "type": "vhd", "san_protocol": "http", "overlay": True},
+            {"mac": "aa:bb:cc:dd:ee:32", "image": "dynamic.vhd", "type": "vhd", "san_protocol": "http"},
+        ]
+        brain.save_config(config)
+        script = client.get("/boot.ipxe", params={"mac": "aa:bb:cc:dd:ee:30"}).text
+        assert "sanboot http://127.0.0.1:8000/san/raw.img" in script
+        script = client.get("/boot.ipxe", params={"mac": "aa:bb:cc:dd:ee:31"}).text
+        assert "sanboot http://" not in script # Overlays are writable, so they stay on iSCSI
+        script = client.get("/boot.ipxe", params={"mac": "aa:bb:cc:dd:ee:32"}).text
+        assert "sanboot http://" not in script and "sanboot iscsi:" in script
+    finally:
+        brain.save_config(brain.DEFAULT_CONFIG.copy())
+        (brain.VHD_DIR / "raw.img").unlink()
+        (brain.VHD_DIR / "fixed.vhd").unlink()
+        (brain.VHD_DIR / "dynamic.vhd").unlink()
+        for overlay in brain.OVERLAY_DIR.glob("*"):
+            overlay.unlink()